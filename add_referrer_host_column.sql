@@ -0,0 +1 @@
+ALTER TABLE visits ADD COLUMN IF NOT EXISTS referrer_host VARCHAR(255);
@@ -0,0 +1 @@
+ALTER TABLE rules ADD COLUMN IF NOT EXISTS conditions TEXT;
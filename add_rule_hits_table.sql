@@ -0,0 +1,9 @@
+CREATE TABLE IF NOT EXISTS rule_hits (
+    id SERIAL PRIMARY KEY,
+    url_id INTEGER NOT NULL REFERENCES urls(id),
+    rule_key VARCHAR(20) NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT NOW(),
+    CONSTRAINT uq_rule_hits_url_id_rule_key UNIQUE (url_id, rule_key)
+);
+CREATE INDEX IF NOT EXISTS ix_rule_hits_url_id ON rule_hits (url_id);
@@ -0,0 +1,367 @@
+"""Click analytics aggregation for URL Shortener."""
+
+import hashlib
+import os
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import String, func, select, type_coerce
+from sqlalchemy.orm import Session
+
+from cache import cache
+from models import Url, Visit
+
+# Optional NumPy support for aggregating links with many visits
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Links with at least this many clicks are aggregated with NumPy (0: never).
+# GROUP BY in the database is faster on SQLite, see benchmarks/bench_analytics.py
+VECTORIZE_MIN_CLICKS = int(os.getenv("ANALYTICS_VECTORIZE_MIN_CLICKS", "0"))
+# Cached aggregates are recomputed from scratch at least this often
+RECOMPUTE_SECONDS = int(os.getenv("ANALYTICS_RECOMPUTE_SECONDS", "300"))
+# Number of visit rows fetched from the database per chunk
+FETCH_CHUNK_ROWS = 100000
+# Length of the unique-visitor series returned by the analytics API
+UNIQUE_VISITOR_DAYS = 30
+UNIQUE_VISITOR_WEEKS = 12
+UNIQUE_VISITOR_MONTHS = 6
+# Page size of the recent visits table (default and maximum)
+RECENT_VISITS_LIMIT = int(os.getenv("ANALYTICS_VISITS_LIMIT", "100"))
+MAX_RECENT_VISITS_LIMIT = 1000
+
+
+def empty_aggregates() -> Dict[str, Any]:
+    """Create empty analytics aggregates."""
+    return {
+        "last_visit_id": 0,
+        "clicks_over_time": {},
+        "devices": {},
+        "countries": {},
+        "referrers": {},
+    }
+
+
+def _merge_counts(newer: Dict[str, int], older: Dict[str, int]) -> Dict[str, int]:
+    """Merge two counters, keeping keys of the newer one first."""
+    merged = dict(newer)
+    for key, count in older.items():
+        merged[key] = merged.get(key, 0) + count
+    return merged
+
+
+def _sort_referrers(referrers: Dict[str, int]) -> Dict[str, int]:
+    """Order referrers by count (descending), then by host."""
+    return dict(sorted(referrers.items(), key=lambda item: (-item[1], item[0])))
+
+
+def _or_default(column, default: str):
+    """SQL expression replacing NULL and empty values of a column."""
+    return func.coalesce(func.nullif(column, ""), default)
+
+
+def _grouped_aggregates(db: Session, visit_filters: list) -> Dict[str, Any]:
+    """Count visits by day, device, country and referrer with GROUP BY queries."""
+    count = func.count(Visit.id)
+    day = func.date(Visit.created_at)
+    days = (
+        db.query(day, count, func.max(Visit.id))
+        .filter(*visit_filters)
+        .group_by(day)
+        .order_by(day.desc())
+        .all()
+    )
+    aggregates = empty_aggregates()
+    if not days:
+        return aggregates
+
+    def count_by(column, default: str) -> Dict[str, int]:
+        key = _or_default(column, default)
+        rows = (
+            db.query(key, count)
+            .filter(*visit_filters)
+            .group_by(key)
+            .order_by(count.desc(), key)
+            .all()
+        )
+        return {value: total for value, total in rows}
+
+    aggregates["last_visit_id"] = max(last_id for _, _, last_id in days)
+    aggregates["clicks_over_time"] = {str(value): total for value, total, _ in days}
+    aggregates["devices"] = count_by(Visit.device_type, "unknown")
+    aggregates["countries"] = count_by(Visit.country_code, "XX")
+    # Referrer hosts are normalized at ingest, so this is a plain GROUP BY
+    aggregates["referrers"] = count_by(Visit.referrer_host, "direct")
+    return aggregates
+
+
+def merge_aggregates(newer: Dict[str, Any], older: Dict[str, Any]) -> Dict[str, Any]:
+    """Add the aggregates of newer visits to older aggregates."""
+    return {
+        "last_visit_id": max(newer["last_visit_id"], older["last_visit_id"]),
+        "clicks_over_time": _merge_counts(
+            newer["clicks_over_time"], older["clicks_over_time"]
+        ),
+        "devices": _merge_counts(newer["devices"], older["devices"]),
+        "countries": _merge_counts(newer["countries"], older["countries"]),
+        "referrers": _sort_referrers(
+            _merge_counts(newer["referrers"], older["referrers"])
+        ),
+    }
+
+
+def compute_aggregates(
+    db: Session, url: Url, visit_filters: Optional[list] = None
+) -> Dict[str, Any]:
+    """Compute analytics aggregates for a URL from scratch.
+
+    Counts come from GROUP BY queries; with ANALYTICS_VECTORIZE_MIN_CLICKS
+    set, links with that many clicks are aggregated with NumPy instead.
+    """
+    if (
+        np is not None
+        and VECTORIZE_MIN_CLICKS
+        and (url.click_count or 0) >= VECTORIZE_MIN_CLICKS
+    ):
+        return aggregate_vectorized(db, url, visit_filters)
+    return aggregate_grouped(db, url, visit_filters)
+
+
+def aggregate_grouped(
+    db: Session, url: Url, visit_filters: Optional[list] = None
+) -> Dict[str, Any]:
+    """Aggregate a URL's visits in the database with GROUP BY queries."""
+    visit_filters = [Visit.url_id == url.id] + list(visit_filters or [])
+    return _grouped_aggregates(db, visit_filters)
+
+
+def _count_in_order(counter: Dict[str, int], values) -> None:
+    """Add value counts of an array to a counter in order of first appearance."""
+    uniques, first_index, codes = np.unique(
+        values, return_index=True, return_inverse=True
+    )
+    counts = np.bincount(codes.ravel(), minlength=len(uniques))
+    order = np.argsort(first_index, kind="stable")
+    if values.dtype.kind == "M":
+        keys = np.datetime_as_string(uniques[order], unit="D").tolist()
+    else:
+        keys = uniques[order].tolist()
+    for key, count in zip(keys, counts[order].tolist()):
+        counter[key] = counter.get(key, 0) + count
+
+
+def aggregate_vectorized(
+    db: Session, url: Url, visit_filters: Optional[list] = None
+) -> Dict[str, Any]:
+    """Aggregate a URL's visits with NumPy, fetching columns in large chunks.
+
+    Produces exactly the same aggregates as :func:`aggregate_grouped`.
+    """
+    visit_filters = [Visit.url_id == url.id] + list(visit_filters or [])
+    statement = (
+        select(
+            Visit.id,
+            # Raw driver values: NumPy parses SQLite's ISO strings in C
+            type_coerce(Visit.created_at, String),
+            _or_default(Visit.device_type, "unknown"),
+            _or_default(Visit.country_code, "XX"),
+            _or_default(Visit.referrer_host, "direct"),
+        )
+        .where(*visit_filters)
+        .order_by(Visit.created_at.desc(), Visit.id.desc())
+        .execution_options(stream_results=True)
+    )
+
+    aggregates = empty_aggregates()
+    referrers: Dict[str, int] = {}
+    # Core execution skips ORM row processing for the large result
+    result = db.connection().execute(statement)
+
+    for chunk in result.partitions(FETCH_CHUNK_ROWS):
+        ids, created, devices, countries, hosts = zip(*chunk)
+
+        aggregates["last_visit_id"] = max(
+            aggregates["last_visit_id"], int(np.max(np.array(ids, dtype=np.int64)))
+        )
+        days = np.array(created, dtype="datetime64[s]").astype("datetime64[D]")
+
+        _count_in_order(aggregates["clicks_over_time"], days)
+        _count_in_order(aggregates["devices"], np.array(devices, dtype=str))
+        _count_in_order(aggregates["countries"], np.array(countries, dtype=str))
+        _count_in_order(referrers, np.array(hosts, dtype=str))
+
+    aggregates["referrers"] = _sort_referrers(referrers)
+    return aggregates
+
+
+def get_cached_aggregates(db: Session, url: Url) -> Dict[str, Any]:
+    """Get analytics aggregates, folding in only visits newer than the cache.
+
+    The cache holds the counters and the high-water mark only, so its size does
+    not grow with the number of visits. Visits are logged by concurrent
+    workers, so one with an id below the high-water mark can commit after the
+    fold; folding keeps the entry's expiry, and the recompute every
+    RECOMPUTE_SECONDS counts such visits.
+    """
+    aggregates = cache.get_analytics_data(url.id)
+    if aggregates is None:
+        aggregates = compute_aggregates(db, url)
+        cache.set_analytics_data(url.id, aggregates, RECOMPUTE_SECONDS)
+        return aggregates
+
+    new_visits = _grouped_aggregates(
+        db, [Visit.url_id == url.id, Visit.id > aggregates["last_visit_id"]]
+    )
+    if new_visits["last_visit_id"]:
+        aggregates = merge_aggregates(new_visits, aggregates)
+        cache.set_analytics_data(url.id, aggregates, keep_ttl=True)
+
+    return aggregates
+
+
+def recent_visits(
+    db: Session,
+    url: Url,
+    visit_filters: Optional[list] = None,
+    limit: int = RECENT_VISITS_LIMIT,
+    offset: int = 0,
+) -> List[Dict[str, Any]]:
+    """Get one page of a URL's visits for the table, newest first."""
+    visit_filters = [Visit.url_id == url.id] + list(visit_filters or [])
+    limit = max(1, min(limit, MAX_RECENT_VISITS_LIMIT))
+    visits = (
+        db.query(
+            Visit.created_at,
+            Visit.ip_address,
+            Visit.country_code,
+            Visit.device_type,
+            Visit.browser,
+            Visit.referrer_host,
+            Visit.final_url,
+        )
+        .filter(*visit_filters)
+        .order_by(Visit.created_at.desc(), Visit.id.desc())
+        .offset(max(0, offset))
+        .limit(limit)
+        .all()
+    )
+    return [
+        {
+            "date": visit.created_at.strftime("%Y-%m-%d"),
+            "time": visit.created_at.strftime("%H:%M:%S"),
+            "ip": visit.ip_address or "unknown",
+            "country": visit.country_code or "XX",
+            "device": visit.device_type or "unknown",
+            "browser": visit.browser or "unknown",
+            "referrer": visit.referrer_host or "direct",
+            "target_url": visit.final_url or url.original_url,
+        }
+        for visit in visits
+    ]
+
+
+def visitor_fingerprint(ip_address: Optional[str], user_agent: Optional[str]) -> str:
+    """Hash a visitor's IP address and User-Agent into a sketch member."""
+    raw = f"{ip_address or ''}|{user_agent or ''}".encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()[:16]
+
+
+def _days_between(start: date, end: date) -> List[str]:
+    """List days from start to end (inclusive) as sketch key suffixes."""
+    return [
+        (start + timedelta(days=offset)).strftime("%Y-%m-%d")
+        for offset in range((end - start).days + 1)
+    ]
+
+
+def unique_visitor_series(url_id: int, today: Optional[date] = None) -> Dict:
+    """Get daily, weekly and monthly unique visitors from HyperLogLog sketches."""
+    today = today or datetime.utcnow().date()
+
+    days = [today - timedelta(days=i) for i in reversed(range(UNIQUE_VISITOR_DAYS))]
+    this_week = today - timedelta(days=today.weekday())
+    weeks = [
+        this_week - timedelta(weeks=i) for i in reversed(range(UNIQUE_VISITOR_WEEKS))
+    ]
+    months = []
+    month = today.replace(day=1)
+    for _ in range(UNIQUE_VISITOR_MONTHS):
+        months.insert(0, month)
+        month = (month - timedelta(days=1)).replace(day=1)
+
+    # Every period is a union of daily sketches, capped at today
+    next_months = months[1:] + [today + timedelta(days=1)]
+    groups = (
+        [[day.strftime("%Y-%m-%d")] for day in days]
+        + [_days_between(week, min(week + timedelta(days=6), today)) for week in weeks]
+        + [
+            _days_between(start, min(next_start - timedelta(days=1), today))
+            for start, next_start in zip(months, next_months)
+        ]
+        + [_days_between(days[0], today)]
+    )
+    counts = cache.count_unique_visitors(url_id, groups)
+
+    daily = counts[: len(days)]
+    weekly = counts[len(days) : len(days) + len(weeks)]
+    monthly = counts[len(days) + len(weeks) : -1]
+    return {
+        "daily": {
+            "labels": [day.strftime("%Y-%m-%d") for day in days],
+            "data": daily,
+        },
+        "weekly": {
+            "labels": [
+                "{0}-W{1:02d}".format(*week.isocalendar()[:2]) for week in weeks
+            ],
+            "data": weekly,
+        },
+        "monthly": {
+            "labels": [month.strftime("%Y-%m") for month in months],
+            "data": monthly,
+        },
+        "last_30_days": counts[-1],
+    }
+
+
+def analytics_etag(url: Url, aggregates: Dict[str, Any]) -> str:
+    """Build an ETag that changes whenever the analytics payload changes.
+
+    The date is included because the unique-visitor series shift daily.
+    """
+    clicks = getattr(url, "total_clicks", url.click_count)
+    return (
+        f"analytics-{url.id}-{aggregates['last_visit_id']}-{clicks}-"
+        f"{datetime.utcnow():%Y%m%d}"
+    )
+
+
+def build_analytics_payload(
+    url: Url,
+    aggregates: Dict[str, Any],
+    visits: List[Dict[str, Any]],
+    unique_visitors: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    """Convert aggregates into the analytics API response format."""
+    payload = {
+        "url_info": {
+            "id": url.id,
+            "short_code": url.short_code,
+            "original_url": url.original_url,
+            "click_count": getattr(url, "total_clicks", url.click_count),
+            "created_at": url.created_at.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "clicks_over_time": {
+            "labels": list(aggregates["clicks_over_time"].keys()),
+            "data": list(aggregates["clicks_over_time"].values()),
+        },
+        "devices": aggregates["devices"],
+        "countries": aggregates["countries"],
+        "referrers": aggregates["referrers"],
+        "visits": visits,
+    }
+    if unique_visitors is not None:
+        payload["unique_visitors"] = unique_visitors
+    return payload
@@ -0,0 +1,393 @@
+"""Columnar compressed archive for visits removed by retention cleanup.
+
+Each archive run writes one immutable segment file per calendar month under
+``<archive dir>/<YYYY-MM>/``. A segment stores every column separately as a
+sequence of zlib-compressed blocks of ``BLOCK_ROWS`` values, followed by a JSON
+footer with the block offsets and the dictionaries of the dictionary-encoded
+columns::
+
+    MAGIC | column blocks ... | footer JSON | footer length (8 bytes) | MAGIC
+
+Readers only load the footer and then the blocks of the columns a query needs,
+one block at a time, so aggregates never hold a whole segment in memory.
+
+The footer also records the shard the visits came from and the
+``(created_at, id)`` of its last visit. That is the archive watermark: a
+cleanup run only archives visits after it, so a run whose delete failed after
+the segments were written does not archive the same visits again.
+"""
+
+import calendar
+import json
+import os
+import secrets
+import struct
+import zlib
+from array import array
+from datetime import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from sqlalchemy import and_, or_
+
+# Load environment variables
+load_dotenv()
+
+# Archiving is enabled by pointing VISITS_ARCHIVE_DIR at a writable directory
+VISITS_ARCHIVE_DIR = os.getenv("VISITS_ARCHIVE_DIR", "")
+
+MAGIC = b"VSEG1\n"
+BLOCK_ROWS = 65536
+COMPRESSION_LEVEL = 6
+
+# Column name -> encoding. Integer columns are stored as int64 arrays,
+# dictionary columns as arrays of codes into a per-segment dictionary and
+# string columns as JSON lists.
+COLUMNS: List[Tuple[str, str]] = [
+    ("id", "int"),
+    ("url_id", "int"),
+    ("created_at", "int"),
+    ("country_code", "dict"),
+    ("device_type", "dict"),
+    ("browser", "dict"),
+    ("os_name", "dict"),
+    ("referrer_host", "dict"),
+    ("ip_address", "str"),
+    ("user_agent", "str"),
+    ("referrer", "str"),
+    ("final_url", "str"),
+]
+COLUMN_NAMES = [name for name, _ in COLUMNS]
+
+
+def to_epoch(value: datetime) -> int:
+    """Convert a naive UTC datetime to epoch seconds."""
+    return calendar.timegm(value.timetuple())
+
+
+def month_key(value: datetime) -> str:
+    """Get the archive month directory name for a datetime."""
+    return f"{value.year:04d}-{value.month:02d}"
+
+
+def _code_typecode(size: int) -> str:
+    """Pick the smallest unsigned array type that can hold dictionary codes."""
+    if size <= 0xFF:
+        return "B"
+    if size <= 0xFFFF:
+        return "H"
+    return "I"
+
+
+class SegmentWriter:
+    """Write visits into a single columnar segment file."""
+
+    def __init__(self, path: str, block_rows: int = BLOCK_ROWS, shard: int = 0):
+        self.path = path
+        self.block_rows = block_rows
+        self.shard = shard
+        self.rows = 0
+        self.last: Optional[Tuple[datetime, int]] = None
+        self._tmp_path = f"{path}.tmp"
+        self._file = open(self._tmp_path, "wb")
+        self._file.write(MAGIC)
+        self._buffer: Dict[str, list] = {name: [] for name in COLUMN_NAMES}
+        self._dictionaries: Dict[str, Dict[Any, int]] = {
+            name: {} for name, kind in COLUMNS if kind == "dict"
+        }
+        self._blocks: Dict[str, List[List[int]]] = {name: [] for name in COLUMN_NAMES}
+
+    def append(self, row: Dict[str, Any]):
+        """Append one visit (a mapping of column name to value)."""
+        self.last = (row["created_at"], row["id"])
+        for name, kind in COLUMNS:
+            value = row.get(name)
+            if kind == "int" and isinstance(value, datetime):
+                value = to_epoch(value)
+            elif kind == "dict":
+                dictionary = self._dictionaries[name]
+                value = dictionary.setdefault(value, len(dictionary))
+            self._buffer[name].append(value)
+
+        self.rows += 1
+        if len(self._buffer["id"]) >= self.block_rows:
+            self._flush_block()
+
+    def _flush_block(self):
+        """Compress and write the buffered block of every column."""
+        if not self._buffer["id"]:
+            return
+
+        for name, kind in COLUMNS:
+            values = self._buffer[name]
+            if kind == "int":
+                raw = array("q", [value or 0 for value in values]).tobytes()
+            elif kind == "dict":
+                typecode = _code_typecode(len(self._dictionaries[name]))
+                raw = typecode.encode("ascii") + array(typecode, values).tobytes()
+            else:
+                raw = json.dumps(values).encode("utf-8")
+
+            data = zlib.compress(raw, COMPRESSION_LEVEL)
+            self._blocks[name].append([self._file.tell(), len(data), len(values)])
+            self._file.write(data)
+            self._buffer[name] = []
+
+    def close(self) -> str:
+        """Write the footer and atomically move the segment into place."""
+        self._flush_block()
+
+        footer = {
+            "version": 1,
+            "rows": self.rows,
+            "shard": self.shard,
+            "last": ([self.last[0].isoformat(), self.last[1]] if self.last else None),
+            "columns": {
+                name: {
+                    "encoding": kind,
+                    "blocks": self._blocks[name],
+                    "dictionary": (
+                        list(self._dictionaries[name]) if kind == "dict" else None
+                    ),
+                }
+                for name, kind in COLUMNS
+            },
+        }
+        data = json.dumps(footer).encode("utf-8")
+        self._file.write(data)
+        self._file.write(struct.pack("<Q", len(data)))
+        self._file.write(MAGIC)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+
+        os.replace(self._tmp_path, self.path)
+        return self.path
+
+    def abort(self):
+        """Discard a partially written segment."""
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+class SegmentReader:
+    """Read columns of a segment file block by block."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            f.seek(-(8 + len(MAGIC)), os.SEEK_END)
+            footer_length = struct.unpack("<Q", f.read(8))[0]
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"Not a visit archive segment: {path}")
+            f.seek(-(8 + len(MAGIC) + footer_length), os.SEEK_END)
+            self.footer = json.loads(f.read(footer_length).decode("utf-8"))
+
+    @property
+    def rows(self) -> int:
+        """Number of visits stored in the segment."""
+        return self.footer["rows"]
+
+    @property
+    def last(self) -> Optional[Tuple[datetime, int]]:
+        """``(created_at, id)`` of the last visit (None for old segments)."""
+        last = self.footer.get("last")
+        if not last:
+            return None
+        return datetime.fromisoformat(last[0]), last[1]
+
+    def _decode(self, name: str, raw: bytes) -> list:
+        """Decode a decompressed block of a column."""
+        column = self.footer["columns"][name]
+        if column["encoding"] == "int":
+            values = array("q")
+            values.frombytes(raw)
+            return values.tolist()
+        if column["encoding"] == "dict":
+            codes = array(raw[:1].decode("ascii"))
+            codes.frombytes(raw[1:])
+            return codes.tolist()
+        return json.loads(raw.decode("utf-8"))
+
+    def dictionary(self, name: str) -> Optional[list]:
+        """Get the dictionary of a dictionary-encoded column."""
+        return self.footer["columns"][name]["dictionary"]
+
+    def iter_blocks(self, names: List[str]) -> Iterator[Dict[str, list]]:
+        """Yield blocks of the requested columns (codes for dictionary columns)."""
+        columns = [self.footer["columns"][name] for name in names]
+        with open(self.path, "rb") as f:
+            for index in range(len(columns[0]["blocks"]) if columns else 0):
+                block = {}
+                for name, column in zip(names, columns):
+                    offset, length, _ = column["blocks"][index]
+                    f.seek(offset)
+                    block[name] = self._decode(name, zlib.decompress(f.read(length)))
+                yield block
+
+
+class VisitArchive:
+    """Directory of per-month visit segments."""
+
+    def __init__(self, root: str = VISITS_ARCHIVE_DIR, block_rows: int = BLOCK_ROWS):
+        self.root = root
+        self.block_rows = block_rows
+
+    def months(self) -> List[str]:
+        """List archived months (YYYY-MM), oldest first."""
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(
+            name
+            for name in os.listdir(self.root)
+            if os.path.isdir(os.path.join(self.root, name))
+        )
+
+    def segments(self, months: Optional[Iterable[str]] = None) -> List[str]:
+        """List segment files of the given months (all months by default)."""
+        paths = []
+        for month in months if months is not None else self.months():
+            directory = os.path.join(self.root, month)
+            if not os.path.isdir(directory):
+                continue
+            paths.extend(
+                os.path.join(directory, name)
+                for name in sorted(os.listdir(directory))
+                if name.endswith(".vseg")
+            )
+        return paths
+
+    def watermark(self, shard: int = 0) -> Optional[Tuple[datetime, int]]:
+        """Get ``(created_at, id)`` of the last archived visit of a shard.
+
+        Segments are written in ``(created_at, id)`` order, so only the
+        newest month holding segments of the shard has to be read.
+        """
+        for month in reversed(self.months()):
+            marks = []
+            for path in self.segments([month]):
+                segment = SegmentReader(path)
+                if segment.footer.get("shard") == shard and segment.last:
+                    marks.append(segment.last)
+            if marks:
+                return max(marks)
+        return None
+
+    def write(self, rows: Iterable[Dict[str, Any]], shard: int = 0) -> List[str]:
+        """Archive visits, writing one new segment per month they fall into.
+
+        Rows must be ordered by ``(created_at, id)`` so that each month is a
+        contiguous run and the segments advance the watermark of the shard.
+        """
+        written = []
+        writer = None
+        current_month = None
+
+        try:
+            for row in rows:
+                month = month_key(row["created_at"])
+                if month != current_month:
+                    if writer:
+                        written.append(writer.close())
+                    writer = self._open_writer(month, row, shard)
+                    current_month = month
+                writer.append(row)
+
+            if writer:
+                written.append(writer.close())
+                writer = None
+        finally:
+            if writer:
+                writer.abort()
+
+        return written
+
+    def _open_writer(
+        self, month: str, first_row: Dict[str, Any], shard: int
+    ) -> SegmentWriter:
+        """Create a writer for a new segment of a month."""
+        directory = os.path.join(self.root, month)
+        os.makedirs(directory, exist_ok=True)
+        name = (
+            f"{datetime.utcnow():%Y%m%dT%H%M%S}-{first_row['id']}-"
+            f"{secrets.token_hex(4)}.vseg"
+        )
+        return SegmentWriter(os.path.join(directory, name), self.block_rows, shard)
+
+    def aggregate(
+        self,
+        group_by: str,
+        url_id: Optional[int] = None,
+        months: Optional[Iterable[str]] = None,
+    ) -> Dict[Any, int]:
+        """Count archived visits grouped by a dictionary column or by 'day'."""
+        if group_by != "day" and dict(COLUMNS).get(group_by) != "dict":
+            raise ValueError(f"Cannot group archived visits by '{group_by}'")
+
+        column = "created_at" if group_by == "day" else group_by
+        names = [column] + (["url_id"] if url_id is not None else [])
+        counts: Dict[Any, int] = {}
+
+        for path in self.segments(months):
+            segment = SegmentReader(path)
+            segment_counts: Dict[Any, int] = {}
+            for block in segment.iter_blocks(names):
+                values = block[column]
+                if url_id is not None:
+                    values = [
+                        value
+                        for value, owner in zip(values, block["url_id"])
+                        if owner == url_id
+                    ]
+                if group_by == "day":
+                    # Bucket by day number first, format dates once at the end
+                    values = [value // 86400 for value in values]
+                for value in values:
+                    segment_counts[value] = segment_counts.get(value, 0) + 1
+
+            dictionary = segment.dictionary(column)
+            for value, count in segment_counts.items():
+                if group_by == "day":
+                    key = datetime.utcfromtimestamp(value * 86400).strftime("%Y-%m-%d")
+                else:
+                    key = dictionary[value]
+                counts[key] = counts.get(key, 0) + count
+
+        return counts
+
+    def count(
+        self, url_id: Optional[int] = None, months: Optional[Iterable[str]] = None
+    ) -> int:
+        """Count archived visits, optionally for a single URL."""
+        if url_id is None:
+            return sum(SegmentReader(path).rows for path in self.segments(months))
+        return sum(self.aggregate("device_type", url_id, months).values())
+
+
+def archive_visits_before(
+    db, cutoff: datetime, archive: Optional[VisitArchive] = None, shard: int = 0
+) -> List[str]:
+    """Archive visits created before the cutoff and return new segments.
+
+    Visits up to the shard's watermark are already archived and are skipped,
+    so rerunning after a failed delete does not archive them twice.
+    """
+    from models import Visit
+
+    archive = archive or VisitArchive()
+    query = db.query(*[getattr(Visit, name) for name in COLUMN_NAMES]).filter(
+        Visit.created_at < cutoff
+    )
+    watermark = archive.watermark(shard)
+    if watermark:
+        last_created_at, last_id = watermark
+        query = query.filter(
+            or_(
+                Visit.created_at > last_created_at,
+                and_(Visit.created_at == last_created_at, Visit.id > last_id),
+            )
+        )
+
+    rows = query.order_by(Visit.created_at, Visit.id).yield_per(5000)
+    return archive.write((row._asdict() for row in rows), shard)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Benchmark GROUP BY vs NumPy analytics aggregation.
+
+Usage:
+    python benchmarks/bench_analytics.py [--rows 100000,1000000,10000000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from analytics import aggregate_grouped, aggregate_vectorized  # noqa: E402
+from models import Base, Url, Visit  # noqa: E402
+
+
+def populate(db, url_id: int, rows: int):
+    """Insert synthetic visits for one URL."""
+    rng = random.Random(0)
+    start = datetime(2025, 1, 1)
+    devices = ["mobile", "desktop", "tablet"]
+    countries = ["US", "FR", "DE", "RU", "GB", "BR", "IN", None]
+    hosts = ["google.com", "t.co", "facebook.com", "direct", "news.ycombinator.com"]
+    batch = []
+    for i in range(rows):
+        batch.append(
+            {
+                "url_id": url_id,
+                "created_at": start + timedelta(seconds=rng.randint(0, 90 * 86400)),
+                "device_type": rng.choice(devices),
+                "country_code": rng.choice(countries),
+                "referrer_host": rng.choice(hosts),
+                "ip_address": f"10.0.{i % 256}.{rng.randint(0, 255)}",
+                "browser": "Chrome",
+                "final_url": "https://example.com",
+            }
+        )
+        if len(batch) == 50000:
+            db.execute(Visit.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.execute(Visit.__table__.insert(), batch)
+    db.commit()
+
+
+def timed(func, *args):
+    """Run a function and return (seconds, result)."""
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", default="100000,1000000")
+    args = parser.parse_args()
+
+    for rows in [int(value) for value in args.rows.split(",")]:
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{tmp}/bench.db")
+            Base.metadata.create_all(bind=engine)
+            db = sessionmaker(bind=engine)()
+            url = Url.create_short_url(db, "https://example.com", "http://bench")
+            populate(db, url.id, rows)
+
+            vector_time, vector_result = timed(aggregate_vectorized, db, url)
+            group_time, group_result = timed(aggregate_grouped, db, url)
+            assert vector_result == group_result, "Aggregation results differ"
+
+            print(
+                f"{rows:>10,} visits: group by {group_time:7.2f}s  "
+                f"numpy {vector_time:7.2f}s"
+            )
+            db.close()
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Benchmark per-lookup overhead of the redirect queries: ORM vs Core lookups.
+
+Compares Url.get_by_short_code with lookups.lookup_url (code -> row) and
+the ORM rules query with lookups.fetch_active_rules, on a SQLite database
+(in memory by default, so the numbers are mostly Python overhead).
+
+Usage:
+    python benchmarks/bench_lookups.py [--links 10000] [--lookups 20000]
+                                       [--rules 5] [--database-url URL]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+from sqlalchemy.pool import StaticPool  # noqa: E402
+
+from lookups import fetch_active_rules, lookup_url  # noqa: E402
+from models import Base, Rule, Url  # noqa: E402
+
+
+def populate(engine, links: int, rules: int):
+    """Create the schema, links and rules for the first links."""
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(
+            Url.__table__.insert(),
+            [
+                {
+                    "short_code": f"c{i:06d}",
+                    "original_url": f"https://example.com/{i}",
+                    "click_count": 0,
+                }
+                for i in range(links)
+            ],
+        )
+        connection.execute(
+            Rule.__table__.insert(),
+            [
+                {
+                    "url_id": url_id,
+                    "rule_type": "country",
+                    "condition_value": "US",
+                    "target_url": f"https://example.com/us/{url_id}",
+                    "priority": priority,
+                    "is_active": 1,
+                }
+                for url_id in range(1, 101)
+                for priority in range(rules)
+            ],
+        )
+
+
+def measure(session_factory, lookups: int, function) -> float:
+    """Return microseconds per call of function(db, i)."""
+    db = session_factory()
+    try:
+        started = time.perf_counter()
+        for i in range(lookups):
+            function(db, i)
+            # A redirect uses a fresh session per request
+            db.expunge_all()
+        return (time.perf_counter() - started) / lookups * 1e6
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--links", type=int, default=10000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--rules", type=int, default=5)
+    parser.add_argument("--database-url", default="sqlite:///:memory:")
+    args = parser.parse_args()
+
+    engine = create_engine(
+        args.database_url,
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    populate(engine, args.links, args.rules)
+    session_factory = sessionmaker(bind=engine)
+
+    rng = random.Random(0)
+    codes = [f"c{rng.randrange(args.links):06d}" for _ in range(args.lookups)]
+    url_ids = [rng.randint(1, 100) for _ in range(args.lookups)]
+
+    def orm_url(db, i):
+        url = Url.get_by_short_code(db, codes[i])
+        return url.id, url.original_url
+
+    def core_url(db, i):
+        row = lookup_url(db, codes[i])
+        return row.id, row.original_url
+
+    def orm_rules(db, i):
+        return (
+            db.query(Rule)
+            .filter(Rule.url_id == url_ids[i], Rule.is_active == 1)
+            .order_by(Rule.priority.desc(), Rule.id)
+            .all()
+        )
+
+    def core_rules(db, i):
+        return fetch_active_rules(db, url_ids[i])
+
+    for name, orm, core in [
+        ("code lookup", orm_url, core_url),
+        (f"rules ({args.rules}/link)", orm_rules, core_rules),
+    ]:
+        orm_time = measure(session_factory, args.lookups, orm)
+        core_time = measure(session_factory, args.lookups, core)
+        print(
+            f"{name:>18}: ORM {orm_time:7.1f}us  Core {core_time:7.1f}us  "
+            f"speedup {orm_time / core_time:4.1f}x"
+        )
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
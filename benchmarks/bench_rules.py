@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Benchmark routing rule evaluation: the former linear if/elif chain vs compiled
+rule sets, both scanned in priority order and indexed by dimension. Links with
+at most ``RULES_LINEAR_MAX`` rules use the scan (see ``routing.RuleSet``).
+Each timing is the best of three runs.
+
+With --kind referrer every rule is a referrer rule (a partner link), which
+exercises the shared Aho-Corasick automaton.
+
+With --parse-user-agent the device type is parsed from a User-Agent string
+for every request, as the redirect does: the linear chain always parses it,
+the compiled rule set only when a candidate rule needs the device.
+
+Usage:
+    python benchmarks/bench_rules.py [--rules 1,10,100] [--requests 100000]
+                                     [--kind mixed|referrer] [--parse-user-agent]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+import user_agents
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import routing  # noqa: E402
+from models import Rule  # noqa: E402
+from routing import RequestContext, compile_rule_set  # noqa: E402
+
+COUNTRIES = ["US", "FR", "DE", "RU", "GB", "BR", "IN", "JP", "CN", "ES"]
+DEVICES = ["mobile", "desktop", "tablet"]
+SLOTS = ["09:00-18:00", "18:00-22:00", "22:00-09:00"]
+REFERRERS = [
+    "https://google.com/search",
+    "https://t.co/x",
+    "",
+    "https://vk.com/",
+    "https://site7.example/blog/post",
+    "https://news.site42.example/",
+]
+USER_AGENTS = {
+    "mobile": "Mozilla/5.0 (iPhone; CPU iPhone OS 14_7_1 like Mac OS X)",
+    "tablet": "Mozilla/5.0 (iPad; CPU OS 14_7_1 like Mac OS X) AppleWebKit/605.1.15",
+    "desktop": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+}
+
+
+def parse_device(user_agent: str) -> str:
+    """Device type detection as done by the redirect."""
+    ua = user_agents.parse(user_agent)
+    return "mobile" if ua.is_mobile else ("tablet" if ua.is_tablet else "desktop")
+
+
+def make_rules(count: int, kind: str = "mixed"):
+    """Build rules of mixed types (or only referrer rules), ordered by priority."""
+    rng = random.Random(count)
+    rules = []
+    for i in range(count):
+        if kind == "referrer":
+            rule_type = "referrer"
+        else:
+            rule_type = rng.choice(["country"] * 4 + ["device", "referrer", "time"])
+        value = {
+            "country": lambda: rng.choice(COUNTRIES),
+            "device": lambda: rng.choice(DEVICES),
+            "referrer": lambda: f"site{i}.example",
+            "time": lambda: rng.choice(SLOTS),
+        }[rule_type]()
+        rules.append(
+            Rule(
+                id=i + 1,
+                rule_type=rule_type,
+                condition_value=value,
+                target_url=f"https://example.com/{i}",
+                priority=count - i,
+            )
+        )
+    return rules
+
+
+def time_slot(now: datetime) -> str:
+    """The former fixed time slots."""
+    if 9 <= now.hour < 18:
+        return "09:00-18:00"
+    if 18 <= now.hour < 22:
+        return "18:00-22:00"
+    return "22:00-09:00"
+
+
+def linear_match(rules, visitor, parse):
+    """The former if/elif evaluation, for comparison."""
+    if parse:
+        visitor = dict(visitor, device=parse_device(visitor["user_agent"]))
+    for rule in rules:
+        if rule.rule_type == "country":
+            matches = rule.condition_value.upper() == visitor["country"]
+        elif rule.rule_type == "device":
+            matches = rule.condition_value.lower() == visitor["device"]
+        elif rule.rule_type == "time":
+            matches = rule.condition_value == time_slot(visitor["now"])
+        elif rule.rule_type == "referrer":
+            matches = rule.condition_value.lower() in visitor["referrer"].lower()
+        else:
+            matches = False
+        if matches:
+            return rule.target_url
+    return None
+
+
+def make_visitors(count: int):
+    """Build random visitors."""
+    rng = random.Random(0)
+    visitors = []
+    for _ in range(count):
+        device = rng.choice(DEVICES)
+        visitors.append(
+            {
+                "country": rng.choice(COUNTRIES + ["XX"] * 10),
+                "device": device,
+                "user_agent": USER_AGENTS[device],
+                "now": datetime(
+                    2025, 1, rng.randint(6, 12), rng.randint(0, 23), rng.randint(0, 59)
+                ).astimezone(),
+                "referrer": rng.choice(REFERRERS),
+            }
+        )
+    return visitors
+
+
+def compiled_match(rule_set, visitors, parse):
+    """Evaluate visitors with a compiled rule set, as the redirect does."""
+    results = []
+    for visitor in visitors:
+        referrer = visitor["referrer"]
+        user_agent = visitor["user_agent"]
+        context = RequestContext(
+            {
+                "country": lambda: visitor["country"],
+                "device": (
+                    (lambda: parse_device(user_agent))
+                    if parse
+                    else (lambda: visitor["device"])
+                ),
+                "now": lambda: visitor["now"],
+                "referrer": lambda: referrer.lower(),
+            },
+            random.random,
+        )
+        rule = rule_set.match(context)
+        results.append(rule.target_url if rule else None)
+    return results
+
+
+def best_time(func, *args):
+    """Best of three runs: (seconds, result)."""
+    best = None
+    for _ in range(3):
+        started = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rules", default="1,2,3,4,10,100")
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--kind", choices=["mixed", "referrer"], default="mixed")
+    parser.add_argument("--parse-user-agent", action="store_true")
+    args = parser.parse_args()
+    parse = args.parse_user_agent
+
+    visitors = make_visitors(args.requests)
+    for count in [int(value) for value in args.rules.split(",")]:
+        rules = make_rules(count, args.kind)
+
+        linear_time, expected = best_time(
+            lambda: [linear_match(rules, visitor, parse) for visitor in visitors]
+        )
+        timings = {}
+        for mode, linear_max in (("scan", count), ("indexed", 0)):
+            routing.LINEAR_MAX_RULES = linear_max
+            rule_set = compile_rule_set("https://example.com", rules)
+            timings[mode], results = best_time(
+                compiled_match, rule_set, visitors, parse
+            )
+            assert results == expected, "Rule engine results differ"
+
+        per_request = {
+            mode: seconds / args.requests * 1e6
+            for mode, seconds in [("linear", linear_time)] + list(timings.items())
+        }
+        print(
+            f"{count:>4} rules: linear {per_request['linear']:6.2f}us  "
+            f"scan {per_request['scan']:6.2f}us  "
+            f"indexed {per_request['indexed']:6.2f}us  "
+            f"indexed/linear {linear_time / timings['indexed']:4.1f}x  "
+            f"indexed/scan {timings['scan'] / timings['indexed']:4.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
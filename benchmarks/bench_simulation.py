@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Benchmark bulk rule simulation over realistic client profiles.
+
+Profiles are high-cardinality like real traffic: thousands of distinct
+User-Agent strings (browser and OS versions) drawn with a long-tail
+distribution, random IPv4 and IPv6 addresses, referrer URLs with paths and
+per-second timestamps with various UTC offsets. Parsing the User-Agents the
+worker has not seen yet is timed on its own (it is paid once per User-Agent
+and process), then the batch is evaluated with the User-Agent cache warm.
+
+Usage:
+    python benchmarks/bench_simulation.py [--rules 100] [--profiles 100000]
+                                          [--user-agents 5000] [--weight 0.3]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_rules import make_rules  # noqa: E402
+
+from main import get_device_type, simulate_routing_rules  # noqa: E402
+from models import Rule  # noqa: E402
+from routing import compile_rule_set  # noqa: E402
+
+PLATFORMS = [
+    "Windows NT 10.0; Win64; x64",
+    "Macintosh; Intel Mac OS X 10_15_{minor}",
+    "X11; Linux x86_64",
+    "Linux; Android {major}; SM-G99{minor}B",
+    "Linux; Android {major}; Pixel {minor}",
+    "iPhone; CPU iPhone OS {major}_{minor} like Mac OS X",
+    "iPad; CPU OS {major}_{minor} like Mac OS X",
+]
+BROWSERS = [
+    "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{major}.0.{build}.{patch} "
+    "Safari/537.36",
+    "AppleWebKit/605.1.15 (KHTML, like Gecko) Version/{minor}.{patch} "
+    "Mobile/15E148 Safari/604.1",
+    "Gecko/20100101 Firefox/{major}.0",
+    "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/{major}.0.{build}.{patch} "
+    "Safari/537.36 Edg/{major}.0.{build}.{patch}",
+]
+REFERRER_HOSTS = [
+    "https://www.google.com/search?q={n}",
+    "https://t.co/{n}",
+    "https://vk.com/wall-{n}",
+    "https://news.site{n}.example/article/{n}",
+    "https://site{n}.example/blog/post-{n}",
+    "",
+]
+OFFSETS = ["Z", "+00:00", "+03:00", "-05:00", "+05:30", ""]
+
+
+def make_user_agents(count: int, rng: random.Random):
+    """Build distinct User-Agent strings from platform and browser versions."""
+    user_agents = set()
+    while len(user_agents) < count:
+        numbers = {
+            "major": rng.randint(8, 130),
+            "minor": rng.randint(0, 9),
+            "build": rng.randint(1000, 6999),
+            "patch": rng.randint(0, 200),
+        }
+        platform = rng.choice(PLATFORMS).format(**numbers)
+        browser = rng.choice(BROWSERS).format(**numbers)
+        user_agents.add(f"Mozilla/5.0 ({platform}) {browser}")
+    return sorted(user_agents)
+
+
+def random_ip(rng: random.Random) -> str:
+    """A random public-looking IPv4 (or, for one in ten, IPv6) address."""
+    if rng.random() < 0.1:
+        return ":".join(f"{rng.randint(0, 0xFFFF):x}" for _ in range(8))
+    return ".".join(str(rng.randint(1, 254)) for _ in range(4))
+
+
+def make_profiles(count: int, user_agent_count: int):
+    """Build client profiles with long-tail User-Agents and distinct values."""
+    rng = random.Random(1)
+    user_agents = make_user_agents(user_agent_count, rng)
+    # Zipf-like popularity: a few browsers are common, most are rare
+    weights = [1 / (rank + 1) for rank in range(len(user_agents))]
+    start = datetime(2025, 1, 6, tzinfo=timezone.utc)
+    profiles = []
+    for user_agent in rng.choices(user_agents, weights, k=count):
+        stamp = start + timedelta(seconds=rng.randint(0, 30 * 86400))
+        profiles.append(
+            {
+                "ip": random_ip(rng),
+                "user_agent": user_agent,
+                "referrer": rng.choice(REFERRER_HOSTS).format(n=rng.randint(1, 500)),
+                "timestamp": stamp.strftime("%Y-%m-%dT%H:%M:%S") + rng.choice(OFFSETS),
+            }
+        )
+    return profiles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rules", type=int, default=100)
+    parser.add_argument("--profiles", type=int, default=100000)
+    parser.add_argument("--user-agents", type=int, default=5000)
+    parser.add_argument("--weight", type=float, default=0.0)
+    args = parser.parse_args()
+
+    rules = make_rules(args.rules)
+    if args.weight:
+        rules.append(
+            Rule(
+                id=len(rules) + 1,
+                rule_type="weight",
+                condition_value=str(args.weight),
+                target_url="https://example.com/variant",
+                priority=0,
+            )
+        )
+    rule_set = compile_rule_set("https://example.com", rules)
+    profiles = make_profiles(args.profiles, args.user_agents)
+    distinct = len({profile["user_agent"] for profile in profiles})
+
+    get_device_type.cache_clear()
+    started = time.perf_counter()
+    for user_agent in {profile["user_agent"] for profile in profiles}:
+        get_device_type(user_agent)
+    elapsed = time.perf_counter() - started
+    print(f"parse {distinct} new User-Agents: {elapsed * 1000:.0f}ms")
+
+    for run in range(3):
+        started = time.perf_counter()
+        counts = simulate_routing_rules(rule_set, 1, profiles)
+        elapsed = time.perf_counter() - started
+        print(
+            f"{args.profiles} profiles ({distinct} User-Agents), {len(rules)} rules: "
+            f"{elapsed * 1000:.0f}ms ({len(counts)} targets)"
+        )
+
+
+if __name__ == "__main__":
+    main()
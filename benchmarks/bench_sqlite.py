@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Benchmark redirect throughput on SQLite: shared connection vs WAL mode.
+
+Each thread performs redirect lookups (short code -> URL); a share of them
+also log a visit, as the visit worker would, so readers compete with writes.
+The single StaticPool connection is not safe to use from several threads at
+once (it fails or crashes), so in that mode every redirect holds a lock: the
+serialization that mode implies.
+
+Usage:
+    python benchmarks/bench_sqlite.py [--threads 1,4,8] [--redirects 2000]
+                                      [--write-ratio 0.1]
+"""
+import argparse
+import contextlib
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from database import create_database_engine  # noqa: E402
+from models import Base, Url, Visit  # noqa: E402
+
+LINKS = 1000
+
+
+def populate(engine):
+    """Create the schema and some links."""
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(
+            Url.__table__.insert(),
+            [
+                {
+                    "short_code": f"c{i:05d}",
+                    "original_url": f"https://example.com/{i}",
+                    "click_count": 0,
+                }
+                for i in range(LINKS)
+            ],
+        )
+
+
+def worker(session_factory, redirects, write_ratio, seed, lock):
+    """Resolve short codes, logging a visit for a share of them."""
+    rng = random.Random(seed)
+    for _ in range(redirects):
+        with lock:
+            db = session_factory()
+            try:
+                url = Url.get_by_short_code(db, f"c{rng.randrange(LINKS):05d}")
+                if rng.random() < write_ratio:
+                    db.add(Visit(url_id=url.id, final_url=url.original_url))
+                    db.commit()
+            finally:
+                db.close()
+
+
+def run(sqlite_wal, threads, redirects, write_ratio, directory=None):
+    """Return redirects per second for one configuration."""
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        engine = create_database_engine(f"sqlite:///{tmp}/bench.db", sqlite_wal)
+        populate(engine)
+        session_factory = sessionmaker(bind=engine)
+        lock = contextlib.nullcontext() if sqlite_wal else threading.Lock()
+
+        pool = [
+            threading.Thread(
+                target=worker,
+                args=(session_factory, redirects, write_ratio, i, lock),
+            )
+            for i in range(threads)
+        ]
+        started = time.perf_counter()
+        for thread in pool:
+            thread.start()
+        for thread in pool:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        engine.dispose()
+    return threads * redirects / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", default="1,4,8")
+    parser.add_argument("--redirects", type=int, default=2000)
+    parser.add_argument("--write-ratio", type=float, default=0.1)
+    parser.add_argument("--dir", help="directory of the database (default: temp)")
+    args = parser.parse_args()
+
+    for threads in [int(value) for value in args.threads.split(",")]:
+        shared = run(False, threads, args.redirects, args.write_ratio, args.dir)
+        wal = run(True, threads, args.redirects, args.write_ratio, args.dir)
+        print(
+            f"{threads:>3} threads: shared connection {shared:8.0f}/s  "
+            f"WAL pool {wal:8.0f}/s  speedup {wal / shared:4.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
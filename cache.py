@@ -2,12 +2,16 @@
 Redis cache management for URL Shortener
 """
 
+import hashlib
 import json
 import os
-from typing import Any, Dict, Optional
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Tuple
 
 import redis
 from dotenv import load_dotenv
+from redis.exceptions import NoScriptError
 
 # Load environment variables
 load_dotenv()
@@ -15,6 +19,57 @@ load_dotenv()
 # Redis configuration
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 CACHE_TTL = int(os.getenv("CACHE_TTL", "3600"))  # 1 hour default
+# Daily unique-visitor sketches are kept a little longer than a year
+UNIQUE_VISITORS_TTL = int(os.getenv("UNIQUE_VISITORS_TTL", str(400 * 24 * 3600)))
+
+# Redirects publish every click to CLICK_CHANNEL_PREFIX + short code
+CLICK_CHANNEL_PREFIX = "clicks:"
+
+# Per-minute click counts: one hash per link and hour, with a field per minute
+CLICK_SERIES_TTL = 25 * 3600
+
+# Per-rule redirect counts: one hash per link with a field per matched rule id
+# (or "default"), plus the set of links with counts waiting to be flushed
+RULE_HITS_PREFIX = "rule_hits:"
+RULE_HITS_PENDING_KEY = "rule_hits:pending"
+DEFAULT_RULE_KEY = "default"
+
+# Counter bumped on every rule change of a link, checked by per-process rule
+# caches before reusing compiled rules
+RULES_VERSION_PREFIX = "rules_version:"
+
+# Trending links: a click is worth 1 now and half as much after TRENDING_HALF_LIFE
+TRENDING_KEY = "trending:links"
+TRENDING_LANDMARK_KEY = "trending:landmark"
+TRENDING_HALF_LIFE = float(os.getenv("TRENDING_HALF_LIFE", "10800"))  # 3 hours
+# Scores are rescaled once they grow past 2**TRENDING_MAX_EXPONENT, and links
+# whose decayed score falls below TRENDING_MIN_SCORE are dropped at that time
+TRENDING_MAX_EXPONENT = 64
+TRENDING_MIN_SCORE = 0.01
+
+# Forward decay: instead of decaying every score over time, each click adds
+# 2 ** ((now - landmark) / half_life), so newer clicks weigh exponentially
+# more and the ranking never needs a full pass. The landmark only moves (with
+# one ZUNIONSTORE rescale) when scores would get too large for a double.
+TRENDING_SCRIPT = """
+local now = tonumber(ARGV[2])
+local half_life = tonumber(ARGV[3])
+local landmark = tonumber(redis.call('GET', KEYS[2]))
+if not landmark then
+    landmark = now
+    redis.call('SET', KEYS[2], ARGV[2])
+end
+local exponent = (now - landmark) / half_life
+if exponent > tonumber(ARGV[4]) then
+    redis.call('ZUNIONSTORE', KEYS[1], 1, KEYS[1], 'WEIGHTS', 2 ^ -exponent)
+    redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', '(' .. ARGV[5])
+    redis.call('SET', KEYS[2], ARGV[2])
+    exponent = 0
+end
+return redis.call('ZINCRBY', KEYS[1], 2 ^ exponent, ARGV[1])
+"""
+# Redis identifies a loaded script by the SHA1 of its body
+TRENDING_SCRIPT_SHA = hashlib.sha1(TRENDING_SCRIPT.encode("utf-8")).hexdigest()
 
 
 class Cache:
@@ -27,6 +82,51 @@ class Cache:
             print(f"Redis connection failed: {e}")
             self.redis_client = None
 
+    def load_scripts(self):
+        """Load the Lua scripts into Redis (once per process, at startup)
+
+        Clicks then run them with EVALSHA; if Redis lost its script cache,
+        record_click loads the script again.
+        """
+        if not self.redis_client:
+            return
+
+        try:
+            self.redis_client.script_load(TRENDING_SCRIPT)
+        except Exception as e:
+            print(f"Script load error: {e}")
+
+    def get_redirect_data(
+        self, short_code: str
+    ) -> Tuple[Optional[Dict[str, Any]], Optional[int]]:
+        """Get cached URL data and the rules version of a link in one round trip.
+
+        The version is 0 for links whose rules never changed and None when
+        Redis is not available.
+        """
+        if not self.redis_client:
+            return None, None
+
+        try:
+            data, version = self.redis_client.mget(
+                f"url:{short_code}", f"{RULES_VERSION_PREFIX}{short_code}"
+            )
+            url_data = json.loads(data.decode("utf-8")) if data else None
+            return url_data, int(version or 0)
+        except Exception as e:
+            print(f"Cache get error: {e}")
+            return None, None
+
+    def bump_rules_version(self, short_code: str):
+        """Make every process recompile the routing rules of a link"""
+        if not self.redis_client:
+            return
+
+        try:
+            self.redis_client.incr(f"{RULES_VERSION_PREFIX}{short_code}")
+        except Exception as e:
+            print(f"Rules version error: {e}")
+
     def get_url_data(self, short_code: str) -> Optional[Dict[str, Any]]:
         """Get URL data from cache"""
         if not self.redis_client:
@@ -64,6 +164,99 @@ class Cache:
         except Exception as e:
             print(f"Cache delete error: {e}")
 
+    def get_analytics_data(self, url_id: int) -> Optional[Dict[str, Any]]:
+        """Get cached analytics aggregates for a URL"""
+        if not self.redis_client:
+            return None
+
+        try:
+            data = self.redis_client.get(f"analytics:{url_id}")
+            if data:
+                return json.loads(data.decode("utf-8"))  # type: ignore
+            return None
+        except Exception as e:
+            print(f"Analytics cache get error: {e}")
+            return None
+
+    def set_analytics_data(
+        self,
+        url_id: int,
+        data: Dict[str, Any],
+        ttl: int = CACHE_TTL,
+        keep_ttl: bool = False,
+    ):
+        """Cache analytics aggregates for a URL.
+
+        With keep_ttl only an existing entry is updated and its expiry is kept.
+        """
+        if not self.redis_client:
+            return
+
+        try:
+            if keep_ttl:
+                self.redis_client.set(
+                    f"analytics:{url_id}", json.dumps(data), keepttl=True, xx=True
+                )
+                return
+            self.redis_client.setex(f"analytics:{url_id}", ttl, json.dumps(data))
+        except Exception as e:
+            print(f"Analytics cache set error: {e}")
+
+    def invalidate_analytics_data(self, url_id: Optional[int] = None):
+        """Remove cached analytics for a URL (or for all URLs)"""
+        if not self.redis_client:
+            return
+
+        try:
+            if url_id is not None:
+                self.redis_client.delete(f"analytics:{url_id}")
+                return
+
+            keys = []
+            for key in self.redis_client.scan_iter(match="analytics:*", count=500):
+                keys.append(key)
+                if len(keys) >= 500:
+                    self.redis_client.delete(*keys)
+                    keys = []
+            if keys:
+                self.redis_client.delete(*keys)
+        except Exception as e:
+            print(f"Analytics cache delete error: {e}")
+
+    def add_unique_visitor(
+        self, url_id: int, day: str, visitor: str, ttl: int = UNIQUE_VISITORS_TTL
+    ):
+        """Add a visitor to the HyperLogLog sketch of a URL for a day"""
+        if not self.redis_client:
+            return
+
+        try:
+            key = f"hll:{url_id}:{day}"
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.pfadd(key, visitor)
+            pipe.expire(key, ttl)
+            pipe.execute()
+        except Exception as e:
+            print(f"Unique visitor add error: {e}")
+
+    def count_unique_visitors(self, url_id: int, day_groups: List[List[str]]):
+        """Count unique visitors for groups of days in a single round trip.
+
+        Each group is estimated by merging its daily sketches (PFCOUNT over
+        several keys), so weekly and monthly uniques need no rescans.
+        """
+        if not self.redis_client:
+            return [0] * len(day_groups)
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for days in day_groups:
+                pipe.pfcount(*[f"hll:{url_id}:{day}" for day in days])
+            return [int(count) for count in pipe.execute()]
+        except Exception as e:
+            print(f"Unique visitor count error: {e}")
+            return [0] * len(day_groups)
+
     def get_cache_stats(self) -> Dict[str, Any]:
         """Get cache statistics"""
         if not self.redis_client:
@@ -103,6 +296,242 @@ class Cache:
             print(f"Counter get error: {e}")
             return 0
 
+    def record_click(
+        self,
+        short_code: str,
+        now: Optional[float] = None,
+        url_id: Optional[int] = None,
+        rule_key: Optional[str] = None,
+    ) -> int:
+        """Count a click, update its trending score and publish it in one round trip
+
+        With a url_id the click is also counted for the matched rule (rule_key,
+        DEFAULT_RULE_KEY when no rule matched).
+        """
+        if not self.redis_client:
+            return 0
+
+        try:
+            now = time.time() if now is None else now
+            pipe = self.redis_client.pipeline(transaction=False)
+            trending = (
+                2,
+                TRENDING_KEY,
+                TRENDING_LANDMARK_KEY,
+                short_code,
+                now,
+                TRENDING_HALF_LIFE,
+                TRENDING_MAX_EXPONENT,
+                TRENDING_MIN_SCORE,
+            )
+            pipe.incr(f"url_clicks:{short_code}")
+            pipe.evalsha(TRENDING_SCRIPT_SHA, *trending)
+            minute = int(now // 60)
+            series_key = f"clicks_ts:{short_code}:{minute // 60}"
+            pipe.hincrby(series_key, str(minute % 60), 1)
+            pipe.expire(series_key, CLICK_SERIES_TTL)
+            pipe.publish(f"{CLICK_CHANNEL_PREFIX}{short_code}", now)
+            if url_id is not None:
+                pipe.hincrby(
+                    f"{RULE_HITS_PREFIX}{url_id}", rule_key or DEFAULT_RULE_KEY, 1
+                )
+                pipe.sadd(RULE_HITS_PENDING_KEY, url_id)
+            results = pipe.execute(raise_on_error=False)
+
+            # The other commands already ran, so only the score is retried
+            if isinstance(results[1], NoScriptError):
+                self.redis_client.script_load(TRENDING_SCRIPT)
+                results[1] = self.redis_client.evalsha(TRENDING_SCRIPT_SHA, *trending)
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+            return int(results[0])
+        except Exception as e:
+            print(f"Click record error: {e}")
+            return 0
+
+    def get_trending(
+        self, limit: int = 10, now: Optional[float] = None
+    ) -> List[Tuple[str, float]]:
+        """Get the top links by decayed click score, highest first"""
+        if not self.redis_client:
+            return []
+
+        try:
+            now = time.time() if now is None else now
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.get(TRENDING_LANDMARK_KEY)
+            pipe.zrevrange(TRENDING_KEY, 0, limit - 1, withscores=True)
+            landmark, top = pipe.execute()
+            if landmark is None:
+                return []
+
+            # Express scores as clicks decayed to the current time
+            scale = 2 ** (-(now - float(landmark)) / TRENDING_HALF_LIFE)
+            return [(member.decode("utf-8"), score * scale) for member, score in top]
+        except Exception as e:
+            print(f"Trending get error: {e}")
+            return []
+
+    def get_click_series(
+        self, short_code: str, minutes: int, now: Optional[float] = None
+    ) -> List[int]:
+        """Get per-minute clicks of the last minutes, oldest first, in one round trip"""
+        now = time.time() if now is None else now
+        last = int(now // 60)
+        first = last - minutes + 1
+        if not self.redis_client:
+            return [0] * minutes
+
+        try:
+            hours = range(first // 60, last // 60 + 1)
+            pipe = self.redis_client.pipeline(transaction=False)
+            for hour in hours:
+                pipe.hgetall(f"clicks_ts:{short_code}:{hour}")
+
+            counts = {}
+            for hour, buckets in zip(hours, pipe.execute()):
+                for field, value in buckets.items():
+                    counts[hour * 60 + int(field)] = int(value)
+            return [counts.get(minute, 0) for minute in range(first, last + 1)]
+        except Exception as e:
+            print(f"Click series get error: {e}")
+            return [0] * minutes
+
+    def remove_trending(self, short_code: str):
+        """Remove a link from the trending set"""
+        if not self.redis_client:
+            return
+
+        try:
+            self.redis_client.zrem(TRENDING_KEY, short_code)
+        except Exception as e:
+            print(f"Trending remove error: {e}")
+
+    def get_rule_hits(self, url_id: int) -> Dict[str, int]:
+        """Get the not yet flushed redirect counts per rule of a link"""
+        if not self.redis_client:
+            return {}
+
+        try:
+            hits = self.redis_client.hgetall(f"{RULE_HITS_PREFIX}{url_id}")
+            return {key.decode("utf-8"): int(value) for key, value in hits.items()}
+        except Exception as e:
+            print(f"Rule hits get error: {e}")
+            return {}
+
+    def drain_rule_hits(self, limit: int = 1000) -> Dict[int, Dict[str, int]]:
+        """Take the pending redirect counts of up to limit links out of Redis
+
+        Each link's hash is read and deleted atomically, so redirects counted
+        meanwhile land in a new hash for the next flush.
+        """
+        if not self.redis_client:
+            return {}
+
+        try:
+            url_ids = [
+                int(url_id)
+                for url_id in self.redis_client.spop(RULE_HITS_PENDING_KEY, limit) or []
+            ]
+            if not url_ids:
+                return {}
+
+            pipe = self.redis_client.pipeline(transaction=True)
+            for url_id in url_ids:
+                pipe.hgetall(f"{RULE_HITS_PREFIX}{url_id}")
+                pipe.delete(f"{RULE_HITS_PREFIX}{url_id}")
+            results = pipe.execute()
+
+            drained = {}
+            for url_id, hits in zip(url_ids, results[::2]):
+                if hits:
+                    drained[url_id] = {
+                        key.decode("utf-8"): int(value) for key, value in hits.items()
+                    }
+            return drained
+        except Exception as e:
+            print(f"Rule hits drain error: {e}")
+            return {}
+
+    def restore_rule_hits(self, drained: Dict[int, Dict[str, int]]):
+        """Put drained counts back after a failed flush"""
+        if not self.redis_client or not drained:
+            return
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for url_id, hits in drained.items():
+                for rule_key, count in hits.items():
+                    pipe.hincrby(f"{RULE_HITS_PREFIX}{url_id}", rule_key, count)
+                pipe.sadd(RULE_HITS_PENDING_KEY, url_id)
+            pipe.execute()
+        except Exception as e:
+            print(f"Rule hits restore error: {e}")
+
+    def delete_rule_hits(self, url_id: int):
+        """Drop the pending redirect counts of a deleted link"""
+        if not self.redis_client:
+            return
+
+        try:
+            pipe = self.redis_client.pipeline(transaction=False)
+            pipe.delete(f"{RULE_HITS_PREFIX}{url_id}")
+            pipe.srem(RULE_HITS_PENDING_KEY, url_id)
+            pipe.execute()
+        except Exception as e:
+            print(f"Rule hits delete error: {e}")
+
+    def delete_url_keys(
+        self,
+        url_id: int,
+        short_code: str,
+        created_at: Optional[datetime] = None,
+        now: Optional[float] = None,
+    ):
+        """Remove every key of a purged link: cache, counters, series, sketches.
+
+        Key names are built rather than scanned: daily sketches exist for the
+        days since the link was created, within UNIQUE_VISITORS_TTL, and
+        per-minute series for the hours within CLICK_SERIES_TTL.
+        """
+        if not self.redis_client:
+            return
+
+        try:
+            now = time.time() if now is None else now
+            keys = [
+                f"url:{short_code}",
+                f"url_clicks:{short_code}",
+                f"analytics:{url_id}",
+                f"{RULE_HITS_PREFIX}{url_id}",
+                f"{RULES_VERSION_PREFIX}{short_code}",
+            ]
+
+            # A day of slack on each side covers clock skew between workers
+            today = datetime.utcfromtimestamp(now).date()
+            day = datetime.utcfromtimestamp(now - UNIQUE_VISITORS_TTL).date()
+            if created_at is not None:
+                day = max(day, created_at.date())
+            for offset in range((today - day).days + 3):
+                key_day = day + timedelta(days=offset - 1)
+                keys.append(f"hll:{url_id}:{key_day:%Y-%m-%d}")
+
+            # A series hash expires CLICK_SERIES_TTL after the last click of its hour
+            last_hour = int(now // 3600)
+            first_hour = int((now - CLICK_SERIES_TTL) // 3600) - 1
+            for hour in range(first_hour, last_hour + 2):
+                keys.append(f"clicks_ts:{short_code}:{hour}")
+
+            pipe = self.redis_client.pipeline(transaction=False)
+            for start in range(0, len(keys), 500):
+                pipe.delete(*keys[start : start + 500])
+            pipe.zrem(TRENDING_KEY, short_code)
+            pipe.srem(RULE_HITS_PENDING_KEY, url_id)
+            pipe.execute()
+        except Exception as e:
+            print(f"Link keys delete error: {e}")
+
 
 # Global cache instance
 cache = Cache()
@@ -12,6 +12,12 @@ load_dotenv()
 
 # Redis URL for Celery broker and backend
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Seconds between flushes of per-rule redirect counts from Redis to the database
+RULE_HITS_FLUSH_INTERVAL = int(os.getenv("RULE_HITS_FLUSH_INTERVAL", "60"))
+# Seconds between folds of click counter slots into urls.click_count
+CLICK_COUNTERS_COMPACT_INTERVAL = int(
+    os.getenv("CLICK_COUNTERS_COMPACT_INTERVAL", "60")
+)
 
 # Create Celery app
 celery_app = Celery(
@@ -32,6 +38,24 @@ celery_app.conf.update(
     task_default_queue="default",
     task_default_exchange="url_shortener",
     task_default_routing_key="url_shortener",
+    beat_schedule={
+        "maintain-visit-partitions": {
+            "task": "tasks.maintain_visit_partitions",
+            "schedule": 24 * 60 * 60,  # Daily
+        },
+        "flush-rule-hits": {
+            "task": "tasks.flush_rule_hits",
+            "schedule": RULE_HITS_FLUSH_INTERVAL,
+        },
+        "compact-click-counters": {
+            "task": "tasks.compact_click_counters",
+            "schedule": CLICK_COUNTERS_COMPACT_INTERVAL,
+        },
+        "purge-deleted-urls": {
+            "task": "tasks.purge_deleted_urls",
+            "schedule": 60 * 60,  # Hourly
+        },
+    },
 )
 
 if __name__ == "__main__":
@@ -4,12 +4,12 @@ Script to create database tables for URL Shortener
 """
 import os
 
-from database import init_db
+from migrations import migrate
 
 if __name__ == "__main__":
     print("Creating database tables...")
     try:
-        init_db()
+        migrate()
         print("✅ Tables created successfully!")
     except Exception as e:
         print(f"❌ Error creating tables: {e}")
@@ -1,18 +1,59 @@
 """Database connection and session management for URL Shortener."""
 
 import os
-from typing import Generator
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Generator, Iterable, List, Optional
+from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
 
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc, text
 from sqlalchemy.orm import Session, sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.pool import NullPool, QueuePool, StaticPool
 
 # Load environment variables
 load_dotenv()
 
+
+def clean_database_url(url: str) -> str:
+    """Normalize a PostgreSQL URL for SQLAlchemy and psycopg2."""
+    if not url.startswith(("postgres://", "postgresql")):
+        return url
+
+    # Ensure PostgreSQL URL uses the correct scheme for SQLAlchemy 2.0
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+
+    # Clean up Supabase-specific parameters that psycopg2 doesn't understand
+    parsed = urlparse(url)
+    query_params = parse_qs(parsed.query)
+
+    # Remove Supabase-specific parameters
+    supabase_params = ["supa", "pgbouncer"]
+    cleaned_params = {k: v for k, v in query_params.items() if k not in supabase_params}
+
+    # Reconstruct URL without invalid parameters
+    if cleaned_params:
+        parsed = parsed._replace(query=urlencode(cleaned_params, doseq=True))
+    else:
+        parsed = parsed._replace(query="")
+
+    return urlunparse(parsed)
+
+
+def requests_pgbouncer(url: Optional[str]) -> bool:
+    """Whether a URL asks for PgBouncer mode (``?pgbouncer=true``)."""
+    if not url:
+        return False
+    values = parse_qs(urlparse(url).query).get("pgbouncer", [])
+    return any(value.lower() == "true" for value in values)
+
+
 # Database URL - use Vercel Postgres for production, SQLite for local development
 DATABASE_URL = os.getenv("DATABASE_URL") or os.getenv("POSTGRES_URL")
+# Checked before the URL is cleaned, which drops the pgbouncer parameter
+DATABASE_PGBOUNCER = requests_pgbouncer(DATABASE_URL)
 
 # Always use SQLite for local development (unless explicitly set to Postgres)
 # Check for Vercel environment or explicit ENVIRONMENT setting
@@ -32,67 +73,349 @@ elif not is_production and not DATABASE_URL.startswith("postgresql"):
     # In non-production, override with local SQLite unless PostgreSQL is explicitly requested
     DATABASE_URL = "sqlite:///./local.db"
 else:
-    # Ensure PostgreSQL URL uses the correct scheme for SQLAlchemy 2.0
-    if DATABASE_URL.startswith("postgres://"):
-        DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+    DATABASE_URL = clean_database_url(DATABASE_URL)
 
-    # Clean up Supabase-specific parameters that psycopg2 doesn't understand
-    from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
+# PgBouncer transaction pooling: PGBOUNCER_MODE=true or ?pgbouncer=true in the URL
+PGBOUNCER_MODE = os.getenv("PGBOUNCER_MODE", "false").lower() == "true"
+DATABASE_PGBOUNCER = PGBOUNCER_MODE or DATABASE_PGBOUNCER
+# Client connections kept per process in PgBouncer mode (0: NullPool)
+PGBOUNCER_POOL_SIZE = int(os.getenv("PGBOUNCER_POOL_SIZE", "0"))
+# Pooled connections idle for longer than this are pinged on checkout
+PGBOUNCER_PING_INTERVAL = float(os.getenv("PGBOUNCER_PING_INTERVAL", "30"))
 
-    parsed = urlparse(DATABASE_URL)
-    query_params = parse_qs(parsed.query)
+# SQLite mode for small deployments: WAL journal, per-thread connection pool
+# and a process-wide write lock instead of one shared connection
+SQLITE_WAL_MODE = os.getenv("SQLITE_WAL_MODE", "false").lower() == "true"
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5"))  # seconds
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", "65536"))
 
-    # Remove Supabase-specific parameters
-    supabase_params = ["supa", "pgbouncer"]
-    cleaned_params = {k: v for k, v in query_params.items() if k not in supabase_params}
+# Optional read replica for read-only requests
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+DATABASE_REPLICA_PGBOUNCER = PGBOUNCER_MODE or requests_pgbouncer(DATABASE_REPLICA_URL)
+if DATABASE_REPLICA_URL:
+    DATABASE_REPLICA_URL = clean_database_url(DATABASE_REPLICA_URL)
+# Reads go to the primary while the replica lags more than this many seconds
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "30"))
+# Seconds between replica lag checks, and the pause after a failed connection
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "10"))
 
-    # Reconstruct URL without invalid parameters
-    if cleaned_params:
-        parsed = parsed._replace(query=urlencode(cleaned_params, doseq=True))
-    else:
-        parsed = parsed._replace(query="")
+# Horizontal sharding of links. Shard 0 is DATABASE_URL, which also keeps
+# users; DATABASE_SHARD_URLS (comma-separated) adds shards 1..N-1. Links carry
+# their shard: codes created on shard s > 0 start with "s~" and link and rule
+# ids there start at s * SHARD_ID_SPAN. Codes without the prefix and ids below
+# the span (every link created before sharding) stay on shard 0, so turning
+# sharding on, or adding shards later, moves no rows.
+DATABASE_SHARD_URLS = [
+    url.strip()
+    for url in os.getenv("DATABASE_SHARD_URLS", "").split(",")
+    if url.strip()
+]
+SHARD_CODE_SEPARATOR = "~"
+# Ids per shard; shard ids must fit the INTEGER id columns (2**31 - 1)
+SHARD_ID_SPAN = int(os.getenv("SHARD_ID_SPAN", "100000000"))
+# Tables whose ids route requests to a shard
+SHARD_ID_TABLES = ("urls", "rules")
+# Threads running a query on every shard at once (per-user listings)
+SHARD_FANOUT_WORKERS = int(os.getenv("SHARD_FANOUT_WORKERS", "8"))
 
-    DATABASE_URL = urlunparse(parsed)
 
-
-# Create engine lazily
+# Create engines lazily
 _engine = None
+_shard_engines: Dict[int, object] = {}
+_shard_lock = threading.Lock()
+_fanout_executor = None
+_replica_engine = None
+_replica_lock = threading.Lock()
+# Monotonic time until which reads skip the replica, and when lag was checked
+_replica_skip_until = 0.0
+_replica_checked_at = 0.0
+
+
+class SQLiteWriteLock:
+    """Let one pooled SQLite connection of the process write at a time.
+
+    SQLite has a single writer; without this, concurrent transactions that
+    upgrade from reading to writing fail with "database is locked". The lock
+    is taken before the first write statement of a transaction and released
+    on commit, rollback or when the connection goes back to the pool. Readers
+    never take it, so with WAL they do not wait for writers at all.
+    """
+
+    WRITE_KEYWORDS = (
+        "INSERT",
+        "UPDATE",
+        "DELETE",
+        "REPLACE",
+        "CREATE",
+        "DROP",
+        "ALTER",
+    )
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self._before_execute)
+        event.listen(engine, "commit", self._release_connection)
+        event.listen(engine, "rollback", self._release_connection)
+        event.listen(engine.pool, "checkin", self._release_record)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, many):
+        info = conn.info
+        if info.get("sqlite_write_lock") or not statement.lstrip().upper().startswith(
+            self.WRITE_KEYWORDS
+        ):
+            return
+        # On timeout carry on and let SQLite's busy_timeout arbitrate
+        info["sqlite_write_lock"] = self._lock.acquire(timeout=self.timeout)
+        if not info["sqlite_write_lock"]:
+            print("SQLite write lock timeout")
+
+    def _release(self, info):
+        if info.pop("sqlite_write_lock", False):
+            self._lock.release()
+
+    def _release_connection(self, conn):
+        self._release(conn.info)
+
+    def _release_record(self, dbapi_connection, connection_record):
+        if connection_record is not None:
+            self._release(connection_record.info)
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply WAL journaling and tuned pragmas to a new SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={int(SQLITE_BUSY_TIMEOUT * 1000)}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cursor.close()
+
+
+class IdlePing:
+    """Ping pooled connections on checkout only after they sat idle.
+
+    Replaces pool_pre_ping, which costs a round trip on every checkout.
+    A failed ping makes the pool discard the connection and open a new one.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+
+    def attach(self, engine):
+        event.listen(engine.pool, "checkin", self._checkin)
+        event.listen(engine.pool, "checkout", self._checkout)
+
+    def _checkin(self, dbapi_connection, connection_record):
+        if connection_record is not None:
+            connection_record.info["checked_in_at"] = time.monotonic()
+
+    def _checkout(self, dbapi_connection, connection_record, connection_proxy):
+        checked_in_at = connection_record.info.get("checked_in_at")
+        if checked_in_at is None or time.monotonic() - checked_in_at < self.interval:
+            return
+        try:
+            cursor = dbapi_connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except Exception:
+            raise exc.DisconnectionError()
+        # The ping ran in a transaction of its own; end it before handing out
+        dbapi_connection.rollback()
+
+
+def create_pgbouncer_engine(url: str):
+    """Create an engine for PgBouncer in transaction pooling mode.
+
+    PgBouncer keeps the server connections, so the process holds few or no
+    client connections of its own (NullPool by default) and pool_pre_ping is
+    replaced by IdlePing. Nothing may rely on session state surviving a
+    transaction: psycopg 3 server-side prepared statements are turned off and
+    psycopg2 skips the per-connection hstore OID lookup.
+    """
+    options = {"echo": False}
+    if url.startswith("postgresql+psycopg:"):
+        options["connect_args"] = {"prepare_threshold": None}
+    elif url.startswith(("postgresql:", "postgresql+psycopg2:")):
+        options["use_native_hstore"] = False
+
+    if PGBOUNCER_POOL_SIZE <= 0:
+        return create_engine(url, poolclass=NullPool, **options)
+
+    engine = create_engine(
+        url,
+        pool_size=PGBOUNCER_POOL_SIZE,
+        max_overflow=PGBOUNCER_POOL_SIZE,
+        pool_timeout=30,
+        pool_pre_ping=False,
+        **options,
+    )
+    IdlePing(PGBOUNCER_PING_INTERVAL).attach(engine)
+    return engine
+
+
+def create_database_engine(
+    url: str, sqlite_wal: Optional[bool] = None, pgbouncer: bool = False
+):
+    """Create an engine with the pool settings for the database type."""
+    if sqlite_wal is None:
+        sqlite_wal = SQLITE_WAL_MODE
+    if pgbouncer and not url.startswith("sqlite"):
+        return create_pgbouncer_engine(url)
+    if url.startswith("sqlite") and sqlite_wal and ":memory:" not in url:
+        # File SQLite for deployments: a connection per thread from a pool,
+        # WAL so readers run alongside the writer, one writer at a time
+        engine = create_engine(
+            url,
+            connect_args={"check_same_thread": False, "timeout": SQLITE_BUSY_TIMEOUT},
+            poolclass=QueuePool,
+            pool_size=SQLITE_POOL_SIZE,
+            max_overflow=SQLITE_POOL_SIZE,
+            pool_timeout=30,
+            echo=False,
+        )
+        event.listen(engine, "connect", set_sqlite_pragmas)
+        SQLiteWriteLock(SQLITE_BUSY_TIMEOUT).attach(engine)
+        return engine
+    if url.startswith("sqlite"):
+        # SQLite specific configuration
+        return create_engine(
+            url,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+            echo=False,
+        )
+    # PostgreSQL configuration with connection pooling
+    return create_engine(
+        url,
+        pool_pre_ping=True,
+        pool_size=5,
+        max_overflow=10,
+        pool_timeout=30,
+        echo=False,
+    )
 
 
 def get_engine():
     """Get database engine, creating it if necessary."""
     global _engine
     if _engine is None:
-        if DATABASE_URL.startswith("sqlite"):
-            # SQLite specific configuration
-            _engine = create_engine(
-                DATABASE_URL,
-                connect_args={"check_same_thread": False},
-                poolclass=StaticPool,
-                echo=False,
-            )
-        else:
-            # PostgreSQL configuration with connection pooling
-            _engine = create_engine(
-                DATABASE_URL,
-                pool_pre_ping=True,
-                pool_size=5,
-                max_overflow=10,
-                pool_timeout=30,
-                echo=False,
-            )
+        _engine = create_database_engine(DATABASE_URL, pgbouncer=DATABASE_PGBOUNCER)
     return _engine
 
 
+def get_replica_engine():
+    """Get the read replica engine, or None if no replica is configured."""
+    global _replica_engine
+    if _replica_engine is None and DATABASE_REPLICA_URL:
+        with _replica_lock:
+            if _replica_engine is None:
+                _replica_engine = create_database_engine(
+                    DATABASE_REPLICA_URL, pgbouncer=DATABASE_REPLICA_PGBOUNCER
+                )
+    return _replica_engine
+
+
+def get_replica_lag(connection) -> Optional[float]:
+    """Seconds the replica is behind the primary (None if unknown).
+
+    Uses the replay timestamp of the last transaction, so an idle primary also
+    shows up as lag; only PostgreSQL replicas report it.
+    """
+    if connection.dialect.name != "postgresql":
+        return None
+    lag = connection.execute(
+        text(
+            "SELECT CASE WHEN pg_is_in_recovery() THEN "
+            "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+        )
+    ).scalar()
+    return float(lag) if lag is not None else None
+
+
+def replica_status() -> dict:
+    """Describe the read replica: reachable or not, and its current lag."""
+    engine = get_replica_engine()
+    if engine is None:
+        return {"replica": False}
+    try:
+        with engine.connect() as connection:
+            lag = get_replica_lag(connection)
+        return {
+            "replica": True,
+            "available": True,
+            "lag_seconds": round(lag, 3) if lag is not None else None,
+            "max_lag_seconds": REPLICA_MAX_LAG,
+        }
+    except Exception as e:
+        print(f"Replica status error: {e}")
+        return {"replica": True, "available": False}
+
+
+def _usable_replica_engine():
+    """Get the replica engine, or None if reads should use the primary."""
+    global _replica_skip_until, _replica_checked_at
+    engine = get_replica_engine()
+    now = time.monotonic()
+    if engine is None or now < _replica_skip_until:
+        return None
+
+    try:
+        # A pooled checkout proves the replica is reachable; the connection
+        # goes back to the pool for the session to use
+        with engine.connect() as connection:
+            if now - _replica_checked_at < REPLICA_CHECK_INTERVAL:
+                return engine
+            _replica_checked_at = now
+            lag = get_replica_lag(connection)
+        if lag is not None and lag > REPLICA_MAX_LAG:
+            print(f"Replica lag {lag:.1f}s, reading from primary")
+            _replica_skip_until = now + REPLICA_CHECK_INTERVAL
+            return None
+        return engine
+    except Exception as e:
+        print(f"Replica connection error: {e}")
+        _replica_skip_until = now + REPLICA_CHECK_INTERVAL
+        return None
+
+
 # Create SessionLocal class - bind will be set when session is created
 SessionLocal = sessionmaker(autocommit=False, autoflush=False)
 
 
-def init_db():
+def init_db(engine=None):
     """Initialize database and create tables."""
     from models import Base
+    from partitioning import (
+        create_partitioned_visits_table,
+        ensure_visit_partitions,
+        is_partitioning_enabled,
+    )
 
-    Base.metadata.create_all(bind=get_engine())
+    engine = engine or get_engine()
+    partitioned = is_partitioning_enabled(engine)
+    if partitioned:
+        # Tables referenced by visits must exist before the partitioned parent
+        Base.metadata.create_all(
+            bind=engine,
+            tables=[
+                table for table in Base.metadata.sorted_tables if table.name != "visits"
+            ],
+        )
+        create_partitioned_visits_table(engine)
+
+    Base.metadata.create_all(bind=engine)
+
+    if partitioned:
+        ensure_visit_partitions(engine)
     print("Database initialized successfully")
 
 
@@ -105,6 +428,189 @@ def get_db() -> Generator[Session, None, None]:
         db.close()
 
 
+def get_read_db(use_primary: bool = False) -> Generator[Session, None, None]:
+    """Get a session for read-only work, on the replica when one is usable.
+
+    Falls back to the primary when no replica is configured, it cannot be
+    reached or it lags too far behind, or when use_primary is set (a client
+    that has just written and must read its own writes).
+    """
+    replica = None if use_primary else _usable_replica_engine()
+    # Bound to an engine, not a connection, so the session stays usable after
+    # close() like the primary sessions from get_db()
+    db = SessionLocal(bind=replica or get_engine())
+    try:
+        yield db
+    finally:
+        db.close()
+
+
 def get_db_session() -> Session:
     """Get database session (for synchronous operations)."""
     return SessionLocal(bind=get_engine())
+
+
+def get_shard_count() -> int:
+    """Number of link shards (1 when sharding is not configured)."""
+    return 1 + len(DATABASE_SHARD_URLS)
+
+
+def shard_for_code(short_code: str) -> int:
+    """Shard holding a short code: its "s~" prefix, shard 0 without one."""
+    prefix, separator, _ = short_code.partition(SHARD_CODE_SEPARATOR)
+    if separator and prefix.isdigit() and int(prefix) < get_shard_count():
+        return int(prefix)
+    return 0
+
+
+def shard_code(shard: int, short_code: str) -> str:
+    """Prefix a short code with its shard (codes on shard 0 stay as they are)."""
+    return f"{shard}{SHARD_CODE_SEPARATOR}{short_code}" if shard else short_code
+
+
+def shard_for_id(row_id: int) -> int:
+    """Shard holding a link or rule id (ids of shard s start at s * span)."""
+    shard = int(row_id) // SHARD_ID_SPAN
+    return shard if 0 < shard < get_shard_count() else 0
+
+
+def get_shard_engine(shard: int):
+    """Get the engine of a shard, creating it if necessary."""
+    if shard == 0:
+        return get_engine()
+    engine = _shard_engines.get(shard)
+    if engine is None:
+        with _shard_lock:
+            engine = _shard_engines.get(shard)
+            if engine is None:
+                url = DATABASE_SHARD_URLS[shard - 1]
+                engine = create_database_engine(
+                    clean_database_url(url),
+                    pgbouncer=PGBOUNCER_MODE or requests_pgbouncer(url),
+                )
+                _shard_engines[shard] = engine
+    return engine
+
+
+def get_shard_engines() -> List:
+    """Get the engines of all shards, shard 0 first."""
+    return [get_shard_engine(shard) for shard in range(get_shard_count())]
+
+
+def get_shard_db(shard: int) -> Generator[Session, None, None]:
+    """Get a session on a shard."""
+    db = SessionLocal(bind=get_shard_engine(shard))
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+def get_shard_session(shard: int) -> Session:
+    """Get a session on a shard (for synchronous operations)."""
+    return SessionLocal(bind=get_shard_engine(shard))
+
+
+def start_shard_ids(engine, shard: int):
+    """Make the id sequences of links and rules on a shard start in its range,
+    and refuse ids past its end (shard 0 too, once there are other shards).
+
+    The database keeps allocating ids (a PostgreSQL sequence, SQLite
+    AUTOINCREMENT), so concurrent inserts never race for one. Idempotent.
+    """
+    if shard or get_shard_count() > 1:
+        limit_shard_ids(engine, shard)
+    if shard == 0:
+        return
+    start = shard * SHARD_ID_SPAN
+    with engine.begin() as connection:
+        for table in SHARD_ID_TABLES:
+            if engine.dialect.name == "postgresql":
+                connection.execute(
+                    text(
+                        f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                        f"GREATEST(:start, (SELECT COALESCE(MAX(id), 0) + 1 "
+                        f"FROM {table})), false)"
+                    ),
+                    {"start": start},
+                )
+            elif engine.dialect.name == "sqlite":
+                # Without AUTOINCREMENT SQLite uses MAX(rowid) + 1 from 1
+                schema = connection.execute(
+                    text("SELECT sql FROM sqlite_master WHERE name = :table"),
+                    {"table": table},
+                ).scalar()
+                if "AUTOINCREMENT" not in (schema or "").upper():
+                    raise RuntimeError(
+                        f"Таблица {table} шарда {shard} создана без AUTOINCREMENT"
+                    )
+                current = connection.execute(
+                    text("SELECT seq FROM sqlite_sequence WHERE name = :table"),
+                    {"table": table},
+                ).scalar()
+                if current is None:
+                    connection.execute(
+                        text(
+                            "INSERT INTO sqlite_sequence (name, seq) "
+                            "VALUES (:table, :seq)"
+                        ),
+                        {"table": table, "seq": start - 1},
+                    )
+                elif current < start - 1:
+                    connection.execute(
+                        text(
+                            "UPDATE sqlite_sequence SET seq = :seq WHERE name = :table"
+                        ),
+                        {"table": table, "seq": start - 1},
+                    )
+
+
+def limit_shard_ids(engine, shard: int):
+    """Cap the id sequences of links and rules at the end of a shard's range.
+
+    An id past the range would route to the next shard, so inserts fail once a
+    shard runs out of ids (raise SHARD_ID_SPAN, or add shards, before then).
+    """
+    last = min((shard + 1) * SHARD_ID_SPAN, 2**31) - 1
+    with engine.begin() as connection:
+        for table in SHARD_ID_TABLES:
+            used = connection.execute(
+                text(f"SELECT COALESCE(MAX(id), 0) FROM {table}")
+            ).scalar()
+            if used > last:
+                raise RuntimeError(
+                    f"Id {used} в таблице {table} шарда {shard} вышел за "
+                    f"диапазон шарда (до {last}): увеличьте SHARD_ID_SPAN"
+                )
+            if engine.dialect.name == "postgresql":
+                sequence = connection.execute(
+                    text("SELECT pg_get_serial_sequence(:table, 'id')"),
+                    {"table": table},
+                ).scalar()
+                connection.execute(text(f"ALTER SEQUENCE {sequence} MAXVALUE {last}"))
+            elif engine.dialect.name == "sqlite":
+                # SQLite sequences have no maximum; abort the insert instead
+                trigger = f"{table}_shard_id_range"
+                connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+                connection.execute(
+                    text(
+                        f"CREATE TRIGGER {trigger} AFTER INSERT ON {table} "
+                        f"WHEN NEW.id > {last} BEGIN "
+                        f"SELECT RAISE(ABORT, 'id вне диапазона шарда'); END"
+                    )
+                )
+
+
+def fan_out(function: Callable[[int], object], shards: Optional[Iterable[int]] = None):
+    """Call function(shard) on every shard in parallel, results in shard order."""
+    global _fanout_executor
+    shards = list(range(get_shard_count()) if shards is None else shards)
+    if len(shards) == 1:
+        return [function(shards[0])]
+    if _fanout_executor is None:
+        with _shard_lock:
+            if _fanout_executor is None:
+                _fanout_executor = ThreadPoolExecutor(
+                    max_workers=SHARD_FANOUT_WORKERS, thread_name_prefix="shard"
+                )
+    return list(_fanout_executor.map(function, shards))
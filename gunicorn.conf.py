@@ -0,0 +1,11 @@
+"""Gunicorn settings (loaded automatically from the working directory)."""
+
+
+def post_worker_init(worker):
+    """Check the schema stamp and load Redis scripts before the first request."""
+    from cache import cache
+    from main import ensure_db_initialized
+
+    ensure_db_initialized()
+    # Clicks run the trending script with EVALSHA, so load it up front
+    cache.load_scripts()
@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+"""
+Bulk import of existing links from JSON, JSON Lines or CSV.
+
+Records are streamed from the input, validated in worker processes and
+loaded in batches: with COPY on PostgreSQL, with executemany elsewhere.
+Supplied short codes are kept; records without one get a code derived from
+their position in the input, so a rerun produces the same code. Conflicts
+are detected per batch with one query per shard. A code that already points
+to the same URL counts as already imported, which makes reruns idempotent.
+
+Progress is saved to a checkpoint file after every batch, and a rerun
+resumes after the last saved batch.
+
+Input records need ``original_url`` and may have ``short_code``,
+``user_id``, ``click_count`` and ``created_at`` (ISO 8601), as in
+``data/urls.json`` (``{"urls": [...]}``).
+
+Usage:
+    python import_links.py links.json [--format json|jsonl|csv]
+                           [--batch-size 5000] [--workers 4]
+                           [--checkpoint PATH] [--restart] [--rejects PATH]
+"""
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import re
+import string
+import sys
+import time
+from collections import deque
+from datetime import datetime, timezone
+from multiprocessing import Pool
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from database import get_shard_count, get_shard_engine, shard_code, shard_for_code
+from models import Url, User
+
+BATCH_SIZE = 5000
+# Short codes are stored in a VARCHAR(20)
+SHORT_CODE_RE = re.compile(r"^[A-Za-z0-9_-]{1,20}$")
+CODE_ALPHABET = string.ascii_letters + string.digits
+# Bound parameters per IN query (SQLite allows 999)
+LOOKUP_CHUNK = 500
+COLUMNS = ["short_code", "original_url", "user_id", "click_count", "created_at"]
+
+
+def iter_json_array(stream, chunk_size: int = 1 << 16) -> Iterator[Any]:
+    """Yield the items of a JSON array one at a time without loading it all.
+
+    The array may be the document itself or the value of its "urls" key.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+
+    def read_more() -> bool:
+        nonlocal buffer, position, eof
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buffer = buffer[position:] + chunk
+        position = 0
+        return True
+
+    # Find the opening bracket of the array
+    start = None
+    while start is None:
+        stripped = buffer.lstrip()
+        if stripped.startswith("["):
+            start = len(buffer) - len(stripped) + 1
+        elif stripped.startswith("{"):
+            match = re.search(r'"urls"\s*:\s*\[', buffer)
+            if match:
+                start = match.end()
+        elif stripped:
+            raise ValueError("Ожидается JSON-массив или объект с ключом 'urls'")
+        if start is None and not read_more():
+            raise ValueError("Не найден массив ссылок")
+    position = start
+
+    while True:
+        # Skip separators between items
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) or not read_more():
+                break
+        if position >= len(buffer):
+            raise ValueError("Неожиданный конец JSON")
+        if buffer[position] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The item continues in the next chunk
+            if eof or not read_more():
+                raise
+            continue
+        if end == len(buffer) and not eof and read_more():
+            # A number may continue in the next chunk: decode it again
+            continue
+        yield item
+        position = end
+
+
+def read_records(path: str, fmt: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """Stream the records of an input file."""
+    if fmt is None:
+        extension = os.path.splitext(path)[1].lower()
+        fmt = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}.get(
+            extension, "json"
+        )
+    with open(path, newline="" if fmt == "csv" else None, encoding="utf-8") as stream:
+        if fmt == "csv":
+            yield from csv.DictReader(stream)
+        elif fmt == "jsonl":
+            for line in stream:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from iter_json_array(stream)
+
+
+def parse_created_at(value: Any) -> datetime:
+    """Parse an ISO 8601 creation time into a naive UTC datetime."""
+    if not value:
+        return datetime.utcnow()
+    parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+def validate_record(record: Any) -> Dict[str, Any]:
+    """Normalize one input record; raises ValueError with the reason."""
+    if not isinstance(record, dict):
+        raise ValueError("Запись должна быть объектом")
+
+    original_url = str(record.get("original_url") or "").strip()
+    if not original_url.startswith(("http://", "https://")):
+        raise ValueError("URL должен начинаться с http:// или https://")
+    if len(original_url) > 2000:
+        raise ValueError("URL слишком длинный")
+
+    short_code = str(record.get("short_code") or "").strip() or None
+    if short_code is not None and not SHORT_CODE_RE.match(short_code):
+        raise ValueError(f"Неверный короткий код: {short_code}")
+
+    try:
+        user_id = int(record["user_id"]) if record.get("user_id") else None
+        click_count = int(record.get("click_count") or 0)
+    except (TypeError, ValueError):
+        raise ValueError("user_id и click_count должны быть целыми числами")
+    if click_count < 0:
+        raise ValueError("click_count не может быть отрицательным")
+
+    try:
+        created_at = parse_created_at(record.get("created_at"))
+    except ValueError:
+        raise ValueError(f"Неверный формат времени: {record.get('created_at')}")
+
+    return {
+        "short_code": short_code,
+        "original_url": original_url,
+        "user_id": user_id,
+        "click_count": click_count,
+        "created_at": created_at,
+    }
+
+
+def validate_batch(batch: Tuple[int, List[Any]]) -> List[Tuple[int, Any, str]]:
+    """Validate a batch in a worker: (index, row or record, error) per record."""
+    start, records = batch
+    results = []
+    for offset, record in enumerate(records):
+        try:
+            results.append((start + offset, validate_record(record), ""))
+        except ValueError as e:
+            results.append((start + offset, record, str(e)))
+    return results
+
+
+def generated_code(source: str, index: int, attempt: int, length: int = 6) -> str:
+    """Short code for a record without one, stable across reruns.
+
+    The digest also picks the shard, so generated links spread over shards.
+    """
+    digest = hashlib.sha256(f"{source}:{index}:{attempt}".encode("utf-8")).digest()
+    value = int.from_bytes(digest[:8], "big")
+    chars = []
+    for _ in range(length):
+        value, remainder = divmod(value, len(CODE_ALPHABET))
+        chars.append(CODE_ALPHABET[remainder])
+    shard = int.from_bytes(digest[8:12], "big") % get_shard_count()
+    return shard_code(shard, "".join(chars))
+
+
+def chunked(items: List[Any], size: int) -> Iterator[List[Any]]:
+    """Split a list into lists of at most size items."""
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def existing_codes(connection, codes: Iterable[str]) -> Dict[str, str]:
+    """Map the codes that already exist on a shard to their original URL."""
+    table = Url.__table__
+    found = {}
+    for chunk in chunked(list(codes), LOOKUP_CHUNK):
+        rows = connection.execute(
+            select(table.c.short_code, table.c.original_url).where(
+                table.c.short_code.in_(chunk)
+            )
+        )
+        found.update({code: url for code, url in rows})
+    return found
+
+
+def existing_users(user_ids: Iterable[int]) -> set:
+    """Get which user ids exist (users live on shard 0)."""
+    table = User.__table__
+    found = set()
+    with get_shard_engine(0).connect() as connection:
+        for chunk in chunked(sorted(set(user_ids)), LOOKUP_CHUNK):
+            found.update(
+                connection.execute(select(table.c.id).where(table.c.id.in_(chunk)))
+                .scalars()
+                .all()
+            )
+    return found
+
+
+def copy_rows(engine, rows: List[Dict[str, Any]], columns: List[str]):
+    """Load rows with PostgreSQL COPY in one transaction."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[column] for column in columns])
+    buffer.seek(0)
+
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.copy_expert(
+            f"COPY urls ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer
+        )
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+
+def insert_rows(shard: int, rows: List[Dict[str, Any]]):
+    """Insert new links into a shard; its id sequence allocates the ids."""
+    engine = get_shard_engine(shard)
+    columns = list(COLUMNS)
+
+    if engine.dialect.name == "postgresql":
+        copy_rows(engine, rows, columns)
+    else:
+        with engine.begin() as connection:
+            connection.execute(
+                Url.__table__.insert(),
+                [{column: row[column] for column in columns} for row in rows],
+            )
+
+
+def load_batch(
+    source: str, results: List[Tuple[int, Any, str]], rejects: List[Dict[str, Any]]
+) -> Dict[str, int]:
+    """Resolve conflicts of a validated batch in bulk and insert the new links."""
+    counts = {"imported": 0, "existing": 0, "conflicts": 0, "invalid": 0}
+    pending = []
+    for index, row, error in results:
+        if error:
+            counts["invalid"] += 1
+            rejects.append({"index": index, "reason": error, "record": row})
+            continue
+        row["index"] = index
+        row["generated"] = row["short_code"] is None
+        row["attempt"] = 0
+        if row["generated"]:
+            row["short_code"] = generated_code(source, index, 0)
+        pending.append(row)
+
+    # Links of unknown users are rejected instead of failing the whole batch
+    user_ids = [row["user_id"] for row in pending if row["user_id"] is not None]
+    if user_ids:
+        known = existing_users(user_ids)
+        accepted = []
+        for row in pending:
+            if row["user_id"] is not None and row["user_id"] not in known:
+                counts["invalid"] += 1
+                rejects.append(
+                    {
+                        "index": row["index"],
+                        "reason": f"Пользователь {row['user_id']} не найден",
+                        "short_code": row["short_code"],
+                    }
+                )
+            else:
+                accepted.append(row)
+        pending = accepted
+
+    new_rows: Dict[int, List[Dict[str, Any]]] = {}
+    taken: Dict[str, str] = {}
+    while pending:
+        by_shard: Dict[int, List[Dict[str, Any]]] = {}
+        for row in pending:
+            by_shard.setdefault(shard_for_code(row["short_code"]), []).append(row)
+
+        retry = []
+        for shard, rows in by_shard.items():
+            with get_shard_engine(shard).connect() as connection:
+                existing = existing_codes(
+                    connection,
+                    {row["short_code"] for row in rows} - taken.keys(),
+                )
+            existing.update(taken)
+            for row in rows:
+                code = row["short_code"]
+                if code not in existing:
+                    taken[code] = row["original_url"]
+                    new_rows.setdefault(shard, []).append(row)
+                elif existing[code] == row["original_url"]:
+                    # Imported by an earlier run (or a duplicate in the input)
+                    counts["existing"] += 1
+                elif row["generated"]:
+                    row["attempt"] += 1
+                    row["short_code"] = generated_code(
+                        source, row["index"], row["attempt"]
+                    )
+                    retry.append(row)
+                else:
+                    counts["conflicts"] += 1
+                    rejects.append(
+                        {
+                            "index": row["index"],
+                            "reason": "Код занят другой ссылкой",
+                            "short_code": code,
+                        }
+                    )
+        pending = retry
+
+    for shard, rows in sorted(new_rows.items()):
+        insert_rows(shard, rows)
+        counts["imported"] += len(rows)
+    return counts
+
+
+def read_checkpoint(path: str) -> Dict[str, Any]:
+    """Read saved progress, or start from the beginning."""
+    try:
+        with open(path) as checkpoint:
+            return json.load(checkpoint)
+    except FileNotFoundError:
+        return {"position": 0}
+
+
+def write_checkpoint(path: str, state: Dict[str, Any]):
+    """Save progress atomically."""
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as checkpoint:
+        json.dump(state, checkpoint)
+    os.replace(temporary, path)
+
+
+def batches(records: Iterator[Any], start: int, size: int):
+    """Group records into (index of first record, records) batches."""
+    batch: List[Any] = []
+    index = start
+    for record in records:
+        batch.append(record)
+        if len(batch) == size:
+            yield index, batch
+            index += size
+            batch = []
+    if batch:
+        yield index, batch
+
+
+def validated(batch_iter, workers: int):
+    """Validate batches in worker processes, keeping input order.
+
+    At most two batches per worker are in flight, so memory stays bounded
+    however large the input is.
+    """
+    if workers <= 1:
+        for batch in batch_iter:
+            yield batch, validate_batch(batch)
+        return
+    with Pool(workers) as pool:
+        in_flight: deque = deque()
+        for batch in batch_iter:
+            in_flight.append((batch, pool.apply_async(validate_batch, (batch,))))
+            if len(in_flight) >= workers * 2:
+                done, result = in_flight.popleft()
+                yield done, result.get()
+        while in_flight:
+            done, result = in_flight.popleft()
+            yield done, result.get()
+
+
+def import_links(
+    path: str,
+    fmt: Optional[str] = None,
+    batch_size: int = BATCH_SIZE,
+    workers: int = 1,
+    checkpoint: Optional[str] = None,
+    restart: bool = False,
+    rejects_path: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Import links from a file, resuming from its checkpoint."""
+    checkpoint = checkpoint or f"{path}.checkpoint"
+    state = {"position": 0} if restart else read_checkpoint(checkpoint)
+    totals = {
+        key: state.get(key, 0)
+        for key in ("imported", "existing", "conflicts", "invalid")
+    }
+    position = state["position"]
+    if position:
+        print(f"Resuming after {position} records")
+
+    records = read_records(path, fmt)
+    for _ in range(position):
+        # Records of saved batches are parsed again but not processed
+        next(records, None)
+
+    source = os.path.basename(path)
+    started = time.perf_counter()
+    processed = 0
+    with open(rejects_path, "a") if rejects_path else io.StringIO() as rejects_file:
+        for (start, records_batch), results in validated(
+            batches(records, position, batch_size), workers
+        ):
+            rejects: List[Dict[str, Any]] = []
+            counts = load_batch(source, results, rejects)
+            for reject in rejects:
+                rejects_file.write(json.dumps(reject, default=str) + "\n")
+
+            for key, value in counts.items():
+                totals[key] += value
+            position = start + len(records_batch)
+            processed += len(records_batch)
+            write_checkpoint(checkpoint, {"position": position, **totals})
+
+            elapsed = time.perf_counter() - started
+            print(
+                f"{position} records: {totals['imported']} imported, "
+                f"{totals['existing']} existing, {totals['conflicts']} conflicts, "
+                f"{totals['invalid']} invalid ({processed / elapsed:.0f} rows/s)"
+            )
+
+    elapsed = time.perf_counter() - started
+    return {
+        "position": position,
+        **totals,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(processed / elapsed) if elapsed else 0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=["json", "jsonl", "csv"])
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--checkpoint", help="default: <path>.checkpoint")
+    parser.add_argument("--restart", action="store_true", help="ignore checkpoint")
+    parser.add_argument("--rejects", help="append rejected records (JSON Lines)")
+    args = parser.parse_args()
+
+    try:
+        result = import_links(
+            args.path,
+            fmt=args.format,
+            batch_size=args.batch_size,
+            workers=args.workers,
+            checkpoint=args.checkpoint,
+            restart=args.restart,
+            rejects_path=args.rejects,
+        )
+    except Exception as e:
+        print(f"Import error: {e}")
+        sys.exit(1)
+    print(
+        f"Done: {result['imported']} imported in {result['seconds']}s "
+        f"({result['rows_per_second']} rows/s)"
+    )
+
+
+if __name__ == "__main__":
+    main()
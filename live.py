@@ -0,0 +1,175 @@
+"""
+Live click feed for URL Shortener
+
+Redirects publish every click to the Redis channel ``clicks:<short_code>``
+(see ``Cache.record_click``). Each process runs a single listener thread on one
+Redis connection, subscribed only to the channels of links that have a stream
+open in that process, and fans clicks out to those dashboards, so open streams
+cost no extra Redis connections or database queries per event.
+
+Streams are long-lived, so they are served by the ``stream`` process of the
+Procfile (gevent workers, one greenlet per stream) rather than by the threads
+of the web process; ``LIVE_STREAM_ORIGIN`` points dashboards at it. Only
+processes started with ``LIVE_STREAM_SERVER=true`` accept streams, so an
+unconfigured deployment refuses them instead of tying up web threads.
+"""
+
+import os
+import threading
+import time
+from typing import Dict, Set
+
+from dotenv import load_dotenv
+
+from cache import CLICK_CHANNEL_PREFIX, cache
+
+# Load environment variables
+load_dotenv()
+
+# Streams are closed after this many seconds; EventSource reconnects on its own
+LIVE_STREAM_SECONDS = int(os.getenv("LIVE_STREAM_SECONDS", "300"))
+# Base URL of the process serving streams (empty: the process issuing tokens)
+LIVE_STREAM_ORIGIN = os.getenv("LIVE_STREAM_ORIGIN", "").rstrip("/")
+# Whether this process serves streams (the stream process of the Procfile)
+LIVE_STREAM_SERVER = os.getenv("LIVE_STREAM_SERVER", "false").lower() == "true"
+# Seconds to wait before resubscribing after a lost Redis connection
+RECONNECT_DELAY = 5
+# Seconds the listener waits for a message before applying subscription changes
+LISTEN_TIMEOUT = 1.0
+
+
+class LiveSubscription:
+    """Click counter of a single open dashboard"""
+
+    def __init__(self, short_code: str):
+        self.short_code = short_code
+        self._count = 0
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+
+    def add(self, amount: int = 1):
+        """Count clicks received for the link"""
+        with self._lock:
+            self._count += amount
+
+    def drain(self, interval: float = 1.0) -> int:
+        """Wait for the interval and return the clicks counted during it"""
+        self._closed.wait(interval)
+        with self._lock:
+            count, self._count = self._count, 0
+        return count
+
+    def close(self):
+        """Wake up a waiting drain"""
+        self._closed.set()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+
+class ClickHub:
+    """Fan out published clicks to the subscriptions of this process"""
+
+    def __init__(self, cache_instance=cache):
+        self.cache = cache_instance
+        self._subscriptions: Dict[str, Set[LiveSubscription]] = {}
+        self._lock = threading.Lock()
+        self._listener = None
+        # Set when a link gains its first or loses its last subscription
+        self._changed = threading.Event()
+
+    def subscribe(self, short_code: str) -> LiveSubscription:
+        """Start receiving clicks for a link"""
+        subscription = LiveSubscription(short_code)
+        with self._lock:
+            subscribers = self._subscriptions.setdefault(short_code, set())
+            if not subscribers:
+                self._changed.set()
+            subscribers.add(subscription)
+            self._ensure_listener()
+        return subscription
+
+    def unsubscribe(self, subscription: LiveSubscription):
+        """Stop receiving clicks for a link"""
+        subscription.close()
+        with self._lock:
+            subscribers = self._subscriptions.get(subscription.short_code)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._subscriptions[subscription.short_code]
+                    self._changed.set()
+
+    def subscriber_count(self) -> int:
+        """Number of open subscriptions in this process"""
+        with self._lock:
+            return sum(len(subs) for subs in self._subscriptions.values())
+
+    def dispatch(self, channel, data=None):
+        """Deliver one published click to the subscriptions of its link"""
+        if isinstance(channel, bytes):
+            channel = channel.decode("utf-8")
+        short_code = channel[len(CLICK_CHANNEL_PREFIX) :]
+        with self._lock:
+            subscribers = list(self._subscriptions.get(short_code, ()))
+        for subscription in subscribers:
+            subscription.add()
+
+    def _ensure_listener(self):
+        """Start the listener thread on first use (caller holds the lock)"""
+        if self._listener and self._listener.is_alive():
+            return
+        if not self.cache.redis_client:
+            return
+
+        self._listener = threading.Thread(
+            target=self._listen, name="click-hub", daemon=True
+        )
+        self._listener.start()
+
+    def sync_channels(self, pubsub, subscribed: Set[str]) -> Set[str]:
+        """Subscribe to links that gained streams, drop links that lost them"""
+        self._changed.clear()
+        with self._lock:
+            wanted = set(self._subscriptions)
+        added = wanted - subscribed
+        removed = subscribed - wanted
+        if added:
+            pubsub.subscribe(*[f"{CLICK_CHANNEL_PREFIX}{code}" for code in added])
+        if removed:
+            pubsub.unsubscribe(*[f"{CLICK_CHANNEL_PREFIX}{code}" for code in removed])
+        return wanted
+
+    def _listen(self):
+        """Receive clicks from Redis until the process exits"""
+        while True:
+            pubsub = None
+            try:
+                pubsub = self.cache.redis_client.pubsub(ignore_subscribe_messages=True)
+                subscribed: Set[str] = set()
+                self._changed.set()
+                while True:
+                    # Subscription changes are applied by this thread only, so
+                    # the connection is never used by two threads at once
+                    if self._changed.is_set():
+                        subscribed = self.sync_channels(pubsub, subscribed)
+                    if not subscribed:
+                        self._changed.wait(LISTEN_TIMEOUT)
+                        continue
+                    message = pubsub.get_message(timeout=LISTEN_TIMEOUT)
+                    if message and message.get("type") == "message":
+                        self.dispatch(message["channel"], message.get("data"))
+            except Exception as e:
+                print(f"Click hub error: {e}")
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+            time.sleep(RECONNECT_DELAY)
+
+
+# Global click hub instance
+click_hub = ClickHub()
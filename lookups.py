@@ -0,0 +1,61 @@
+"""Core-level lookups for the redirect path.
+
+The statements are built once at import. SQLAlchemy caches their compiled
+SQL per engine, so a lookup costs a cache key check and one round trip and
+returns plain rows: no ORM Query construction, identity map or object
+hydration. The rows support attribute access, so they can stand in for the
+ORM objects where only column values are read (e.g. compile_rule).
+"""
+
+from typing import List, Optional
+
+from sqlalchemy import and_, bindparam, exists, select
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+
+from models import Rule, Url
+
+urls = Url.__table__
+rules = Rule.__table__
+
+URL_BY_CODE = select(
+    urls.c.id,
+    urls.c.original_url,
+    urls.c.user_id,
+    urls.c.click_count,
+    exists()
+    .where(and_(rules.c.url_id == urls.c.id, rules.c.is_active == 1))
+    .label("has_rules"),
+).where(and_(urls.c.short_code == bindparam("short_code"), urls.c.deleted_at.is_(None)))
+
+URL_TARGET = select(urls.c.original_url).where(
+    and_(urls.c.id == bindparam("url_id"), urls.c.deleted_at.is_(None))
+)
+
+ACTIVE_RULES = (
+    select(
+        rules.c.id,
+        rules.c.rule_type,
+        rules.c.condition_value,
+        rules.c.weight,
+        rules.c.conditions,
+        rules.c.target_url,
+    )
+    .where(and_(rules.c.url_id == bindparam("url_id"), rules.c.is_active == 1))
+    .order_by(rules.c.priority.desc(), rules.c.id)
+)
+
+
+def lookup_url(db: Session, short_code: str) -> Optional[Row]:
+    """Get (id, original_url, user_id, click_count, has_rules) for a code."""
+    return db.connection().execute(URL_BY_CODE, {"short_code": short_code}).first()
+
+
+def fetch_url_target(db: Session, url_id: int) -> Optional[str]:
+    """Get the original URL of a link id, or None if it does not exist."""
+    return db.connection().execute(URL_TARGET, {"url_id": url_id}).scalar()
+
+
+def fetch_active_rules(db: Session, url_id: int) -> List[Row]:
+    """Get the active rules of a link as rows, highest priority first."""
+    return db.connection().execute(ACTIVE_RULES, {"url_id": url_id}).all()
@@ -1,22 +1,67 @@
 """URL Shortener API built with Flask for Render."""
 
+import json
 import os
 import random
-from datetime import datetime, timedelta
-from typing import Any, Dict, Optional
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, wraps
+from typing import Any, Dict, List, Optional, Tuple
 
 import jwt
-from flask import Flask, jsonify, redirect, render_template, request
+from flask import Flask, Response, jsonify, redirect, render_template, request
 from flask_cors import CORS
 from flask_wtf.csrf import CSRFProtect
 from sqlalchemy import text
+from sqlalchemy.engine import Row
 from sqlalchemy.orm import Session
 
-from cache import cache
+from analytics import (
+    RECENT_VISITS_LIMIT,
+    analytics_etag,
+    build_analytics_payload,
+    compute_aggregates,
+    get_cached_aggregates,
+    recent_visits,
+    unique_visitor_series,
+    visitor_fingerprint,
+)
+from cache import DEFAULT_RULE_KEY, cache
 
 # Import our modules
-from database import get_db, init_db
-from models import Rule, Url, User, Visit
+from database import (
+    DATABASE_REPLICA_URL,
+    fan_out,
+    get_db,
+    get_read_db,
+    get_shard_count,
+    get_shard_db,
+    replica_status,
+    shard_for_code,
+    shard_for_id,
+)
+from live import (
+    LIVE_STREAM_ORIGIN,
+    LIVE_STREAM_SECONDS,
+    LIVE_STREAM_SERVER,
+    click_hub,
+)
+from lookups import lookup_url
+from migrations import check_schema, migrate
+from models import Rule, RuleHit, Url, UrlClickCounter, User, Visit
+from routing import (
+    STICKY_AB_TESTS,
+    RequestContext,
+    RuleSet,
+    WeightMatcher,
+    compile_condition,
+    get_rule_set,
+    load_rule_set,
+    parse_conditions,
+    rule_cache,
+    simulate_profiles,
+    sticky_draw,
+)
 from schemas import (
     TokenResponse,
     UrlCreate,
@@ -25,7 +70,7 @@ from schemas import (
     UserLogin,
     UserResponse,
 )
-from tasks import log_visit
+from tasks import log_visit, purge_deleted_url
 
 # Optional imports for geoip functionality
 try:
@@ -42,6 +87,17 @@ except ImportError:
         "MockUA", (), {"is_mobile": False, "is_tablet": False, "is_pc": True}
     )()
 
+# Seconds a client keeps reading from the primary after a write
+REPLICA_STICKY_SECONDS = float(os.getenv("REPLICA_STICKY_SECONDS", "10"))
+PRIMARY_COOKIE = "db_primary_until"
+
+# Maximum number of client profiles and request body size of a rule simulation
+SIMULATION_MAX_PROFILES = int(os.getenv("SIMULATION_MAX_PROFILES", "100000"))
+SIMULATION_MAX_BYTES = int(os.getenv("SIMULATION_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Number of distinct User-Agent strings whose device type is kept per process
+USER_AGENT_CACHE_SIZE = int(os.getenv("USER_AGENT_CACHE_SIZE", "10000"))
+
 # Create Flask app
 app = Flask(__name__)
 
@@ -69,6 +125,8 @@ def strftime_filter(date: Optional[datetime], format_string: str) -> str:
 JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_HOURS = 24
+# Lifetime of the token that opens one live stream (it travels in the URL)
+STREAM_TOKEN_SECONDS = int(os.getenv("STREAM_TOKEN_SECONDS", "60"))
 
 # Database will be initialized lazily on first request
 _db_initialized = False
@@ -82,10 +140,25 @@ def create_access_token(user_id: int) -> str:
     return encoded_jwt
 
 
+def create_stream_token(user_id: int, short_code: str) -> str:
+    """Create a short-lived token that only opens the live stream of a link."""
+    expire = datetime.utcnow() + timedelta(seconds=STREAM_TOKEN_SECONDS)
+    to_encode = {
+        "sub": str(user_id),
+        "scope": "stream",
+        "code": short_code,
+        "exp": expire,
+    }
+    return jwt.encode(to_encode, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+
+
 def verify_token(token: str) -> Optional[int]:
     """Verify JWT token and return user_id."""
     try:
         payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        # Scoped tokens (live streams) are not API access tokens
+        if payload.get("scope"):
+            return None
         user_id = int(payload.get("sub"))
         return user_id
     except jwt.ExpiredSignatureError:
@@ -109,12 +182,110 @@ def get_current_user() -> Optional[User]:
     return None
 
 
+def require_auth(view):
+    """Reject requests without a valid access token with 401."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        ensure_db_initialized()
+        if not get_current_user():
+            return jsonify({"error": "Не авторизован"}), 401
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def reads_from_primary() -> bool:
+    """Whether the client wrote within the last REPLICA_STICKY_SECONDS."""
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def get_read_session(shard: int = 0, use_primary: Optional[bool] = None) -> Session:
+    """Get a session for read-only endpoints (replica when available).
+
+    Clients that wrote within the last REPLICA_STICKY_SECONDS carry a cookie
+    and keep reading from the primary, so they see their own writes. The
+    replica only mirrors shard 0; other shards are read directly.
+    """
+    if shard != 0:
+        return next(get_shard_db(shard))
+    if use_primary is None:
+        use_primary = reads_from_primary()
+    return next(get_read_db(use_primary))
+
+
+def replica_may_lag(short_code: str) -> bool:
+    """Whether a short code is read from a replica that may lag the primary."""
+    return bool(DATABASE_REPLICA_URL) and shard_for_code(short_code) == 0
+
+
+def find_url_by_code(db: Session, short_code: str) -> Optional[Url]:
+    """Find a URL by short code, checking the primary if a replica missed it."""
+    url = Url.get_by_short_code(db, short_code)
+    if url is None and replica_may_lag(short_code):
+        # A link created moments ago may not have reached the replica yet
+        url = Url.get_by_short_code(next(get_db()), short_code)
+    return url
+
+
+def find_url_row(db: Session, short_code: str) -> Optional[Row]:
+    """Like find_url_by_code, returning the redirect's lookup row."""
+    row = lookup_url(db, short_code)
+    if row is None and replica_may_lag(short_code):
+        row = lookup_url(next(get_db()), short_code)
+    return row
+
+
+def list_user_urls(user_id: int) -> List[Url]:
+    """Get a user's links from all shards (queried in parallel), newest first."""
+    use_primary = reads_from_primary()
+
+    def query(shard: int) -> List[Url]:
+        db = get_read_session(shard, use_primary)
+        try:
+            urls = (
+                db.query(Url)
+                .filter(Url.user_id == user_id, Url.deleted_at.is_(None))
+                .order_by(Url.created_at.desc())
+                .all()
+            )
+            return UrlClickCounter.attach_totals(db, urls)
+        finally:
+            db.close()
+
+    urls = [url for shard_urls in fan_out(query) for url in shard_urls]
+    if get_shard_count() > 1:
+        urls.sort(key=lambda url: url.created_at or datetime.min, reverse=True)
+    return urls
+
+
+@app.after_request
+def stick_to_primary_after_write(response):
+    """Send clients that just wrote to the primary for their next reads."""
+    if (
+        DATABASE_REPLICA_URL
+        and request.method in ("POST", "PUT", "PATCH", "DELETE")
+        and response.status_code < 400
+    ):
+        response.set_cookie(
+            PRIMARY_COOKIE,
+            str(time.time() + REPLICA_STICKY_SECONDS),
+            max_age=int(REPLICA_STICKY_SECONDS),
+            httponly=True,
+            samesite="Lax",
+        )
+    return response
+
+
 def ensure_db_initialized():
     """Ensure database is initialized before handling requests."""
     global _db_initialized
     if not _db_initialized:
         try:
-            init_db()
+            check_schema()
             _db_initialized = True
         except Exception as e:
             print(f"Database initialization failed: {e}")
@@ -145,8 +316,9 @@ def get_client_info():
     }
 
 
+@lru_cache(maxsize=USER_AGENT_CACHE_SIZE)
 def get_device_type(user_agent_str: str) -> str:
-    """Determine device type from User-Agent."""
+    """Determine device type from User-Agent (parsing is memoized)."""
     try:
         if user_agents is None:
             return "desktop"
@@ -162,92 +334,126 @@ def get_device_type(user_agent_str: str) -> str:
         return "desktop"
 
 
-def get_country_code(ip_address: str) -> str:
-    """Get country code from IP address."""
+def open_geoip_reader():
+    """Open the GeoIP database, or return None if it is not available."""
     try:
         if geoip2 is None:
-            return "XX"
+            return None
 
         geo_db_path = os.getenv(
             "GEOIP_DB_PATH", "/usr/share/GeoIP/GeoLite2-Country.mmdb"
         )
         if os.path.exists(geo_db_path):
-            with geoip2.database.Reader(geo_db_path) as reader:
-                response = reader.country(ip_address)
-                return response.country.iso_code
+            return geoip2.database.Reader(geo_db_path)
+    except Exception:
+        pass
+    return None
+
+
+def lookup_country_code(reader, ip_address: str) -> str:
+    """Get country code from IP address with an open GeoIP reader."""
+    try:
+        if reader is not None:
+            return reader.country(ip_address).country.iso_code
     except Exception:
         pass
     return "XX"  # Unknown
 
 
-def get_current_time_slot() -> str:
-    """Get current time slot (e.g., '09:00-18:00')."""
-    now = datetime.now()
-    hour = now.hour
-    if 9 <= hour < 18:
-        return "09:00-18:00"  # Business hours
-    elif 18 <= hour < 22:
-        return "18:00-22:00"  # Evening
-    else:
-        return "22:00-09:00"  # Night
+def get_country_code(ip_address: str) -> str:
+    """Get country code from IP address."""
+    reader = open_geoip_reader()
+    if reader is None:
+        return "XX"
+    with reader as opened:
+        return lookup_country_code(opened, ip_address)
 
 
-def apply_routing_rules(
-    db: Session, url_id: int, client_info: Dict[str, Any]
-) -> Optional[str]:
-    """Apply routing rules and return the target URL.
+def get_current_time() -> datetime:
+    """Get the current time (timezone-aware, UTC) for time rules."""
+    return datetime.now(timezone.utc)
 
-    Returns the original URL if no rules apply.
+
+def get_ab_draw_source(url_id: int, client_info: Dict[str, Any]):
+    """Get the A/B test draw of a visit: random, or a hash of the visitor."""
+    if not STICKY_AB_TESTS:
+        return random.random
+    return lambda: sticky_draw(
+        url_id,
+        visitor_fingerprint(client_info["ip_address"], client_info["user_agent"]),
+    )
+
+
+def resolve_routing_rules(
+    db: Session,
+    url_id: int,
+    client_info: Dict[str, Any],
+    rules_version: Optional[int] = None,
+) -> Tuple[Optional[str], Optional[int]]:
+    """Apply routing rules and return the target URL and the matched rule id.
+
+    Returns the original URL and None if no rules apply.
     """
     try:
-        # Get active rules for this URL, ordered by priority
-        rules = (
-            db.query(Rule)
-            .filter(Rule.url_id == url_id, Rule.is_active == 1)
-            .order_by(Rule.priority.desc())
-            .all()
-        )
-
-        if not rules:
+        rule_set = get_rule_set(db, url_id, rules_version)
+        if rule_set is None:
+            return None, None
+        if not rule_set.rules:
             # No rules, return original URL
-            url = db.query(Url).filter(Url.id == url_id).first()
-            return url.original_url if url else None
+            return rule_set.original_url, None
 
-        # Analyze client
-        country_code = get_country_code(client_info["ip_address"])
-        device_type = get_device_type(client_info["user_agent"])
-        time_slot = get_current_time_slot()
-        referrer = client_info["referrer"]
+        # Analyze client lazily: only dimensions of candidate rules are resolved
+        context = RequestContext(
+            {
+                "country": lambda: get_country_code(client_info["ip_address"]),
+                "device": lambda: get_device_type(client_info["user_agent"]),
+                "now": get_current_time,
+                "referrer": lambda: (client_info["referrer"] or "").lower(),
+                "ip": lambda: client_info["ip_address"],
+            },
+            get_ab_draw_source(url_id, client_info),
+        )
 
-        # Apply rules in priority order
-        for rule in rules:
-            rule_matches = False
-
-            if rule.rule_type == "country":
-                rule_matches = rule.condition_value.upper() == country_code
-            elif rule.rule_type == "device":
-                rule_matches = rule.condition_value.lower() == device_type
-            elif rule.rule_type == "time":
-                rule_matches = rule.condition_value == time_slot
-            elif rule.rule_type == "referrer":
-                rule_matches = rule.condition_value.lower() in referrer.lower()
-            elif rule.rule_type == "weight":
-                # A/B testing - random selection based on weight
-                if random.random() < float(rule.weight or 0):
-                    rule_matches = True
-
-            if rule_matches:
-                return rule.target_url
-
-        # No rules matched, return original URL
-        url = db.query(Url).filter(Url.id == url_id).first()
-        return url.original_url if url else None
+        rule = rule_set.match(context)
+        if rule:
+            return rule.target_url, rule.id
+        return rule_set.original_url, None
 
     except Exception as e:
         print(f"Error applying routing rules: {e}")
         # Fallback to original URL
-        url = db.query(Url).filter(Url.id == url_id).first()
-        return url.original_url if url else None
+        url = db.query(Url).filter(Url.id == url_id, Url.deleted_at.is_(None)).first()
+        return (url.original_url if url else None), None
+
+
+def apply_routing_rules(
+    db: Session, url_id: int, client_info: Dict[str, Any]
+) -> Optional[str]:
+    """Apply routing rules and return the target URL.
+
+    Returns the original URL if no rules apply.
+    """
+    return resolve_routing_rules(db, url_id, client_info)[0]
+
+
+def simulate_routing_rules(
+    rule_set: RuleSet, url_id: int, profiles: List[Dict[str, Any]]
+) -> Dict[Optional[int], int]:
+    """Evaluate the rules of a URL against client profiles (nothing is logged)."""
+    reader = open_geoip_reader() if "country" in rule_set.dimensions else None
+    try:
+        return simulate_profiles(
+            rule_set,
+            profiles,
+            lambda ip_address: lookup_country_code(reader, ip_address),
+            get_device_type,
+            lambda ip_address, user_agent: get_ab_draw_source(
+                url_id, {"ip_address": ip_address, "user_agent": user_agent}
+            ),
+        )
+    finally:
+        if reader is not None:
+            reader.close()
 
 
 @app.route("/api/auth/register", methods=["POST"])
@@ -419,7 +625,9 @@ def logout():
 def shorten_url():
     """Create a short URL."""
     ensure_db_initialized()
-    db = next(get_db())
+    # New links are spread evenly; the code is drawn to hash to the shard
+    shard = random.randrange(get_shard_count())
+    db = next(get_shard_db(shard))
 
     try:
         # Try to get JSON data first
@@ -453,7 +661,9 @@ def shorten_url():
         user_id = current_user.id if current_user else None
 
         # Create short URL
-        short_url = Url.create_short_url(db, url_data.original_url, base_url, user_id)
+        short_url = Url.create_short_url(
+            db, url_data.original_url, base_url, user_id, shard=shard
+        )
 
         response = UrlResponse(
             id=short_url.id,
@@ -506,12 +716,13 @@ def shorten_url():
 def get_url_info(short_code):
     """Get information about a short URL."""
     ensure_db_initialized()
-    db = next(get_db())
+    db = get_read_session(shard_for_code(short_code))
 
     try:
-        url = Url.get_by_short_code(db, short_code)
+        url = find_url_by_code(db, short_code)
         if not url:
             return jsonify({"error": "Короткий URL не найден"}), 404
+        UrlClickCounter.attach_totals(db, [url])
 
         return jsonify(
             {
@@ -519,7 +730,7 @@ def get_url_info(short_code):
                 "data": {
                     "short_code": url.short_code,
                     "original_url": url.original_url,
-                    "click_count": url.click_count,
+                    "click_count": url.total_clicks,
                     "created_at": url.created_at.strftime("%Y-%m-%dT%H:%M:%S"),
                 },
             }
@@ -533,23 +744,27 @@ def get_url_info(short_code):
 def redirect_to_url(short_code):
     """Redirect to the original URL with smart routing and analytics."""
     ensure_db_initialized()
-    db = next(get_db())
+    # Exactly one shard holds the code
+    db = get_read_session(shard_for_code(short_code))
 
     try:
-        # Try to get URL data from cache first
-        cached_data = cache.get_url_data(short_code)
+        # Try to get URL data from cache first, with the link's rules version
+        cached_data, rules_version = cache.get_redirect_data(short_code)
         url_id = None
 
         if cached_data:
             # Use cached data
             url_id = cached_data.get("id")
         else:
-            # Get from database
-            url = Url.get_by_short_code(db, short_code)
+            # Get from database: one Core lookup returning a plain row
+            url = find_url_row(db, short_code)
             if not url:
                 return jsonify({"error": "Короткий URL не найден"}), 404
 
             url_id = url.id
+            if not url.has_rules and not replica_may_lag(short_code):
+                # Nothing to compile: spare resolve_routing_rules its queries
+                rule_cache.set(url_id, RuleSet(url.original_url, []), rules_version)
 
             # Cache the URL data
             cache.set_url_data(
@@ -565,8 +780,15 @@ def redirect_to_url(short_code):
         # Get client information for routing rules and analytics
         client_info = get_client_info()
 
-        # Apply routing rules if URL has rules configured
-        final_url = apply_routing_rules(db, url_id, client_info)
+        # Apply routing rules if URL has rules configured. Rules are compiled
+        # from the primary (only on a rule cache miss), so an edit is never
+        # cached from a replica that has not caught up yet
+        final_url, rule_id = resolve_routing_rules(
+            next(get_db()) if replica_may_lag(short_code) else db,
+            url_id,
+            client_info,
+            rules_version,
+        )
 
         if not final_url:
             return jsonify({"error": "URL не найден"}), 404
@@ -578,8 +800,12 @@ def redirect_to_url(short_code):
             print(f"Failed to queue visit logging: {e}")
             # Continue with redirect even if logging fails
 
-        # Update click count in cache for faster access
-        cache.increment_counter(f"url_clicks:{short_code}")
+        # Update click count, trending score and rule hits in cache
+        cache.record_click(
+            short_code,
+            url_id=url_id,
+            rule_key=str(rule_id) if rule_id is not None else DEFAULT_RULE_KEY,
+        )
 
         return redirect(final_url, code=302)
 
@@ -609,10 +835,16 @@ def get_version():
 
 @app.route("/api/init-db")
 def init_database():
-    """Initialize database tables (for debugging)."""
+    """Apply pending migrations (for debugging)."""
     try:
-        init_db()
-        return jsonify({"success": True, "message": "Database initialized"})
+        version = migrate()
+        return jsonify(
+            {
+                "success": True,
+                "message": "Database initialized",
+                "schema_version": version,
+            }
+        )
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -633,6 +865,14 @@ def test_database():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+@app.route("/api/db/replica")
+@require_auth
+def get_replica_status():
+    """Report whether a read replica is configured and how far it lags."""
+    status = replica_status()
+    return jsonify({"success": True, **status}), 200
+
+
 @app.route("/api/my-links")
 def get_my_links():
     """Get current user's links."""
@@ -642,16 +882,9 @@ def get_my_links():
     if not user:
         return jsonify({"error": "Не авторизован"}), 401
 
-    db = next(get_db())
-
     try:
         # Get user's URLs ordered by creation date (newest first)
-        urls = (
-            db.query(Url)
-            .filter(Url.user_id == user.id)
-            .order_by(Url.created_at.desc())
-            .all()
-        )
+        urls = list_user_urls(user.id)
 
         # Get base URL for constructing short URLs
         protocol = request.headers.get("x-forwarded-proto", request.scheme)
@@ -670,7 +903,7 @@ def get_my_links():
                     "short_code": url.short_code,
                     "original_url": url.original_url,
                     "short_url": url.short_url,
-                    "click_count": url.click_count,
+                    "click_count": url.total_clicks,
                     "created_at": url.created_at.strftime("%Y-%m-%dT%H:%M:%S"),
                 }
             )
@@ -699,16 +932,9 @@ def get_my_links_html():
             401,
         )
 
-    db = next(get_db())
-
     try:
         # Get user's URLs ordered by creation date (newest first)
-        urls = (
-            db.query(Url)
-            .filter(Url.user_id == user.id)
-            .order_by(Url.created_at.desc())
-            .all()
-        )
+        urls = list_user_urls(user.id)
 
         # Get base URL for constructing short URLs
         protocol = request.headers.get("x-forwarded-proto", request.scheme)
@@ -735,7 +961,7 @@ def get_my_links_html():
                 id=url.id,
                 short_url=url.short_url,
                 original_url=url.original_url,
-                click_count=url.click_count,
+                click_count=url.total_clicks,
                 created_at=url.created_at,
             )
 
@@ -761,7 +987,7 @@ def create_rule():
     if not user:
         return jsonify({"error": "Не авторизован"}), 401
 
-    db = next(get_db())
+    db = None
 
     try:
         data = request.get_json()
@@ -774,38 +1000,38 @@ def create_rule():
             if field not in data:
                 return jsonify({"error": f"Поле '{field}' обязательно"}), 400
 
+        # Rules live on the shard of their URL
+        db = next(get_shard_db(shard_for_id(data["url_id"])))
+
         # Check if URL belongs to user
         url = (
             db.query(Url)
-            .filter(Url.id == data["url_id"], Url.user_id == user.id)
+            .filter(
+                Url.id == data["url_id"],
+                Url.user_id == user.id,
+                Url.deleted_at.is_(None),
+            )
             .first()
         )
         if not url:
             return jsonify({"error": "Ссылка не найдена или не принадлежит вам"}), 404
 
-        # Validate rule type
-        valid_rule_types = ["country", "device", "time", "referrer", "weight"]
-        if data["rule_type"] not in valid_rule_types:
+        # Validate the rule and its extra conditions by compiling them
+        conditions = data.get("conditions") or []
+        try:
+            if not isinstance(conditions, list):
+                raise ValueError("Поле 'conditions' должно быть списком")
+            matcher = compile_condition(data["rule_type"], data["condition_value"])
+            conditions = parse_conditions(conditions)
+            for condition in conditions:
+                compile_condition(condition["type"], condition["value"])
+        except (KeyError, TypeError):
             return (
-                jsonify(
-                    {
-                        "error": (
-                            f"Неверный тип правила. Допустимые: "
-                            f"{', '.join(valid_rule_types)}"
-                        ),
-                    }
-                ),
+                jsonify({"error": "Условие должно содержать поля 'type' и 'value'"}),
                 400,
             )
-
-        # Validate condition value based on rule type
-        if data["rule_type"] == "weight":
-            try:
-                weight = float(data["condition_value"])
-                if not 0 <= weight <= 1:
-                    return jsonify({"error": "Вес должен быть между 0 и 1"}), 400
-            except ValueError:
-                return jsonify({"error": "Вес должен быть числом"}), 400
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
         # Create rule
         rule = Rule(
@@ -813,12 +1039,16 @@ def create_rule():
             rule_type=data["rule_type"],
             condition_value=data["condition_value"],
             target_url=data["target_url"],
+            weight=matcher.weight if isinstance(matcher, WeightMatcher) else 0.0,
+            conditions=json.dumps(conditions) if conditions else None,
             priority=data.get("priority", 0),
             is_active=1,
         )
 
         db.add(rule)
         db.commit()
+        rule_cache.invalidate(rule.url_id)
+        cache.bump_rules_version(url.short_code)
 
         return (
             jsonify(
@@ -830,6 +1060,7 @@ def create_rule():
                         "url_id": rule.url_id,
                         "rule_type": rule.rule_type,
                         "condition_value": rule.condition_value,
+                        "conditions": conditions,
                         "target_url": rule.target_url,
                         "priority": rule.priority,
                         "is_active": rule.is_active,
@@ -841,7 +1072,8 @@ def create_rule():
         )
 
     except Exception as e:
-        db.rollback()
+        if db is not None:
+            db.rollback()
         return jsonify({"error": str(e)}), 500
 
 
@@ -854,11 +1086,15 @@ def get_rules(url_id):
     if not user:
         return jsonify({"error": "Не авторизован"}), 401
 
-    db = next(get_db())
+    db = get_read_session(shard_for_id(url_id))
 
     try:
         # Check if URL belongs to user
-        url = db.query(Url).filter(Url.id == url_id, Url.user_id == user.id).first()
+        url = (
+            db.query(Url)
+            .filter(Url.id == url_id, Url.user_id == user.id, Url.deleted_at.is_(None))
+            .first()
+        )
         if not url:
             return jsonify({"error": "Ссылка не найдена или не принадлежит вам"}), 404
 
@@ -870,22 +1106,129 @@ def get_rules(url_id):
             .all()
         )
 
+        # Flushed rollups plus counts still waiting in Redis
+        hits: Dict[str, int] = {
+            rule_key: count
+            for rule_key, count in db.query(RuleHit.rule_key, RuleHit.hits).filter(
+                RuleHit.url_id == url_id
+            )
+        }
+        for rule_key, count in cache.get_rule_hits(url_id).items():
+            hits[rule_key] = hits.get(rule_key, 0) + count
+        total_hits = sum(hits.values())
+
+        def share(count: int) -> float:
+            return round(count / total_hits, 4) if total_hits else 0.0
+
         rules_data = []
         for rule in rules:
+            rule_hits = hits.get(str(rule.id), 0)
             rules_data.append(
                 {
                     "id": rule.id,
                     "url_id": rule.url_id,
                     "rule_type": rule.rule_type,
                     "condition_value": rule.condition_value,
+                    "conditions": parse_conditions(rule.conditions),
                     "target_url": rule.target_url,
                     "priority": rule.priority,
                     "is_active": rule.is_active,
                     "created_at": rule.created_at.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "hits": rule_hits,
+                    "share": share(rule_hits),
+                }
+            )
+
+        default_hits = hits.get(DEFAULT_RULE_KEY, 0)
+        return (
+            jsonify(
+                {
+                    "success": True,
+                    "rules": rules_data,
+                    "hits": {
+                        "total": total_hits,
+                        "default": default_hits,
+                        "default_share": share(default_hits),
+                    },
                 }
+            ),
+            200,
+        )
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/rules/<int:url_id>/simulate", methods=["POST"])
+def simulate_rules(url_id):
+    """Evaluate the rules of a URL against a batch of synthetic profiles."""
+    ensure_db_initialized()
+
+    user = get_current_user()
+    if not user:
+        return jsonify({"error": "Не авторизован"}), 401
+
+    db = get_read_session(shard_for_id(url_id))
+
+    try:
+        url = (
+            db.query(Url)
+            .filter(Url.id == url_id, Url.user_id == user.id, Url.deleted_at.is_(None))
+            .first()
+        )
+        if not url:
+            return jsonify({"error": "Ссылка не найдена или не принадлежит вам"}), 404
+
+        # Oversized batches are rejected before the body is parsed
+        if (request.content_length or 0) > SIMULATION_MAX_BYTES:
+            return jsonify({"error": "Слишком большой запрос"}), 413
+
+        data = request.get_json(silent=True) or {}
+        profiles = data.get("profiles")
+        if not isinstance(profiles, list) or not profiles:
+            return jsonify({"error": "Поле 'profiles' должно быть списком"}), 400
+        if len(profiles) > SIMULATION_MAX_PROFILES:
+            return (
+                jsonify(
+                    {"error": f"Не более {SIMULATION_MAX_PROFILES} профилей за раз"}
+                ),
+                400,
             )
 
-        return jsonify({"success": True, "rules": rules_data}), 200
+        # Compiled from the session directly: a simulation must not put rules
+        # read from a possibly lagging replica into the redirect's rule cache
+        rule_set = load_rule_set(db, url_id)
+        started = time.perf_counter()
+        try:
+            counts = simulate_routing_rules(rule_set, url_id, profiles)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        elapsed = time.perf_counter() - started
+
+        targets_by_rule = {rule.id: rule.target_url for rule in rule_set.rules}
+        targets = [
+            {
+                "rule_id": rule_id,
+                "target_url": targets_by_rule.get(rule_id, rule_set.original_url),
+                "count": count,
+                "share": round(count / len(profiles), 4),
+            }
+            for rule_id, count in sorted(
+                counts.items(), key=lambda item: item[1], reverse=True
+            )
+        ]
+
+        return (
+            jsonify(
+                {
+                    "success": True,
+                    "profiles": len(profiles),
+                    "targets": targets,
+                    "elapsed_ms": round(elapsed * 1000, 1),
+                }
+            ),
+            200,
+        )
 
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -900,22 +1243,27 @@ def delete_rule(rule_id):
     if not user:
         return jsonify({"error": "Не авторизован"}), 401
 
-    db = next(get_db())
+    db = next(get_shard_db(shard_for_id(rule_id)))
 
     try:
         # Find rule and check ownership through URL
         rule = (
             db.query(Rule)
             .join(Url)
-            .filter(Rule.id == rule_id, Url.user_id == user.id)
+            .filter(
+                Rule.id == rule_id, Url.user_id == user.id, Url.deleted_at.is_(None)
+            )
             .first()
         )
 
         if not rule:
             return jsonify({"error": "Правило не найдено или не принадлежит вам"}), 404
 
+        short_code = rule.url.short_code
         db.delete(rule)
         db.commit()
+        rule_cache.invalidate(rule.url_id)
+        cache.bump_rules_version(short_code)
 
         return jsonify({"success": True, "message": "Правило удалено"}), 200
 
@@ -926,28 +1274,44 @@ def delete_rule(rule_id):
 
 @app.route("/api/urls/<int:url_id>", methods=["DELETE"])
 def delete_url(url_id):
-    """Delete a URL and all its associated rules."""
+    """Delete a URL; its rules, visits and counters are purged by a task."""
     ensure_db_initialized()
 
     user = get_current_user()
     if not user:
         return jsonify({"error": "Не авторизован"}), 401
 
-    db = next(get_db())
+    db = next(get_shard_db(shard_for_id(url_id)))
 
     try:
         # Find URL and check ownership
-        url = db.query(Url).filter(Url.id == url_id, Url.user_id == user.id).first()
+        url = (
+            db.query(Url)
+            .filter(Url.id == url_id, Url.user_id == user.id, Url.deleted_at.is_(None))
+            .first()
+        )
         if not url:
             return jsonify({"error": "Ссылка не найдена или не принадлежит вам"}), 404
 
-        # Delete all rules associated with this URL
-        db.query(Rule).filter(Rule.url_id == url_id).delete()
-
-        # Delete the URL
-        db.delete(url)
+        # Hide the link right away; its rules, visits and counters can be
+        # far too many to delete within the request, so a task purges them
+        url.deleted_at = datetime.utcnow()
         db.commit()
 
+        # Evict every cache tier so no redirect resolves the link any more
+        cache.invalidate_url(url.short_code)
+        cache.invalidate_analytics_data(url_id)
+        rule_cache.invalidate(url_id)
+        cache.bump_rules_version(url.short_code)
+        cache.remove_trending(url.short_code)
+        cache.delete_rule_hits(url_id)
+
+        try:
+            purge_deleted_url.delay(url_id)
+        except Exception as e:
+            # tasks.purge_deleted_urls picks the link up later
+            print(f"Failed to queue link purge: {e}")
+
         return (
             jsonify(
                 {"success": True, "message": "Ссылка и все связанные правила удалены"}
@@ -960,6 +1324,32 @@ def delete_url(url_id):
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/trending")
+def get_trending():
+    """Get links with the highest recently decayed click scores."""
+    user = get_current_user()
+    if not user:
+        return jsonify({"error": "Не авторизован"}), 401
+
+    limit = min(max(request.args.get("limit", 10, type=int), 1), 100)
+
+    # Get base URL for constructing short URLs
+    protocol = request.headers.get("x-forwarded-proto", request.scheme)
+    host = request.headers.get(
+        "x-forwarded-host", request.headers.get("host", request.host)
+    )
+    base_url = f"{protocol}://{host}"
+    links = [
+        {
+            "short_code": short_code,
+            "short_url": f"{base_url}/{short_code}",
+            "score": round(score, 4),
+        }
+        for short_code, score in cache.get_trending(limit)
+    ]
+    return jsonify({"success": True, "trending": links}), 200
+
+
 @app.route("/api/analytics/<short_code>")
 def get_analytics(short_code):
     """Get analytics data for a URL."""
@@ -969,103 +1359,218 @@ def get_analytics(short_code):
     if not user:
         return jsonify({"error": "Не авторизован"}), 401
 
-    db = next(get_db())
+    db = get_read_session(shard_for_code(short_code))
 
     try:
         # Find URL and check ownership
         url = (
             db.query(Url)
-            .filter(Url.short_code == short_code, Url.user_id == user.id)
+            .filter(
+                Url.short_code == short_code,
+                Url.user_id == user.id,
+                Url.deleted_at.is_(None),
+            )
             .first()
         )
         if not url:
             return jsonify({"error": "Ссылка не найдена или не принадлежит вам"}), 404
+        UrlClickCounter.attach_totals(db, [url])
+
+        # The visits table is paged separately from the cached aggregates
+        visits_limit = request.args.get("visits_limit", RECENT_VISITS_LIMIT, type=int)
+        visits_offset = request.args.get("visits_offset", 0, type=int)
+
+        # An explicit time range (in days) is computed directly so PostgreSQL
+        # only scans the matching visit partitions
+        days = request.args.get("days", type=int)
+        if days:
+            since = datetime.utcnow() - timedelta(days=days)
+            visit_filters = [Visit.created_at >= since]
+            aggregates = compute_aggregates(db, url, visit_filters)
+            visits = recent_visits(db, url, visit_filters, visits_limit, visits_offset)
+            analytics_data = build_analytics_payload(
+                url, aggregates, visits, unique_visitor_series(url.id)
+            )
+            return jsonify({"success": True, "analytics": analytics_data}), 200
 
-        # Get visit statistics
-        visits = (
-            db.query(Visit)
-            .filter(Visit.url_id == url.id)
-            .order_by(Visit.created_at.desc())
-            .all()
+        # Otherwise fold only new visits into the cached aggregates
+        aggregates = get_cached_aggregates(db, url)
+        etag = analytics_etag(url, aggregates)
+        if request.if_none_match.contains(etag):
+            response = app.response_class(status=304)
+        else:
+            visits = recent_visits(db, url, None, visits_limit, visits_offset)
+            analytics_data = build_analytics_payload(
+                url, aggregates, visits, unique_visitor_series(url.id)
+            )
+            response = jsonify({"success": True, "analytics": analytics_data})
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    except Exception as e:
+        print(f"Analytics error: {e}")
+        return jsonify({"success": False, "error": "Internal server error"}), 500
+
+
+# Supported per-minute time series windows, in minutes
+TIMESERIES_WINDOWS = {"1h": 60, "24h": 1440}
+
+
+@app.route("/api/analytics/<short_code>/timeseries")
+def get_analytics_timeseries(short_code):
+    """Get per-minute click counts of a URL from Redis."""
+    ensure_db_initialized()
+
+    user = get_current_user()
+    if not user:
+        return jsonify({"error": "Не авторизован"}), 401
+
+    window = request.args.get("window", "1h")
+    minutes = TIMESERIES_WINDOWS.get(window)
+    if not minutes:
+        return jsonify({"error": "Допустимые окна: 1h, 24h"}), 400
+
+    db = get_read_session(shard_for_code(short_code))
+    url = (
+        db.query(Url.id)
+        .filter(
+            Url.short_code == short_code,
+            Url.user_id == user.id,
+            Url.deleted_at.is_(None),
         )
+        .first()
+    )
+    if not url:
+        return jsonify({"error": "Ссылка не найдена или не принадлежит вам"}), 404
+
+    now = time.time()
+    data = cache.get_click_series(short_code, minutes, now)
+    first_minute = int(now // 60) - minutes + 1
+    labels = [
+        datetime.utcfromtimestamp((first_minute + i) * 60).strftime("%Y-%m-%dT%H:%M")
+        for i in range(minutes)
+    ]
+    return (
+        jsonify(
+            {
+                "success": True,
+                "window": window,
+                "timeseries": {"labels": labels, "data": data},
+            }
+        ),
+        200,
+    )
 
-        # Process data for charts
-        analytics_data = {
-            "url_info": {
-                "id": url.id,
-                "short_code": url.short_code,
-                "original_url": url.original_url,
-                "click_count": url.click_count,
-                "created_at": url.created_at.strftime("%Y-%m-%dT%H:%M:%S"),
-            },
-            "clicks_over_time": {},
-            "devices": {},
-            "countries": {},
-            "referrers": {},
-            "visits": [],
-        }
 
-        # Process visits data
-        for visit in visits:
-            # Clicks over time (daily)
-            date_key = visit.created_at.strftime("%Y-%m-%d")
-            analytics_data["clicks_over_time"][date_key] = (
-                analytics_data["clicks_over_time"].get(date_key, 0) + 1
-            )
+def verify_stream_token(token: str, short_code: str) -> Optional[int]:
+    """Verify a live stream token of a link and return user_id."""
+    try:
+        payload = jwt.decode(token, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+        if payload.get("scope") != "stream" or payload.get("code") != short_code:
+            return None
+        return int(payload.get("sub"))
+    except (jwt.PyJWTError, TypeError, ValueError):
+        return None
 
-            # Devices
-            device = visit.device_type or "unknown"
-            analytics_data["devices"][device] = (
-                analytics_data["devices"].get(device, 0) + 1
-            )
 
-            # Countries
-            country = visit.country_code or "XX"
-            analytics_data["countries"][country] = (
-                analytics_data["countries"].get(country, 0) + 1
-            )
+@app.route("/api/analytics/<short_code>/stream-token", methods=["POST"])
+def issue_stream_token(short_code):
+    """Issue a short-lived token for the live click stream of a URL."""
+    ensure_db_initialized()
 
-            # Referrers
-            referrer = "direct"
-            if visit.referrer:
-                try:
-                    from urllib.parse import urlparse
-
-                    parsed = urlparse(visit.referrer)
-                    referrer = parsed.netloc or "direct"
-                    if not referrer or referrer == "":
-                        referrer = "direct"
-                except Exception:
-                    referrer = "direct"
-            analytics_data["referrers"][referrer] = (
-                analytics_data["referrers"].get(referrer, 0) + 1
-            )
+    user = get_current_user()
+    if not user:
+        return jsonify({"error": "Не авторизован"}), 401
+    # Streams are served only by a process started with LIVE_STREAM_SERVER
+    if not LIVE_STREAM_ORIGIN and not LIVE_STREAM_SERVER:
+        return (
+            jsonify(
+                {"error": "Живая статистика недоступна: процесс stream не настроен"}
+            ),
+            503,
+        )
 
-            # Visit details for table
-            analytics_data["visits"].append(
-                {
-                    "date": visit.created_at.strftime("%Y-%m-%d"),
-                    "time": visit.created_at.strftime("%H:%M:%S"),
-                    "ip": visit.ip_address or "unknown",
-                    "country": visit.country_code or "XX",
-                    "device": visit.device_type or "unknown",
-                    "browser": visit.browser or "unknown",
-                    "referrer": referrer,
-                    "target_url": visit.final_url or url.original_url,
-                }
+    db = get_read_session(shard_for_code(short_code))
+    try:
+        url = (
+            db.query(Url.id)
+            .filter(
+                Url.short_code == short_code,
+                Url.user_id == user.id,
+                Url.deleted_at.is_(None),
             )
+            .first()
+        )
+    finally:
+        db.close()
+    if not url:
+        return jsonify({"error": "Ссылка не найдена или не принадлежит вам"}), 404
 
-        # Convert to chart format
-        analytics_data["clicks_over_time"] = {
-            "labels": list(analytics_data["clicks_over_time"].keys()),
-            "data": list(analytics_data["clicks_over_time"].values()),
-        }
+    token = create_stream_token(user.id, short_code)
+    return (
+        jsonify(
+            {
+                "success": True,
+                "token": token,
+                "expires_in": STREAM_TOKEN_SECONDS,
+                "stream_url": (
+                    f"{LIVE_STREAM_ORIGIN}/api/analytics/{short_code}/stream"
+                    f"?token={token}"
+                ),
+            }
+        ),
+        200,
+    )
 
-        return jsonify({"success": True, "analytics": analytics_data}), 200
 
-    except Exception as e:
-        print(f"Analytics error: {e}")
-        return jsonify({"success": False, "error": "Internal server error"}), 500
+@app.route("/api/analytics/<short_code>/stream")
+def stream_analytics(short_code):
+    """Stream per-second click counts of a URL as Server-Sent Events.
+
+    EventSource cannot send headers, so the stream takes a token issued by
+    ``issue_stream_token`` in the query string. Ownership was checked when the
+    token was issued, so the stream process needs no database access. Web
+    processes refuse streams: each one would hold a gthread worker thread.
+    """
+    if not LIVE_STREAM_SERVER:
+        return (
+            jsonify(
+                {"error": "Живая статистика недоступна: процесс stream не настроен"}
+            ),
+            503,
+        )
+
+    user_id = verify_stream_token(request.args.get("token", ""), short_code)
+    if not user_id:
+        return jsonify({"error": "Не авторизован"}), 401
+
+    def generate():
+        subscription = click_hub.subscribe(short_code)
+        try:
+            yield "retry: 3000\n\n"
+            deadline = time.monotonic() + LIVE_STREAM_SECONDS
+            idle = 0
+            while time.monotonic() < deadline:
+                count = subscription.drain(1.0)
+                if count:
+                    event = {"ts": int(time.time()), "count": count}
+                    yield f"event: clicks\ndata: {json.dumps(event)}\n\n"
+                    idle = 0
+                else:
+                    idle += 1
+                    if idle >= 15:
+                        # Comment line keeps proxies from closing an idle stream
+                        yield ": keep-alive\n\n"
+                        idle = 0
+        finally:
+            click_hub.unsubscribe(subscription)
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # Local development server
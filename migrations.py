@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""
+Schema migrations stamped with a version number.
+
+Run at deploy time (the Procfile release step) so web workers never create
+tables themselves: on startup a worker only reads the stamp row.
+
+Usage:
+    python migrations.py           # migrate to the latest version
+    python migrations.py --check   # exit 1 if the database is behind
+"""
+
+import argparse
+import os
+import sys
+from typing import Callable, List, Optional, Tuple
+
+from sqlalchemy import inspect, select, text
+
+import database
+from models import SchemaVersion, Url, UrlClickCounter
+
+SCHEMA_VERSION_ID = 1
+
+# Workers read the stamp on startup; SCHEMA_CHECK=false skips even that
+SCHEMA_CHECK = os.getenv("SCHEMA_CHECK", "true").lower() == "true"
+# Let a worker migrate a database that is behind (local development);
+# in production the release step does it
+IS_PRODUCTION = database.is_production or os.getenv("RENDER_ENV") == "production"
+AUTO_MIGRATE = (
+    os.getenv("AUTO_MIGRATE", "false" if IS_PRODUCTION else "true").lower() == "true"
+)
+
+
+def add_column(engine, table: str, column: str, ddl_type: str):
+    """Add a column unless the table already has it (create_all never does)."""
+    columns = {info["name"] for info in inspect(engine).get_columns(table)}
+    if column not in columns:
+        with engine.begin() as connection:
+            connection.execute(
+                text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}")
+            )
+
+
+def baseline(engine):
+    """Create the tables missing from an unstamped database.
+
+    Columns added to existing tables later are separate migrations below,
+    as create_all leaves existing tables untouched.
+    """
+    database.init_db(engine)
+
+
+def add_click_counters(engine):
+    """Create the click counter slots table."""
+    UrlClickCounter.__table__.create(bind=engine, checkfirst=True)
+
+
+def add_url_deleted_at(engine):
+    """Add urls.deleted_at and the partial index of deleted links."""
+    add_column(engine, "urls", "deleted_at", "TIMESTAMP")
+    for index in Url.__table__.indexes:
+        if index.name == "ix_urls_deleted_at":
+            index.create(bind=engine, checkfirst=True)
+
+
+def add_visit_referrer_host(engine):
+    """Add visits.referrer_host (add_referrer_host_column.sql)."""
+    add_column(engine, "visits", "referrer_host", "VARCHAR(255)")
+
+
+def add_rule_conditions(engine):
+    """Add rules.conditions (add_rule_conditions_column.sql)."""
+    add_column(engine, "rules", "conditions", "TEXT")
+
+
+def widen_rule_condition_value(engine):
+    """Make rules.condition_value TEXT (widen_rule_condition_value.sql)."""
+    # SQLite does not enforce VARCHAR lengths
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as connection:
+            connection.execute(
+                text("ALTER TABLE rules ALTER COLUMN condition_value TYPE TEXT")
+            )
+
+
+# Ordered schema changes: (version, description, function taking the engine).
+# Append new ones here; never edit or reorder applied entries.
+MIGRATIONS: List[Tuple[int, str, Callable]] = [
+    (1, "Tables from models", baseline),
+    (2, "Click counter slots", add_click_counters),
+    (3, "Deleted links awaiting purge", add_url_deleted_at),
+    # Databases baselined before these existed were stamped without them
+    (4, "Visit referrer host column", add_visit_referrer_host),
+    (5, "Rule conditions column", add_rule_conditions),
+    (6, "Unbounded rule condition values", widen_rule_condition_value),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+def get_schema_version(engine) -> Optional[int]:
+    """Read the schema stamp with one query; None if the database has none."""
+    try:
+        with engine.connect() as connection:
+            return connection.execute(
+                select(SchemaVersion.version).where(
+                    SchemaVersion.id == SCHEMA_VERSION_ID
+                )
+            ).scalar()
+    except Exception:
+        # No schema_version table yet
+        return None
+
+
+def set_schema_version(engine, version: int):
+    """Write the schema stamp."""
+    table = SchemaVersion.__table__
+    with engine.begin() as connection:
+        updated = connection.execute(
+            table.update()
+            .where(table.c.id == SCHEMA_VERSION_ID)
+            .values(version=version)
+        ).rowcount
+        if not updated:
+            connection.execute(
+                table.insert().values(id=SCHEMA_VERSION_ID, version=version)
+            )
+
+
+def migrate(engine=None) -> int:
+    """Apply pending migrations and return the resulting schema version.
+
+    Without an engine every link shard is migrated, the main database first.
+    """
+    if engine is not None:
+        return migrate_engine(engine)
+    version = None
+    for shard, shard_engine in enumerate(database.get_shard_engines()):
+        if shard:
+            print(f"Migrating shard {shard}")
+        version = migrate_engine(shard_engine)
+        prepare_link_shard(shard_engine, shard)
+    return version
+
+
+def prepare_link_shard(engine, shard: int):
+    """Keep a shard's link and rule ids in its range and drop foreign keys
+    to users (users live on shard 0). Idempotent.
+    """
+    database.start_shard_ids(engine, shard)
+    if shard == 0 or engine.dialect.name != "postgresql":
+        # SQLite does not enforce foreign keys unless asked to
+        return
+    with engine.begin() as connection:
+        connection.execute(
+            text("ALTER TABLE urls DROP CONSTRAINT IF EXISTS urls_user_id_fkey")
+        )
+
+
+def migrate_engine(engine) -> int:
+    """Apply pending migrations to one database."""
+    version = get_schema_version(engine)
+    if version is None and not inspect(engine).has_table("urls"):
+        # Fresh database: create_all builds the latest schema directly
+        database.init_db(engine)
+        set_schema_version(engine, SCHEMA_VERSION)
+        print(f"Database created at schema version {SCHEMA_VERSION}")
+        return SCHEMA_VERSION
+
+    for number, description, apply in MIGRATIONS:
+        if version is not None and number <= version:
+            continue
+        print(f"Applying migration {number}: {description}")
+        apply(engine)
+        set_schema_version(engine, number)
+        version = number
+    print(f"Database at schema version {version}")
+    return version
+
+
+def check_schema(engine=None) -> Optional[int]:
+    """Worker startup check: one stamp query per shard, migrating if allowed.
+
+    Without an engine every link shard is checked. Returns the lowest
+    version found (None if a database has no stamp).
+    """
+    if not SCHEMA_CHECK:
+        return None
+    engines = [engine] if engine is not None else database.get_shard_engines()
+    versions = []
+    for shard, shard_engine in enumerate(engines):
+        version = get_schema_version(shard_engine)
+        if version is None or version < SCHEMA_VERSION:
+            if AUTO_MIGRATE:
+                version = migrate_engine(shard_engine)
+                prepare_link_shard(shard_engine, shard)
+            else:
+                print(
+                    f"Shard {shard} schema version {version}, "
+                    f"expected {SCHEMA_VERSION}: run python migrations.py"
+                )
+        versions.append(version)
+    return None if None in versions else min(versions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--check", action="store_true", help="only compare the stamp")
+    args = parser.parse_args()
+
+    if args.check:
+        versions = [
+            get_schema_version(engine) for engine in database.get_shard_engines()
+        ]
+        for shard, version in enumerate(versions):
+            print(f"Shard {shard} schema version {version}, expected {SCHEMA_VERSION}")
+        sys.exit(0 if all(v == SCHEMA_VERSION for v in versions) else 1)
+    try:
+        migrate()
+    except Exception as e:
+        print(f"Migration error: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,39 @@
 """SQLAlchemy models for URL Shortener."""
 
 import hashlib
+import json
+import os
 import random
 import secrets
 import string
-from typing import Optional
-
-from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, String, Text, func
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Float,
+    ForeignKey,
+    Index,
+    Integer,
+    String,
+    Text,
+    UniqueConstraint,
+    func,
+    select,
+    text,
+)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session, declarative_base, relationship
 
+from database import shard_code
+
 Base = declarative_base()
 
+# Rows each link's click count is split over; concurrent clicks on one link
+# update different rows instead of queueing on the urls row lock
+CLICK_COUNTER_SLOTS = max(int(os.getenv("CLICK_COUNTER_SLOTS", "16")), 1)
+
 
 class User(Base):
     """User model."""
@@ -102,6 +125,17 @@ class Url(Base):
     """URL model."""
 
     __tablename__ = "urls"
+    # Deleted links waiting for tasks.purge_deleted_urls; usually none
+    __table_args__ = (
+        Index(
+            "ix_urls_deleted_at",
+            "deleted_at",
+            postgresql_where=text("deleted_at IS NOT NULL"),
+            sqlite_where=text("deleted_at IS NOT NULL"),
+        ),
+        # Ids are never reused, and shards can start them at their range
+        {"sqlite_autoincrement": True},
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     short_code = Column(String(20), unique=True, index=True, nullable=False)
@@ -109,6 +143,8 @@ class Url(Base):
     user_id = Column(Integer, ForeignKey("users.id"), index=True, nullable=True)
     click_count = Column(Integer, default=0)
     created_at = Column(DateTime, default=func.now())
+    # Set when the owner deletes the link; its rows are purged in the background
+    deleted_at = Column(DateTime, nullable=True)
 
     @staticmethod
     def generate_short_code(length: int = 6) -> str:
@@ -116,11 +152,19 @@ class Url(Base):
         chars = string.ascii_letters + string.digits
         return "".join(random.choice(chars) for _ in range(length))
 
+    @classmethod
+    def generate_shard_code(cls, shard: int, length: int = 6) -> str:
+        """Generate a random short code carrying the given shard."""
+        return shard_code(shard, cls.generate_short_code(length))
+
     @classmethod
     def create_short_url(
-        cls, db_session, original_url: str, base_url: str, user_id=None
+        cls, db_session, original_url: str, base_url: str, user_id=None, shard=0
     ) -> "Url":
-        """Create a new short URL."""
+        """Create a new short URL on a shard (db_session must be its session).
+
+        The code carries the shard, so uniqueness is only checked there.
+        """
         # Convert HttpUrl to string if needed
         url_str = str(original_url)
 
@@ -134,7 +178,7 @@ class Url(Base):
         # Generate unique short code
         max_attempts = 10
         for _ in range(max_attempts):
-            short_code = cls.generate_short_code()
+            short_code = cls.generate_shard_code(shard)
             existing = (
                 db_session.query(cls).filter(cls.short_code == short_code).first()
             )
@@ -157,18 +201,22 @@ class Url(Base):
 
     @classmethod
     def get_by_short_code(cls, db_session, short_code: str) -> Optional["Url"]:
-        """Get URL by short code."""
-        return db_session.query(cls).filter(cls.short_code == short_code).first()
+        """Get URL by short code (deleted links are not found)."""
+        return (
+            db_session.query(cls)
+            .filter(cls.short_code == short_code, cls.deleted_at.is_(None))
+            .first()
+        )
 
     @classmethod
     def get_original_url(cls, db_session, short_code: str) -> Optional[str]:
-        """Get original URL and increment click count."""
+        """Get original URL and count the click."""
         url_obj = cls.get_by_short_code(db_session, short_code)
         if not url_obj:
             return None
 
-        # Increment click count
-        url_obj.click_count += 1
+        # Count the click in a counter slot, not on the urls row
+        UrlClickCounter.increment(db_session, url_obj.id)
         db_session.commit()
 
         return url_obj.original_url
@@ -194,17 +242,21 @@ class Rule(Base):
     """Rule model for conditional redirects."""
 
     __tablename__ = "rules"
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, index=True)
     url_id = Column(Integer, ForeignKey("urls.id"), index=True, nullable=False)
     rule_type = Column(
         String(50), nullable=False
     )  # 'country', 'device', 'referrer', 'time', 'weight'
-    condition_value = Column(String(100))  # 'US', 'mobile', 'google.com', '09:00-18:00'
+    # 'US', 'mobile', 'google.com', '09:00-18:00', '10.0.0.0/8,2001:db8::/32'
+    condition_value = Column(Text)
     target_url = Column(Text, nullable=False)
     weight = Column(Float, default=0.0)  # For A/B testing (0.0-1.0)
     priority = Column(Integer, default=0)  # Rule priority (higher = checked first)
     is_active = Column(Integer, default=1)  # 1 = active, 0 = inactive
+    # Extra AND-combined conditions: JSON list of {"type": ..., "value": ...}
+    conditions = Column(Text)
     created_at = Column(DateTime, default=func.now())
 
     # Relationship with URL
@@ -219,6 +271,7 @@ class Rule(Base):
             "condition_value": self.condition_value,
             "target_url": self.target_url,
             "weight": self.weight,
+            "conditions": json.loads(self.conditions) if self.conditions else [],
             "priority": self.priority,
             "is_active": bool(self.is_active),
             "created_at": (
@@ -229,16 +282,152 @@ class Rule(Base):
         }
 
 
+class RuleHit(Base):
+    """Redirect counts per matched rule of a URL, flushed from Redis."""
+
+    __tablename__ = "rule_hits"
+    __table_args__ = (
+        UniqueConstraint("url_id", "rule_key", name="uq_rule_hits_url_id_rule_key"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    url_id = Column(Integer, ForeignKey("urls.id"), index=True, nullable=False)
+    rule_key = Column(String(20), nullable=False)  # Rule id or 'default'
+    hits = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+
+
+class UrlClickCounter(Base):
+    """Clicks of a URL not yet folded into urls.click_count, split over slots.
+
+    Writers add to a random slot; tasks.compact_click_counters moves the
+    counts into urls.click_count.
+    """
+
+    __tablename__ = "url_click_counters"
+    __table_args__ = (
+        UniqueConstraint("url_id", "slot", name="uq_url_click_counters_url_id_slot"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    url_id = Column(Integer, ForeignKey("urls.id"), nullable=False)
+    slot = Column(Integer, nullable=False)
+    count = Column(Integer, default=0, nullable=False)
+
+    @classmethod
+    def increment(cls, db_session, url_id: int, amount: int = 1):
+        """Add clicks to a random slot of a URL (the caller commits)."""
+        table = cls.__table__
+        slot = random.randrange(CLICK_COUNTER_SLOTS)
+        dialect = db_session.get_bind().dialect.name
+        if dialect in ("postgresql", "sqlite"):
+            insert = (postgresql if dialect == "postgresql" else sqlite).insert
+            statement = insert(table).values(url_id=url_id, slot=slot, count=amount)
+            db_session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[table.c.url_id, table.c.slot],
+                    set_={"count": table.c.count + statement.excluded.count},
+                )
+            )
+            return
+        updated = db_session.execute(
+            table.update()
+            .where(table.c.url_id == url_id, table.c.slot == slot)
+            .values(count=table.c.count + amount)
+        ).rowcount
+        if not updated:
+            db_session.execute(
+                table.insert().values(url_id=url_id, slot=slot, count=amount)
+            )
+
+    @classmethod
+    def pending(cls, db_session, url_ids: List[int]) -> Dict[int, int]:
+        """Sum the unfolded clicks of URLs with one grouped query."""
+        if not url_ids:
+            return {}
+        rows = db_session.execute(
+            select(cls.url_id, func.sum(cls.count))
+            .where(cls.url_id.in_(url_ids))
+            .group_by(cls.url_id)
+        )
+        return {url_id: int(total or 0) for url_id, total in rows}
+
+    @classmethod
+    def attach_totals(cls, db_session, urls: List["Url"]) -> List["Url"]:
+        """Set url.total_clicks (folded plus pending clicks) on each URL."""
+        pending = cls.pending(db_session, [url.id for url in urls])
+        for url in urls:
+            url.total_clicks = (url.click_count or 0) + pending.get(url.id, 0)
+        return urls
+
+    @classmethod
+    def compact(cls, db_session, batch_size: int = 1000) -> int:
+        """Fold the slots into urls.click_count, batch_size URLs per commit.
+
+        Folded counts are subtracted rather than the rows deleted, so clicks
+        added while a batch is folded are kept for the next run.
+        """
+        table = cls.__table__
+        urls = Url.__table__
+        folded = 0
+        last_url_id = 0
+
+        while True:
+            url_ids = [
+                url_id
+                for (url_id,) in db_session.execute(
+                    select(table.c.url_id)
+                    .where(table.c.url_id > last_url_id, table.c.count != 0)
+                    .group_by(table.c.url_id)
+                    .order_by(table.c.url_id)
+                    .limit(batch_size)
+                )
+            ]
+            if not url_ids:
+                break
+
+            rows = db_session.execute(
+                select(table.c.url_id, table.c.slot, table.c.count).where(
+                    table.c.url_id.in_(url_ids), table.c.count != 0
+                )
+            ).all()
+            totals = {}
+            for url_id, slot, count in rows:
+                db_session.execute(
+                    table.update()
+                    .where(table.c.url_id == url_id, table.c.slot == slot)
+                    .values(count=table.c.count - count)
+                )
+                totals[url_id] = totals.get(url_id, 0) + count
+            for url_id, count in totals.items():
+                db_session.execute(
+                    urls.update()
+                    .where(urls.c.id == url_id)
+                    .values(click_count=func.coalesce(urls.c.click_count, 0) + count)
+                )
+            db_session.execute(
+                table.delete().where(table.c.url_id.in_(url_ids), table.c.count == 0)
+            )
+            db_session.commit()
+
+            folded += sum(totals.values())
+            last_url_id = url_ids[-1]
+
+        return folded
+
+
 class Visit(Base):
     """Visit model for click analytics."""
 
     __tablename__ = "visits"
+    __table_args__ = (Index("ix_visits_url_id_created_at", "url_id", "created_at"),)
 
     id = Column(Integer, primary_key=True, index=True)
     url_id = Column(Integer, ForeignKey("urls.id"), index=True, nullable=False)
     ip_address = Column(String(45))  # IPv4/IPv6 support
     user_agent = Column(Text)
     referrer = Column(Text)
+    referrer_host = Column(String(255))  # Normalized host, 'direct' if none
     country_code = Column(String(2))  # ISO 3166-1 alpha-2
     device_type = Column(String(20))  # 'mobile', 'tablet', 'desktop'
     browser = Column(String(50))
@@ -249,6 +438,19 @@ class Visit(Base):
     # Relationship with URL
     url = relationship("Url", backref="visits")
 
+    @staticmethod
+    def normalize_referrer_host(referrer: Optional[str]) -> str:
+        """Extract lowercased referrer host without 'www.' ('direct' if none)."""
+        if not referrer:
+            return "direct"
+        try:
+            host = urlparse(referrer).hostname or ""
+        except ValueError:
+            return "direct"
+        if host.startswith("www."):
+            host = host[4:]
+        return host or "direct"
+
     def to_dict(self):
         """Convert to dictionary."""
         return {
@@ -257,6 +459,7 @@ class Visit(Base):
             "ip_address": self.ip_address,
             "user_agent": self.user_agent,
             "referrer": self.referrer,
+            "referrer_host": self.referrer_host,
             "country_code": self.country_code,
             "device_type": self.device_type,
             "browser": self.browser,
@@ -268,3 +471,13 @@ class Visit(Base):
                 else None
             ),
         }
+
+
+class SchemaVersion(Base):
+    """Single-row stamp of the schema version applied by migrations.py."""
+
+    __tablename__ = "schema_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
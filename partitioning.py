@@ -0,0 +1,200 @@
+"""Monthly range partitioning of the visits table on PostgreSQL."""
+
+import os
+import re
+from datetime import datetime
+from typing import List
+
+from dotenv import load_dotenv
+from sqlalchemy import MetaData, PrimaryKeyConstraint, inspect, text
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+# Load environment variables
+load_dotenv()
+
+# Partitioning is opt-in and only applies to PostgreSQL databases
+VISITS_PARTITIONING = os.getenv("VISITS_PARTITIONING", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+# How many future months should always have a partition ready
+PARTITION_MONTHS_AHEAD = int(os.getenv("VISITS_PARTITION_MONTHS_AHEAD", "3"))
+
+PARTITION_NAME_RE = re.compile(r"^visits_(\d{4})_(\d{2})$")
+# Catches visits outside every monthly partition (e.g. when maintenance lags)
+DEFAULT_PARTITION = "visits_default"
+
+
+def is_partitioning_enabled(engine) -> bool:
+    """Check whether the visits table should be partitioned on this engine."""
+    return VISITS_PARTITIONING and engine.dialect.name == "postgresql"
+
+
+def month_start(value: datetime) -> datetime:
+    """Truncate a datetime to the first moment of its month."""
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    """Shift a month-start datetime by a number of months."""
+    month_index = value.year * 12 + value.month - 1 + months
+    return value.replace(year=month_index // 12, month=month_index % 12 + 1)
+
+
+def partition_name(month: datetime) -> str:
+    """Get the partition table name for a month (e.g. 'visits_2025_01')."""
+    return f"visits_{month.year:04d}_{month.month:02d}"
+
+
+def _partitioned_visits_table():
+    """Build a copy of the visits table declared as a range-partitioned parent.
+
+    PostgreSQL requires the partition key to be part of the primary key, so the
+    copy uses (id, created_at) as its primary key.
+    """
+    from models import Base
+
+    metadata = MetaData()
+    for table in Base.metadata.sorted_tables:
+        table.to_metadata(metadata)
+
+    visits = metadata.tables["visits"]
+    visits.c.created_at.primary_key = True
+    visits.c.created_at.nullable = False
+    visits.append_constraint(PrimaryKeyConstraint(visits.c.id, visits.c.created_at))
+    visits.c.id.autoincrement = True
+    visits.dialect_options["postgresql"]["partition_by"] = "RANGE (created_at)"
+    return visits
+
+
+def create_partitioned_visits_table(engine) -> bool:
+    """Create the partitioned visits parent table if it does not exist yet.
+
+    Returns True when the table was created. An existing (possibly
+    unpartitioned) visits table is left untouched.
+    """
+    if inspect(engine).has_table("visits"):
+        return False
+
+    visits = _partitioned_visits_table()
+    with engine.begin() as conn:
+        conn.execute(CreateTable(visits))
+        for index in visits.indexes:
+            conn.execute(CreateIndex(index))
+    return True
+
+
+def _partition_exists(conn, name: str) -> bool:
+    """Check whether a partition table exists."""
+    return (
+        conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar()
+        is not None
+    )
+
+
+def ensure_visit_partitions(engine, months_ahead: int = PARTITION_MONTHS_AHEAD):
+    """Create the default partition and the current and next few months.
+
+    Visits that landed in the default partition because their month had no
+    partition yet are moved into the new monthly partition, which PostgreSQL
+    requires before the month can be attached.
+    """
+    current = month_start(datetime.utcnow())
+    created = []
+
+    with engine.begin() as conn:
+        if not _partition_exists(conn, DEFAULT_PARTITION):
+            conn.execute(
+                text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF visits DEFAULT")
+            )
+            created.append(DEFAULT_PARTITION)
+
+        for offset in range(months_ahead + 1):
+            start = add_months(current, offset)
+            end = add_months(start, 1)
+            name = partition_name(start)
+            if _partition_exists(conn, name):
+                continue
+
+            bounds = f"FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+            in_month = (
+                f"created_at >= '{start:%Y-%m-%d}' AND created_at < '{end:%Y-%m-%d}'"
+            )
+            stranded = conn.execute(
+                text(f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_month} LIMIT 1")
+            ).first()
+            if stranded is None:
+                conn.execute(
+                    text(f"CREATE TABLE {name} PARTITION OF visits FOR VALUES {bounds}")
+                )
+            else:
+                conn.execute(
+                    text(
+                        f"CREATE TABLE {name} "
+                        "(LIKE visits INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+                    )
+                )
+                conn.execute(
+                    text(
+                        f"WITH moved AS (DELETE FROM {DEFAULT_PARTITION} "
+                        f"WHERE {in_month} RETURNING *) "
+                        f"INSERT INTO {name} SELECT * FROM moved"
+                    )
+                )
+                conn.execute(
+                    text(
+                        f"ALTER TABLE visits ATTACH PARTITION {name} "
+                        f"FOR VALUES {bounds}"
+                    )
+                )
+            created.append(name)
+
+    return created
+
+
+def default_partition_in_use(engine) -> bool:
+    """Check whether any visits fell outside the monthly partitions."""
+    with engine.connect() as conn:
+        if not _partition_exists(conn, DEFAULT_PARTITION):
+            return False
+        row = conn.execute(text(f"SELECT 1 FROM {DEFAULT_PARTITION} LIMIT 1")).first()
+    return row is not None
+
+
+def list_visit_partitions(engine) -> List[str]:
+    """List the names of the partitions attached to the visits table."""
+    with engine.connect() as conn:
+        rows = conn.execute(
+            text(
+                "SELECT child.relname FROM pg_inherits "
+                "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+                "WHERE parent.relname = 'visits' ORDER BY child.relname"
+            )
+        ).fetchall()
+    return [row[0] for row in rows]
+
+
+def expired_partitions(partition_names: List[str], cutoff: datetime) -> List[str]:
+    """Select partitions whose whole month lies before the cutoff date."""
+    expired = []
+    for name in partition_names:
+        match = PARTITION_NAME_RE.match(name)
+        if not match:
+            continue
+        start = datetime(int(match.group(1)), int(match.group(2)), 1)
+        if add_months(start, 1) <= cutoff:
+            expired.append(name)
+    return expired
+
+
+def drop_expired_partitions(engine, cutoff: datetime) -> List[str]:
+    """Detach and drop partitions that only hold visits older than the cutoff."""
+    dropped = []
+    for name in expired_partitions(list_visit_partitions(engine), cutoff):
+        with engine.begin() as conn:
+            conn.execute(text(f"ALTER TABLE visits DETACH PARTITION {name}"))
+            conn.execute(text(f"DROP TABLE {name}"))
+        dropped.append(name)
+    return dropped
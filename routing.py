@@ -0,0 +1,1113 @@
+"""
+Rule engine for smart routing
+
+Rules are compiled once per URL into typed matchers and indexed by dimension:
+rules whose conditions include a country or device set are only evaluated when
+the visitor's value is in that set. Links with many referrer patterns compile
+them into one Aho-Corasick automaton, so a single pass over the referrer finds
+the candidate referrer rules, and IP rules share one binary radix trie per
+address family, so a walk over the visitor address bits finds the candidate
+IP rules. Other rules are scanned in priority order.
+Visitor dimensions (GeoIP, User-Agent parsing, ...) are resolved lazily, so a
+dimension no candidate rule needs is never computed.
+
+A rule matches when its own ``rule_type``/``condition_value`` and all of its
+extra ``conditions`` match (AND).
+"""
+
+import hashlib
+import ipaddress
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone, tzinfo
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple, Union
+
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session
+
+from lookups import fetch_active_rules, fetch_url_target
+from models import Rule
+
+# Optional NumPy support for parsing simulation timestamps in bulk
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:  # Python 3.8
+    from backports.zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+# Load environment variables
+load_dotenv()
+
+# Compiled rule sets are reused for this many seconds per process
+RULES_CACHE_TTL = float(os.getenv("RULES_CACHE_TTL", "30"))
+# Maximum number of links whose compiled rules a process keeps (LRU)
+RULES_CACHE_SIZE = int(os.getenv("RULES_CACHE_SIZE", "10000"))
+# Links with at most this many rules are scanned in priority order: below it
+# the index lookups cost more than checking every rule (benchmarks/bench_rules.py)
+LINEAR_MAX_RULES = int(os.getenv("RULES_LINEAR_MAX", "3"))
+
+RULE_TYPES = ["country", "device", "time", "referrer", "ip", "weight"]
+DEVICE_TYPES = {"mobile", "tablet", "desktop"}
+# Time zone of time rules that do not name one (server local time if empty)
+ROUTING_TIMEZONE = os.getenv("ROUTING_TIMEZONE", "")
+WEEKDAYS = ["mon", "tue", "wed", "thu", "fri", "sat", "sun"]
+MINUTES_PER_WEEK = 7 * 24 * 60
+# Pick A/B variants from a hash of the visitor instead of a random draw, so a
+# visitor keeps seeing the same variant of a link
+STICKY_AB_TESTS = os.getenv("STICKY_AB_TESTS", "false").lower() == "true"
+# Referrer rules share one Aho-Corasick automaton from this many patterns on;
+# below it plain substring checks are faster
+REFERRER_AUTOMATON_MIN_PATTERNS = 8
+# Maximum number of networks in one ip condition
+MAX_IP_NETWORKS = 1000
+# Dimensions that can be used to index rules, checked in this order
+INDEXED_DIMENSIONS = ("country", "device")
+# UTC profile timestamps NumPy can parse (others go through fromisoformat)
+_UTC_TIMESTAMP = re.compile(
+    r"^\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}(:\d{2}(\.\d{1,6})?)?)?Z?$"
+)
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _split_values(value: str) -> List[str]:
+    """Split a comma separated condition value."""
+    return [part.strip() for part in str(value or "").split(",") if part.strip()]
+
+
+class SetMatcher:
+    """Match a visitor dimension against a set of values."""
+
+    def __init__(self, dimension: str, values: FrozenSet[str]):
+        self.dimension = dimension
+        self.values = values
+
+    def __call__(self, context: "RequestContext") -> bool:
+        return context.get(self.dimension) in self.values
+
+
+class ReferrerMatcher:
+    """Match when the referrer contains any of the given substrings."""
+
+    dimension = "referrer"
+
+    def __init__(self, needles: Tuple[str, ...]):
+        self.needles = needles
+        # Set when the link's referrer rules share one automaton (see RuleSet)
+        self.automaton: Optional["ReferrerAutomaton"] = None
+        self.key = 0
+
+    def __call__(self, context: "RequestContext") -> bool:
+        if self.automaton is not None:
+            return self.key in context.referrer_hits(self.automaton)
+        referrer = context.get(self.dimension)
+        return any(needle in referrer for needle in self.needles)
+
+
+class ReferrerAutomaton:
+    """Aho-Corasick automaton finding all referrer patterns in one pass."""
+
+    def __init__(self, patterns: List[Tuple[str, int]]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail = [0]
+        self.out: List[FrozenSet[int]] = [frozenset()]
+
+        outputs: List[set] = [set()]
+        for needle, key in patterns:
+            state = 0
+            for char in needle:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    outputs.append(set())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            outputs[state].add(key)
+
+        # Breadth-first: a state's failure link points to its longest proper
+        # suffix in the trie, and it also reports that suffix's patterns
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[child] = target if target != child else 0
+                outputs[child] |= outputs[self.fail[child]]
+                queue.append(child)
+        self.out = [frozenset(keys) for keys in outputs]
+
+    def search(self, text: str) -> FrozenSet[int]:
+        """Get the keys of all patterns occurring in the text."""
+        goto, fail, out = self.goto, self.fail, self.out
+        found: FrozenSet[int] = frozenset()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found = found | out[state]
+        return found
+
+
+IpNetwork = Union[ipaddress.IPv4Network, ipaddress.IPv6Network]
+IpAddress = Union[ipaddress.IPv4Address, ipaddress.IPv6Address]
+
+
+class IpMatcher:
+    """Match when the visitor address is in any of the given networks."""
+
+    dimension = "ip"
+
+    def __init__(self, networks: Tuple[IpNetwork, ...]):
+        self.networks = networks
+        self.trie = IpTrie([(network, 0) for network in networks])
+        # Replaced by the trie shared by the link's IP rules (see RuleSet)
+        self.key = 0
+
+    def __call__(self, context: "RequestContext") -> bool:
+        return self.key in context.ip_hits(self.trie)
+
+
+class IpTrie:
+    """Binary radix trie of networks, one per address family.
+
+    Nodes are ``[zero child, one child, keys]`` lists; a network is stored at
+    the node reached by its prefix bits, so a lookup walks at most prefix
+    length nodes and collects the keys of every network containing the address.
+    """
+
+    def __init__(self, networks: List[Tuple[IpNetwork, int]]):
+        self.roots: Dict[int, list] = {4: [None, None, ()], 6: [None, None, ()]}
+        self.bits = {4: 32, 6: 128}
+        for network, key in networks:
+            self.insert(network, key)
+
+    def insert(self, network: IpNetwork, key: int):
+        """Add a network reporting the key."""
+        node = self.roots[network.version]
+        address = int(network.network_address)
+        shift = self.bits[network.version]
+        for _ in range(network.prefixlen):
+            shift -= 1
+            bit = (address >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, ()]
+            node = node[bit]
+        if key not in node[2]:
+            node[2] = node[2] + (key,)
+
+    def lookup(self, address: Optional[IpAddress]) -> FrozenSet[int]:
+        """Get the keys of all networks containing the address."""
+        if address is None:
+            return frozenset()
+        node = self.roots[address.version]
+        found = list(node[2])
+        value = int(address)
+        shift = self.bits[address.version]
+        while shift:
+            shift -= 1
+            node = node[(value >> shift) & 1]
+            if node is None:
+                break
+            if node[2]:
+                found.extend(node[2])
+        return frozenset(found)
+
+
+def parse_ip_address(value: Optional[str]) -> Optional[IpAddress]:
+    """Parse a visitor address, mapping IPv4-mapped IPv6 addresses to IPv4."""
+    try:
+        address = ipaddress.ip_address(str(value or "").strip())
+    except ValueError:
+        return None
+    if address.version == 6 and address.ipv4_mapped:
+        return address.ipv4_mapped
+    return address
+
+
+def compile_ip_networks(values: List[str]) -> IpMatcher:
+    """Compile CIDR networks (or single addresses) into an IP matcher."""
+    if len(values) > MAX_IP_NETWORKS:
+        raise ValueError(f"Слишком много сетей (максимум {MAX_IP_NETWORKS})")
+    networks = []
+    for value in values:
+        try:
+            networks.append(ipaddress.ip_network(value, strict=False))
+        except ValueError:
+            raise ValueError(f"Неверная сеть: {value}")
+    return IpMatcher(tuple(networks))
+
+
+class TimeWindowMatcher:
+    """Match the visit time against a minute-of-week bitmap."""
+
+    dimension = "time"
+
+    def __init__(self, bitmap: bytes, zone: Optional[tzinfo]):
+        self.bitmap = bitmap
+        self.zone = zone
+
+    def __call__(self, context: "RequestContext") -> bool:
+        minute = context.minute_of_week(self.zone)
+        return bool(self.bitmap[minute >> 3] & (1 << (minute & 7)))
+
+
+_TIME_RANGE = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$")
+
+
+def _parse_zone(name: str) -> tzinfo:
+    """Load an IANA time zone."""
+    try:
+        return ZoneInfo(name)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Неизвестный часовой пояс: {name}")
+
+
+def _parse_days(token: str) -> List[int]:
+    """Parse 'Mon', 'Mon-Fri' (ranges may wrap) or 'Sat+Sun' into weekdays."""
+    days = []
+    for part in token.lower().split("+"):
+        bounds = part.split("-")
+        if len(bounds) > 2 or any(bound not in WEEKDAYS for bound in bounds):
+            raise ValueError(f"Неверный день недели: {token}")
+        start, end = WEEKDAYS.index(bounds[0]), WEEKDAYS.index(bounds[-1])
+        days.extend((start + offset) % 7 for offset in range((end - start) % 7 + 1))
+    return days
+
+
+def _parse_time_range(token: str) -> Tuple[int, int]:
+    """Parse 'HH:MM-HH:MM' into a start minute and a length in minutes."""
+    match = _TIME_RANGE.match(token)
+    if not match:
+        raise ValueError(f"Неверный временной интервал: {token}")
+    start_h, start_m, end_h, end_m = (int(group) for group in match.groups())
+    start, end = start_h * 60 + start_m, end_h * 60 + end_m
+    if start_h > 23 or start_m > 59 or end > 24 * 60 or end_m > 59:
+        raise ValueError(f"Неверный временной интервал: {token}")
+    # A window ending before it starts runs past midnight
+    return start, (end - start) % (24 * 60) or 24 * 60
+
+
+def compile_time_windows(value: str) -> TimeWindowMatcher:
+    """Compile a schedule into a 10 080-bit minute-of-week bitmap.
+
+    The schedule is a comma separated list of windows such as
+    ``"Mon-Fri 09:00-18:00, Sat 10:00-14:00 Europe/Moscow"``: an optional
+    day spec (``Mon``, ``Mon-Fri``, ``Sat+Sun``, all days if omitted), an
+    optional time range (the whole day if omitted) and, anywhere, one IANA
+    time zone. Windows ending before they start continue into the next day.
+    """
+    bitmap = bytearray(MINUTES_PER_WEEK // 8)
+    zone_name = None
+    windows = 0
+
+    for part in str(value or "").split(","):
+        days = None
+        span = None
+        for token in part.split():
+            if "/" in token or token.upper() == "UTC":
+                if zone_name and zone_name != token:
+                    raise ValueError("Можно указать только один часовой пояс")
+                zone_name = token
+            elif ":" in token:
+                if span:
+                    raise ValueError(f"Неверный временной интервал: {part.strip()}")
+                span = _parse_time_range(token)
+            elif days is None:
+                days = _parse_days(token)
+            else:
+                raise ValueError(f"Неверный день недели: {token}")
+
+        if days is None and span is None:
+            continue
+        start, length = span or (0, 24 * 60)
+        for day in days if days is not None else range(7):
+            first = day * 24 * 60 + start
+            for minute in range(first, first + length):
+                minute %= MINUTES_PER_WEEK
+                bitmap[minute >> 3] |= 1 << (minute & 7)
+        windows += 1
+
+    if not windows:
+        raise ValueError("Значение условия не может быть пустым")
+
+    zone_name = zone_name or ROUTING_TIMEZONE
+    zone = _parse_zone(zone_name) if zone_name else None
+    return TimeWindowMatcher(bytes(bitmap), zone)
+
+
+class WeightMatcher:
+    """Match the share of visits assigned to one A/B variant.
+
+    All weight rules of a link form one experiment: a single draw per visit
+    picks at most one variant from the link's alias table (see RuleSet).
+    """
+
+    dimension = "random"
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.table: Optional["AliasTable"] = None
+        self.variant = 0
+
+    def __call__(self, context: "RequestContext") -> bool:
+        if self.table is None:
+            return context.draw() < self.weight
+        return self.table.pick(context.draw()) == self.variant
+
+
+class AliasTable:
+    """Walker/Vose alias table: picks a weighted index from one draw in O(1)."""
+
+    def __init__(self, weights: List[float]):
+        count = len(weights)
+        total = sum(weights)
+        scaled = [weight * count / total for weight in weights]
+        self.prob = [1.0] * count
+        self.alias = list(range(count))
+
+        small = [i for i, value in enumerate(scaled) if value < 1.0]
+        large = [i for i, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+
+    def pick(self, draw: float) -> int:
+        """Map a uniform draw in [0, 1) to an index."""
+        scaled = draw * len(self.prob)
+        column = min(int(scaled), len(self.prob) - 1)
+        return column if scaled - column < self.prob[column] else self.alias[column]
+
+
+def sticky_draw(url_id: int, client_id: str) -> float:
+    """Deterministic uniform draw in [0, 1) for a visitor of a link."""
+    digest = hashlib.sha1(f"{url_id}:{client_id}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2**64
+
+
+def compile_condition(rule_type: str, value: Any):
+    """Compile one condition into a matcher.
+
+    Raises ValueError with a user-facing message for invalid conditions.
+    """
+    if rule_type not in RULE_TYPES:
+        raise ValueError(f"Неверный тип правила. Допустимые: {', '.join(RULE_TYPES)}")
+
+    if rule_type == "weight":
+        try:
+            weight = float(value)
+        except (TypeError, ValueError):
+            raise ValueError("Вес должен быть числом")
+        if not 0 <= weight <= 1:
+            raise ValueError("Вес должен быть между 0 и 1")
+        return WeightMatcher(weight)
+
+    if rule_type == "time":
+        return compile_time_windows(value)
+
+    values = _split_values(value)
+    if not values:
+        raise ValueError("Значение условия не может быть пустым")
+
+    if rule_type == "country":
+        return SetMatcher("country", frozenset(v.upper() for v in values))
+    if rule_type == "device":
+        devices = frozenset(v.lower() for v in values)
+        if not devices <= DEVICE_TYPES:
+            allowed = ", ".join(sorted(DEVICE_TYPES))
+            raise ValueError(f"Неверный тип устройства. Допустимые: {allowed}")
+        return SetMatcher("device", devices)
+    if rule_type == "ip":
+        return compile_ip_networks(values)
+    return ReferrerMatcher(tuple(v.lower() for v in values))
+
+
+def parse_conditions(raw: Optional[str]) -> List[Dict[str, Any]]:
+    """Parse the JSON ``conditions`` column of a rule."""
+    if not raw:
+        return []
+    conditions = json.loads(raw) if isinstance(raw, str) else raw
+    return [
+        {"type": condition["type"], "value": condition["value"]}
+        for condition in conditions
+    ]
+
+
+class CompiledRule:
+    """A rule with all of its conditions compiled into matchers."""
+
+    __slots__ = ("id", "position", "target_url", "matchers", "residual")
+
+    def __init__(self, rule_id: int, position: int, target_url: str, matchers):
+        self.id = rule_id
+        self.position = position
+        self.target_url = target_url
+        self.matchers = tuple(matchers)
+        # Matchers still to check once the rule is a candidate
+        self.residual = self.matchers
+
+    def matches(self, context: "RequestContext") -> bool:
+        for matcher in self.matchers:
+            if not matcher(context):
+                return False
+        return True
+
+
+def compile_rule(rule, position: int) -> CompiledRule:
+    """Compile a Rule row (primary condition plus extra conditions)."""
+    if rule.rule_type == "weight":
+        # Rules created before the weight was stored only have condition_value
+        value = rule.condition_value if rule.condition_value else rule.weight
+    else:
+        value = rule.condition_value
+    matchers = [compile_condition(rule.rule_type, value)]
+    for condition in parse_conditions(getattr(rule, "conditions", None)):
+        matchers.append(compile_condition(condition["type"], condition["value"]))
+
+    # Cheap set lookups first, random draws last
+    matchers.sort(key=lambda matcher: matcher.dimension == "random")
+    return CompiledRule(rule.id, position, rule.target_url, matchers)
+
+
+class RuleSet:
+    """Compiled, dimension-indexed rules of one URL."""
+
+    def __init__(self, original_url: str, rules: List[CompiledRule]):
+        self.original_url = original_url
+        self.rules = rules
+        # dimension -> value -> positions of rules requiring that value
+        self.index: Dict[str, Dict[str, List[int]]] = {}
+        # positions of rules that must always be evaluated
+        self.scan: List[int] = []
+
+        # automaton key -> positions of rules indexed by that referrer matcher
+        self.referrer_index: Dict[int, List[int]] = {}
+        self.referrer_automaton: Optional[ReferrerAutomaton] = None
+        # trie key -> positions of rules indexed by that IP matcher
+        self.ip_index: Dict[int, List[int]] = {}
+        self.ip_trie: Optional[IpTrie] = None
+
+        # Visitor dimensions any rule depends on ("random" for A/B draws)
+        self.dimensions = frozenset(
+            matcher.dimension for rule in rules for matcher in rule.matchers
+        )
+
+        self._build_experiment()
+        self._build_referrer_automaton()
+        self._build_ip_trie()
+
+        if len(rules) <= LINEAR_MAX_RULES:
+            self.scan = [rule.position for rule in rules]
+            return
+
+        for rule in rules:
+            matcher = next(
+                (
+                    m
+                    for dimension in INDEXED_DIMENSIONS
+                    for m in rule.matchers
+                    if isinstance(m, SetMatcher) and m.dimension == dimension
+                ),
+                None,
+            )
+            if matcher is None:
+                matcher = next(
+                    (m for m in rule.matchers if isinstance(m, IpMatcher)), None
+                )
+            if matcher is None and self.referrer_automaton is not None:
+                matcher = next(
+                    (m for m in rule.matchers if isinstance(m, ReferrerMatcher)),
+                    None,
+                )
+            if matcher is None:
+                self.scan.append(rule.position)
+                continue
+            # Reaching the rule through the index already satisfies the matcher
+            rule.residual = tuple(m for m in rule.matchers if m is not matcher)
+            if isinstance(matcher, ReferrerMatcher):
+                self.referrer_index[matcher.key] = [rule.position]
+                continue
+            if isinstance(matcher, IpMatcher):
+                self.ip_index[matcher.key] = [rule.position]
+                continue
+            values = self.index.setdefault(matcher.dimension, {})
+            for value in matcher.values:
+                values.setdefault(value, []).append(rule.position)
+
+    def _build_experiment(self):
+        """Compile the link's weight rules into one alias table.
+
+        Weights are shares of all visits; if they add up to less than 1 the
+        rest falls through to the other rules, above 1 they are normalized.
+        """
+        matchers = [
+            matcher
+            for rule in self.rules
+            for matcher in rule.matchers
+            if isinstance(matcher, WeightMatcher)
+        ]
+        weights = [matcher.weight for matcher in matchers]
+        if not weights or sum(weights) <= 0:
+            return
+
+        remainder = 1.0 - sum(weights)
+        table = AliasTable(weights + [remainder] if remainder > 0 else weights)
+        for variant, matcher in enumerate(matchers):
+            matcher.table = table
+            matcher.variant = variant
+
+    def _build_referrer_automaton(self):
+        """Compile the link's referrer patterns into one automaton."""
+        matchers = [
+            matcher
+            for rule in self.rules
+            for matcher in rule.matchers
+            if isinstance(matcher, ReferrerMatcher)
+        ]
+        patterns = [
+            (needle, key)
+            for key, matcher in enumerate(matchers)
+            for needle in matcher.needles
+        ]
+        if len(patterns) < REFERRER_AUTOMATON_MIN_PATTERNS:
+            return
+
+        self.referrer_automaton = ReferrerAutomaton(patterns)
+        for key, matcher in enumerate(matchers):
+            matcher.automaton = self.referrer_automaton
+            matcher.key = key
+
+    def _build_ip_trie(self):
+        """Insert the networks of all IP matchers of the link into one trie."""
+        matchers = [
+            matcher
+            for rule in self.rules
+            for matcher in rule.matchers
+            if isinstance(matcher, IpMatcher)
+        ]
+        if not matchers:
+            return
+
+        self.ip_trie = IpTrie(
+            [
+                (network, key)
+                for key, matcher in enumerate(matchers)
+                for network in matcher.networks
+            ]
+        )
+        for key, matcher in enumerate(matchers):
+            matcher.trie = self.ip_trie
+            matcher.key = key
+
+    def candidates(self, context: "RequestContext") -> List[int]:
+        """Positions of rules that can match the visitor, in priority order."""
+        found = self.scan
+        merged = False
+        groups = [
+            values.get(context.get(dimension))
+            for dimension, values in self.index.items()
+        ]
+        if self.referrer_index:
+            hits = context.referrer_hits(self.referrer_automaton)
+            groups.extend(self.referrer_index.get(key) for key in hits)
+        if self.ip_index:
+            hits = context.ip_hits(self.ip_trie)
+            groups.extend(self.ip_index.get(key) for key in hits)
+        for positions in groups:
+            if not positions:
+                continue
+            if not found:
+                found = positions
+            else:
+                found = found + positions
+                merged = True
+        return sorted(found) if merged else found
+
+    def match(self, context: "RequestContext") -> Optional[CompiledRule]:
+        """Get the highest priority rule matching the visitor."""
+        rules = self.rules
+        for position in self.candidates(context):
+            rule = rules[position]
+            for matcher in rule.residual:
+                if not matcher(context):
+                    break
+            else:
+                return rule
+        return None
+
+    def viable(self, context: "RequestContext") -> List[CompiledRule]:
+        """Rules matching the visitor apart from A/B draws, in priority order.
+
+        The list ends at the first rule without a draw, which always matches;
+        ``match`` returns the first listed rule whose draws also match.
+        """
+        rules = self.rules
+        found = []
+        for position in self.candidates(context):
+            rule = rules[position]
+            drawn = False
+            for matcher in rule.residual:
+                if matcher.dimension == "random":
+                    drawn = True
+                elif not matcher(context):
+                    break
+            else:
+                found.append(rule)
+                if not drawn:
+                    break
+        return found
+
+    @staticmethod
+    def pick(
+        viable: List[CompiledRule], context: "RequestContext"
+    ) -> Optional[CompiledRule]:
+        """Get the first of the ``viable`` rules whose A/B draws match."""
+        for rule in viable:
+            for matcher in rule.residual:
+                if matcher.dimension == "random" and not matcher(context):
+                    break
+            else:
+                return rule
+        return None
+
+
+class RequestContext:
+    """Lazily resolved visitor dimensions of one redirect."""
+
+    def __init__(
+        self,
+        resolvers: Dict[str, Callable[[], Any]],
+        draw_source: Callable[[], float],
+    ):
+        self._resolvers = resolvers
+        self._values: Dict[str, Any] = {}
+        self._draw_source = draw_source
+        self._draw: Optional[float] = None
+
+    def get(self, dimension: str) -> Any:
+        """Get a dimension value, resolving it on first use."""
+        try:
+            return self._values[dimension]
+        except KeyError:
+            value = self._values[dimension] = self._resolvers[dimension]()
+            return value
+
+    def minute_of_week(self, zone: Optional[tzinfo]) -> int:
+        """Minute of the week of the visit in a time zone (None: local time)."""
+        key = ("minute_of_week", zone)
+        if key not in self._values:
+            now: datetime = self.get("now")
+            local = now.astimezone(zone) if zone else now.astimezone()
+            self._values[key] = (
+                local.weekday() * 24 * 60 + local.hour * 60 + local.minute
+            )
+        return self._values[key]
+
+    def referrer_hits(self, automaton: ReferrerAutomaton) -> FrozenSet[int]:
+        """Keys of the referrer patterns found in the referrer (one pass)."""
+        key = ("referrer_hits", id(automaton))
+        if key not in self._values:
+            self._values[key] = automaton.search(self.get("referrer"))
+        return self._values[key]
+
+    def ip_hits(self, trie: IpTrie) -> FrozenSet[int]:
+        """Keys of the networks containing the visitor address (one walk)."""
+        key = ("ip_hits", id(trie))
+        if key not in self._values:
+            self._values[key] = trie.lookup(parse_ip_address(self.get("ip")))
+        return self._values[key]
+
+    def draw(self) -> float:
+        """Uniform draw in [0, 1) shared by all weight rules of the visit."""
+        if self._draw is None:
+            self._draw = self._draw_source()
+        return self._draw
+
+
+def compile_rule_set(original_url: str, rules: List[Rule]) -> RuleSet:
+    """Compile rules that are already sorted by priority."""
+    compiled = []
+    for rule in rules:
+        try:
+            compiled.append(compile_rule(rule, len(compiled)))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Skipping invalid rule {rule.id}: {e}")
+    return RuleSet(original_url, compiled)
+
+
+class RuleCache:
+    """Per-process TTL cache of compiled rule sets, bounded by LRU eviction.
+
+    Entries can carry the link's rules version from Redis; a lookup with a
+    different version misses, so rule edits apply in every process at once.
+    """
+
+    def __init__(self, ttl: float = RULES_CACHE_TTL, size: int = RULES_CACHE_SIZE):
+        self.ttl = ttl
+        self.size = size
+        self._entries: "OrderedDict[int, Tuple[float, Optional[int], RuleSet]]" = (
+            OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def get(self, url_id: int, version: Optional[int] = None) -> Optional[RuleSet]:
+        with self._lock:
+            entry = self._entries.get(url_id)
+            if entry is None:
+                return None
+            expires_at, entry_version, rule_set = entry
+            if expires_at <= time.monotonic() or (
+                version is not None and entry_version != version
+            ):
+                del self._entries[url_id]
+                return None
+            self._entries.move_to_end(url_id)
+            return rule_set
+
+    def set(self, url_id: int, rule_set: RuleSet, version: Optional[int] = None):
+        if self.ttl <= 0 or self.size <= 0:
+            return
+        with self._lock:
+            self._entries[url_id] = (time.monotonic() + self.ttl, version, rule_set)
+            self._entries.move_to_end(url_id)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def invalidate(self, url_id: int):
+        with self._lock:
+            self._entries.pop(url_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+rule_cache = RuleCache()
+
+
+def load_rule_set(db: Session, url_id: int) -> Optional[RuleSet]:
+    """Compile the rules of a URL from the database, bypassing the cache."""
+    original_url = fetch_url_target(db, url_id)
+    if original_url is None:
+        return None
+    return compile_rule_set(original_url, fetch_active_rules(db, url_id))
+
+
+def get_rule_set(
+    db: Session, url_id: int, version: Optional[int] = None
+) -> Optional[RuleSet]:
+    """Get the compiled rules of a URL, or None if the URL does not exist.
+
+    ``version`` is the link's rules version read before the lookup; a cached
+    rule set compiled for another version is recompiled.
+    """
+    rule_set = rule_cache.get(url_id, version)
+    if rule_set is not None:
+        return rule_set
+
+    rule_set = load_rule_set(db, url_id)
+    if rule_set is not None:
+        rule_cache.set(url_id, rule_set, version)
+    return rule_set
+
+
+def parse_profile_time(value: Optional[str]) -> datetime:
+    """Parse an ISO 8601 profile timestamp (naive values are UTC)."""
+    if not value:
+        return datetime.now(timezone.utc)
+    try:
+        parsed = datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    except ValueError:
+        raise ValueError(f"Неверный формат времени: {value}")
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+
+def parse_profile_times(values) -> Dict[Optional[str], datetime]:
+    """Parse distinct profile timestamps, UTC ones in one NumPy call."""
+    parsed: Dict[Optional[str], datetime] = {}
+    utc = []
+    for value in values:
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f"Неверный формат времени: {value}")
+        if np is not None and value and _UTC_TIMESTAMP.match(value):
+            utc.append(value)
+        else:
+            parsed[value] = parse_profile_time(value)
+    if utc:
+        try:
+            stamps = np.array([value.rstrip("Z") for value in utc], "datetime64[us]")
+        except ValueError:
+            # Out of range fields: report the first bad value
+            return {**parsed, **{value: parse_profile_time(value) for value in utc}}
+        micros = stamps.astype(np.int64).tolist()
+        for value, offset in zip(utc, micros):
+            parsed[value] = _EPOCH + timedelta(microseconds=offset)
+    return parsed
+
+
+def parse_profile_epochs(values: List[Optional[str]]):
+    """Parse profile timestamps into epoch seconds, UTC ones in one NumPy call."""
+    epochs = np.empty(len(values))
+    utc: List[str] = []
+    positions: List[int] = []
+    for position, value in enumerate(values):
+        if value is not None and not isinstance(value, str):
+            raise ValueError(f"Неверный формат времени: {value}")
+        if value and _UTC_TIMESTAMP.match(value):
+            utc.append(value.rstrip("Z"))
+            positions.append(position)
+        else:
+            epochs[position] = parse_profile_time(value).timestamp()
+    if utc:
+        try:
+            epochs[positions] = np.array(utc, "datetime64[us]").astype(np.int64) / 1e6
+        except ValueError:
+            # Out of range fields: report the first bad value
+            epochs[positions] = [parse_profile_time(value).timestamp() for value in utc]
+    return epochs
+
+
+def _factorize(values: List[Any]) -> Tuple[List[Any], Any]:
+    """Distinct values (first seen first) and each value's index among them."""
+    index: Dict[Any, int] = {}
+    codes = [index.setdefault(value, len(index)) for value in values]
+    return list(index), np.array(codes, dtype=np.int64)
+
+
+def _resolve_column(values: List[Any], resolve: Callable[[Any], Any]):
+    """Resolve each distinct value once; get the results and per-row indexes."""
+    distinct, codes = _factorize(values)
+    resolved, resolved_codes = _factorize([resolve(value) for value in distinct])
+    return resolved, resolved_codes[codes]
+
+
+def _utc_offset(epoch: float, zone: Optional[tzinfo]) -> float:
+    """UTC offset in seconds of a zone (None: local time) at an instant."""
+    moment = datetime.fromtimestamp(epoch, timezone.utc)
+    local = moment.astimezone(zone) if zone else moment.astimezone()
+    return local.utcoffset().total_seconds()
+
+
+def _minutes_of_week(epochs, zone: Optional[tzinfo]):
+    """Minute of the week of each instant in a time zone (as minute_of_week).
+
+    The offset is looked up once per distinct hour; only hours in which the
+    offset changes are resolved instant by instant.
+    """
+    hours, inverse = np.unique(epochs // 3600, return_inverse=True)
+    offsets = np.empty(len(hours))
+    for i, hour in enumerate(hours.tolist()):
+        start = _utc_offset(hour * 3600, zone)
+        offsets[i] = start if start == _utc_offset(hour * 3600 + 3599, zone) else np.nan
+    offsets = offsets[inverse.ravel()]
+    changing = np.isnan(offsets)
+    if changing.any():
+        offsets[changing] = [
+            _utc_offset(epoch, zone) for epoch in epochs[changing].tolist()
+        ]
+    # 1970-01-01 was a Thursday (weekday 3)
+    minutes = ((epochs + offsets) // 60).astype(np.int64) + 3 * 24 * 60
+    return minutes % MINUTES_PER_WEEK
+
+
+def _draw_hits(matcher: WeightMatcher, draws):
+    """Which visits' draws select the variant of a weight matcher (as pick)."""
+    if matcher.table is None:
+        return draws < matcher.weight
+    prob = np.array(matcher.table.prob)
+    alias = np.array(matcher.table.alias)
+    scaled = draws * len(prob)
+    column = np.minimum(scaled.astype(np.int64), len(prob) - 1)
+    picks = np.where(scaled - column < prob[column], column, alias[column])
+    return picks == matcher.variant
+
+
+def _simulate_bulk(
+    rule_set: RuleSet,
+    profiles: List[Dict[str, Any]],
+    country_of: Callable[[str], str],
+    device_of: Callable[[str], str],
+    draw_source_of: Callable[[str, str], Callable[[], float]],
+) -> Dict[Optional[int], int]:
+    """Evaluate all profiles at once, one NumPy mask per rule condition.
+
+    Each dimension is resolved once per distinct value and every matcher runs
+    once per distinct value of its dimension; the results are spread to the
+    profiles by index arrays. Rules then claim the profiles still unmatched in
+    priority order.
+    """
+    dimensions = rule_set.dimensions
+    ips = [str(p.get("ip") or p.get("ip_address") or "") for p in profiles]
+    user_agents = [str(p.get("user_agent") or "") for p in profiles]
+
+    # dimension -> (contexts of the distinct values, value index of each profile)
+    columns: Dict[str, Tuple[List[RequestContext], Any]] = {}
+
+    def add_column(dimension: str, values: List[Any], codes):
+        contexts = [
+            RequestContext({dimension: lambda value=value: value}, random.random)
+            for value in values
+        ]
+        columns[dimension] = (contexts, codes)
+
+    if "country" in dimensions:
+        add_column("country", *_resolve_column(ips, country_of))
+    if "device" in dimensions:
+        add_column("device", *_resolve_column(user_agents, device_of))
+    if "referrer" in dimensions:
+        referrers = [str(p.get("referrer") or "") for p in profiles]
+        add_column("referrer", *_resolve_column(referrers, str.lower))
+    if "ip" in dimensions:
+        add_column("ip", *_factorize(ips))
+
+    # Parsed even without time rules, so bad timestamps are always reported
+    stamps, codes = _factorize([p.get("timestamp") for p in profiles])
+    epochs = parse_profile_epochs(stamps)[codes]
+    minutes: Dict[Optional[tzinfo], Any] = {}
+
+    draws = None
+    if "random" in dimensions:
+        draws = np.array([draw_source_of(ip, ua)() for ip, ua in zip(ips, user_agents)])
+
+    def hits(matcher):
+        if isinstance(matcher, WeightMatcher):
+            return _draw_hits(matcher, draws)
+        if isinstance(matcher, TimeWindowMatcher):
+            if matcher.zone not in minutes:
+                minutes[matcher.zone] = _minutes_of_week(epochs, matcher.zone)
+            bits = np.unpackbits(
+                np.frombuffer(matcher.bitmap, dtype=np.uint8), bitorder="little"
+            ).astype(bool)
+            return bits[minutes[matcher.zone]]
+        contexts, codes = columns[matcher.dimension]
+        found = np.fromiter(
+            (matcher(context) for context in contexts), bool, len(contexts)
+        )
+        return found[codes]
+
+    rules = rule_set.rules
+    # Position of the matched rule per profile, len(rules) when none matched
+    matched = np.full(len(profiles), len(rules), dtype=np.int64)
+    unmatched = np.ones(len(profiles), dtype=bool)
+    for position, rule in enumerate(rules):
+        mask = unmatched.copy()
+        for matcher in rule.matchers:
+            mask &= hits(matcher)
+            if not mask.any():
+                break
+        else:
+            matched[mask] = position
+            unmatched &= ~mask
+            if not unmatched.any():
+                break
+
+    counts: Dict[Optional[int], int] = {}
+    totals = np.bincount(matched, minlength=len(rules) + 1).tolist()
+    for position, total in enumerate(totals):
+        if total:
+            rule_id = rules[position].id if position < len(rules) else None
+            counts[rule_id] = counts.get(rule_id, 0) + total
+    return counts
+
+
+def simulate_profiles(
+    rule_set: RuleSet,
+    profiles: List[Dict[str, Any]],
+    country_of: Callable[[str], str],
+    device_of: Callable[[str], str],
+    draw_source_of: Callable[[str, str], Callable[[], float]],
+) -> Dict[Optional[int], int]:
+    """Evaluate compiled rules against synthetic client profiles.
+
+    Returns the number of profiles per matched rule id (None: no rule).
+    Countries and devices are resolved once per IP and User-Agent of the batch
+    and the distinct timestamps are parsed together. With NumPy the whole
+    batch is evaluated in bulk (see _simulate_bulk); otherwise, unless the
+    link runs an A/B test, profiles that agree on every dimension the rules
+    use share one evaluation.
+    """
+    for profile in profiles:
+        if not isinstance(profile, dict):
+            raise ValueError("Профиль должен быть объектом")
+    if np is not None:
+        return _simulate_bulk(rule_set, profiles, country_of, device_of, draw_source_of)
+    times = parse_profile_times({profile.get("timestamp") for profile in profiles})
+
+    dimensions = rule_set.dimensions
+    uses_country = "country" in dimensions
+    uses_device = "device" in dimensions
+    uses_referrer = "referrer" in dimensions
+    uses_ip = "ip" in dimensions
+    uses_time = "time" in dimensions
+    uses_draw = "random" in dimensions
+
+    countries: Dict[str, str] = {}
+    devices: Dict[str, str] = {}
+    # dimension values -> rules matching apart from A/B draws
+    viable: Dict[tuple, list] = {}
+    counts: Dict[Optional[int], int] = {}
+    for profile in profiles:
+        ip_address = str(profile.get("ip") or profile.get("ip_address") or "")
+        user_agent = str(profile.get("user_agent") or "")
+        referrer = str(profile.get("referrer") or "").lower() if uses_referrer else ""
+        timestamp = profile.get("timestamp")
+
+        country = device = None
+        if uses_country:
+            country = countries.get(ip_address)
+            if country is None:
+                country = countries[ip_address] = country_of(ip_address)
+        if uses_device:
+            device = devices.get(user_agent)
+            if device is None:
+                device = devices[user_agent] = device_of(user_agent)
+        key = (
+            country,
+            device,
+            referrer,
+            ip_address if uses_ip else None,
+            timestamp if uses_time else None,
+        )
+
+        rules = viable.get(key)
+        if rules is None:
+            now = times[timestamp]
+            context = RequestContext(
+                {
+                    "country": lambda: country,
+                    "device": lambda: device,
+                    "now": lambda: now,
+                    "referrer": lambda: referrer,
+                    "ip": lambda: ip_address,
+                },
+                random.random,
+            )
+            rules = viable[key] = rule_set.viable(context)
+
+        if rules and uses_draw:
+            draws = RequestContext({}, draw_source_of(ip_address, user_agent))
+            rule = rule_set.pick(rules, draws)
+        else:
+            rule = rules[0] if rules else None
+        rule_id = rule.id if rule else None
+        counts[rule_id] = counts.get(rule_id, 0) + 1
+    return counts
@@ -6,16 +6,57 @@ from datetime import datetime, timedelta
 import geoip2.database
 import user_agents
 
+from analytics import visitor_fingerprint
+from archive import VISITS_ARCHIVE_DIR, archive_visits_before
+from cache import cache
 from celery_app import celery_app
-from database import get_db_session
-from models import Url, Visit
+from database import (
+    get_db_session,
+    get_engine,
+    get_shard_count,
+    get_shard_engine,
+    get_shard_session,
+    shard_for_id,
+)
+from lookups import fetch_url_target
+from models import Rule, RuleHit, Url, UrlClickCounter, Visit
+from partitioning import (
+    DEFAULT_PARTITION,
+    default_partition_in_use,
+    drop_expired_partitions,
+    ensure_visit_partitions,
+    is_partitioning_enabled,
+)
+
+# Rows removed per statement when purging a deleted link
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "5000"))
+# Deleted links older than this are purged by the periodic sweep
+PURGE_GRACE_MINUTES = int(os.getenv("PURGE_GRACE_MINUTES", "10"))
+
+
+def shard_session(shard: int):
+    """Get a session on a shard (shard 0 is the main database)."""
+    return get_db_session() if shard == 0 else get_shard_session(shard)
+
+
+def shard_engines():
+    """Get the engines of all shards, the main database first."""
+    return [get_engine()] + [
+        get_shard_engine(shard) for shard in range(1, get_shard_count())
+    ]
 
 
 @celery_app.task(bind=True)
 def log_visit(self, url_id: int, request_data: dict, final_url: str):
     """Log a visit to a URL with analytics data."""
     try:
-        db = get_db_session()
+        # Visits are stored on the shard of their URL
+        db = shard_session(shard_for_id(url_id))
+
+        # Clicks queued before the link was deleted are dropped, so the purge
+        # does not race with new visits and counters
+        if fetch_url_target(db, url_id) is None:
+            return {"status": "skipped"}
 
         # Extract data from request
         ip_address = request_data.get("ip_address", "")
@@ -58,6 +99,7 @@ def log_visit(self, url_id: int, request_data: dict, final_url: str):
             ip_address=ip_address,
             user_agent=user_agent_str,
             referrer=referrer,
+            referrer_host=Visit.normalize_referrer_host(referrer),
             country_code=country_code,
             device_type=device_type,
             browser=browser,
@@ -68,11 +110,16 @@ def log_visit(self, url_id: int, request_data: dict, final_url: str):
         db.add(visit)
         db.commit()
 
-        # Update URL click count
-        url = db.query(Url).filter(Url.id == url_id).first()
-        if url:
-            url.click_count += 1
-            db.commit()
+        # Count the visitor in today's unique-visitor sketch
+        cache.add_unique_visitor(
+            url_id,
+            datetime.utcnow().strftime("%Y-%m-%d"),
+            visitor_fingerprint(ip_address, user_agent_str),
+        )
+
+        # Count the click in a random counter slot of the URL
+        UrlClickCounter.increment(db, url_id)
+        db.commit()
 
         return {"status": "success", "visit_id": visit.id}
 
@@ -93,18 +140,101 @@ def process_analytics(url_id: int):
     pass
 
 
+@celery_app.task
+def backfill_referrer_hosts(batch_size: int = 1000):
+    """Fill referrer_host for visits logged before it was stored at ingest."""
+    db = None
+    try:
+        updated = 0
+        for shard in range(get_shard_count()):
+            db = shard_session(shard)
+            last_id = 0
+
+            while True:
+                rows = (
+                    db.query(Visit.id, Visit.referrer)
+                    .filter(Visit.referrer_host.is_(None), Visit.id > last_id)
+                    .order_by(Visit.id)
+                    .limit(batch_size)
+                    .all()
+                )
+                if not rows:
+                    break
+
+                db.bulk_update_mappings(
+                    Visit,
+                    [
+                        {
+                            "id": visit_id,
+                            "referrer_host": Visit.normalize_referrer_host(referrer),
+                        }
+                        for visit_id, referrer in rows
+                    ],
+                )
+                db.commit()
+
+                updated += len(rows)
+                last_id = rows[-1][0]
+            db.close()
+
+        return {"status": "success", "updated": updated}
+
+    except Exception as e:
+        print(f"Error backfilling referrer hosts: {e}")
+        return {"status": "error", "error": str(e)}
+    finally:
+        if db:
+            db.close()
+
+
 @celery_app.task
 def cleanup_old_visits(days: int = 90):
-    """Clean up old visit records (older than specified days)."""
+    """Clean up old visit records (older than specified days).
+
+    When VISITS_ARCHIVE_DIR is set the visits are first written to the
+    columnar archive, so history survives the cleanup.
+    """
     db = None
     try:
-        db = get_db_session()
         cutoff_date = datetime.utcnow() - timedelta(days=days)
+        archived_segments = []
+        dropped_partitions = []
+        deleted_count = 0
 
-        deleted_count = db.query(Visit).filter(Visit.created_at < cutoff_date).delete()
+        for shard in range(get_shard_count()):
+            db = shard_session(shard)
 
-        db.commit()
-        return {"status": "success", "deleted": deleted_count}
+            # Keep long-term history in the columnar archive before removing rows
+            if VISITS_ARCHIVE_DIR:
+                archived_segments += archive_visits_before(db, cutoff_date, shard=shard)
+                # End the read transaction: its locks on visits would block
+                # the DETACH PARTITION below, which runs on another connection
+                db.commit()
+
+            # Whole expired months are dropped as partitions, not row deletes
+            engine = db.get_bind()
+            if is_partitioning_enabled(engine):
+                dropped_partitions += drop_expired_partitions(engine, cutoff_date)
+                ensure_visit_partitions(engine)
+
+            # Remaining expired rows live in the partially expired boundary month
+            deleted_count += (
+                db.query(Visit).filter(Visit.created_at < cutoff_date).delete()
+            )
+
+            db.commit()
+            db.close()
+
+        # Cached analytics only ever fold in new visits, so drop them all
+        if deleted_count or dropped_partitions:
+            cache.invalidate_analytics_data()
+
+        result = {"status": "success", "deleted": deleted_count}
+        if dropped_partitions:
+            result["dropped_partitions"] = dropped_partitions
+        if archived_segments:
+            result["archived_segments"] = archived_segments
+        return result
 
     except Exception as e:
         print(f"Error cleaning up visits: {e}")
@@ -112,3 +242,208 @@ def cleanup_old_visits(days: int = 90):
     finally:
         if db:
             db.close()
+
+
+@celery_app.task
+def flush_rule_hits(batch_size: int = 1000):
+    """Add the per-rule redirect counts collected in Redis to rule_hits."""
+    db = None
+    drained = {}
+    try:
+        flushed = 0
+
+        while True:
+            drained = cache.drain_rule_hits(batch_size)
+            if not drained:
+                break
+
+            # Counts are added on the shard of their URL
+            by_shard = {}
+            for url_id in drained:
+                by_shard.setdefault(shard_for_id(url_id), []).append(url_id)
+
+            for shard, url_ids in sorted(by_shard.items()):
+                db = shard_session(shard)
+                # Counts of links deleted in the meantime are dropped
+                existing = {
+                    url_id
+                    for (url_id,) in db.query(Url.id).filter(
+                        Url.id.in_(url_ids), Url.deleted_at.is_(None)
+                    )
+                }
+                rows = {
+                    (row.url_id, row.rule_key): row
+                    for row in db.query(RuleHit).filter(RuleHit.url_id.in_(existing))
+                }
+                for url_id in existing:
+                    for rule_key, count in drained[url_id].items():
+                        row = rows.get((url_id, rule_key))
+                        if row is None:
+                            db.add(
+                                RuleHit(url_id=url_id, rule_key=rule_key, hits=count)
+                            )
+                        else:
+                            row.hits += count
+                        flushed += count
+                db.commit()
+                db.close()
+                db = None
+                # Only counts not yet committed go back to Redis on failure
+                for url_id in url_ids:
+                    del drained[url_id]
+
+        return {"status": "success", "flushed": flushed}
+
+    except Exception as e:
+        print(f"Error flushing rule hits: {e}")
+        if db:
+            db.rollback()
+        cache.restore_rule_hits(drained)
+        return {"status": "error", "error": str(e)}
+    finally:
+        if db:
+            db.close()
+
+
+@celery_app.task
+def compact_click_counters(batch_size: int = 1000):
+    """Fold the click counter slots of every shard into urls.click_count."""
+    db = None
+    try:
+        folded = 0
+        for shard in range(get_shard_count()):
+            db = shard_session(shard)
+            folded += UrlClickCounter.compact(db, batch_size)
+            db.close()
+            db = None
+
+        return {"status": "success", "folded": folded}
+
+    except Exception as e:
+        print(f"Error compacting click counters: {e}")
+        if db:
+            db.rollback()
+        return {"status": "error", "error": str(e)}
+    finally:
+        if db:
+            db.close()
+
+
+def purge_url_rows(db, url_id: int, batch_size: int) -> dict:
+    """Delete the rows of a deleted link in batches, then the link itself.
+
+    Each batch is its own transaction, so no statement holds locks on
+    millions of visits.
+    """
+    deleted = {}
+    for model in (Visit, RuleHit, Rule, UrlClickCounter):
+        count = 0
+        while True:
+            ids = [
+                row_id
+                for (row_id,) in db.query(model.id)
+                .filter(model.url_id == url_id)
+                .limit(batch_size)
+            ]
+            if not ids:
+                break
+            db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+            count += len(ids)
+        deleted[model.__tablename__] = count
+
+    db.query(Url).filter(Url.id == url_id, Url.deleted_at.isnot(None)).delete(
+        synchronize_session=False
+    )
+    db.commit()
+    return deleted
+
+
+@celery_app.task(bind=True)
+def purge_deleted_url(self, url_id: int, batch_size: int = PURGE_BATCH_SIZE):
+    """Remove a deleted link with its visits, rule hits, rules and counters."""
+    db = None
+    try:
+        db = shard_session(shard_for_id(url_id))
+        url = db.query(Url).filter(Url.id == url_id).first()
+        if url is None or url.deleted_at is None:
+            return {"status": "skipped"}
+        short_code, created_at = url.short_code, url.created_at
+
+        deleted = purge_url_rows(db, url_id, batch_size)
+
+        # Redis keys of the link (a redirect racing the deletion may also have
+        # cached the link again)
+        cache.delete_url_keys(url_id, short_code, created_at)
+        return {"status": "success", "deleted": deleted}
+
+    except Exception as e:
+        print(f"Error purging link {url_id}: {e}")
+        if db:
+            db.rollback()
+        self.retry(countdown=60, max_retries=3)
+        return {"status": "error", "error": str(e)}
+    finally:
+        if db:
+            db.close()
+
+
+@celery_app.task
+def purge_deleted_urls(batch_size: int = PURGE_BATCH_SIZE):
+    """Purge links deleted a while ago whose purge task was lost."""
+    db = None
+    try:
+        cutoff = datetime.utcnow() - timedelta(minutes=PURGE_GRACE_MINUTES)
+        purged = 0
+        for shard in range(get_shard_count()):
+            db = shard_session(shard)
+            urls = (
+                db.query(Url.id, Url.short_code, Url.created_at)
+                .filter(Url.deleted_at.isnot(None), Url.deleted_at < cutoff)
+                .all()
+            )
+            for url_id, short_code, created_at in urls:
+                purge_url_rows(db, url_id, batch_size)
+                cache.delete_url_keys(url_id, short_code, created_at)
+                purged += 1
+            db.close()
+            db = None
+
+        return {"status": "success", "purged": purged}
+
+    except Exception as e:
+        print(f"Error purging deleted links: {e}")
+        if db:
+            db.rollback()
+        return {"status": "error", "error": str(e)}
+    finally:
+        if db:
+            db.close()
+
+
+@celery_app.task
+def maintain_visit_partitions():
+    """Create upcoming monthly partitions of the visits table on every shard."""
+    try:
+        engines = [
+            engine for engine in shard_engines() if is_partitioning_enabled(engine)
+        ]
+        if not engines:
+            return {"status": "skipped"}
+
+        created = []
+        result = {"status": "success", "created": created}
+        for engine in engines:
+            created += ensure_visit_partitions(engine)
+            # Visits in the default partition mean maintenance fell behind
+            if default_partition_in_use(engine):
+                print(
+                    f"Warning: visits outside monthly partitions in "
+                    f"{DEFAULT_PARTITION} on {engine.url.database}"
+                )
+                result["default_partition_in_use"] = True
+        return result
+
+    except Exception as e:
+        print(f"Error maintaining visit partitions: {e}")
+        return {"status": "error", "error": str(e)}
@@ -7,3 +7,11 @@ import pytest
 def cleanup_global_database_state(monkeypatch):
     """Reset global database engine state before each test to prevent leaks."""
     monkeypatch.setattr("database._engine", None)
+
+
+@pytest.fixture(autouse=True, scope="function")
+def clear_rule_cache():
+    """Drop compiled routing rules cached by earlier tests."""
+    from routing import rule_cache
+
+    rule_cache.clear()
@@ -0,0 +1,321 @@
+"""Unit tests for analytics aggregation."""
+
+import random
+from datetime import date, datetime, timedelta
+from unittest.mock import ANY, patch
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from analytics import (
+    RECOMPUTE_SECONDS,
+    aggregate_grouped,
+    aggregate_vectorized,
+    analytics_etag,
+    build_analytics_payload,
+    compute_aggregates,
+    get_cached_aggregates,
+    recent_visits,
+    unique_visitor_series,
+    visitor_fingerprint,
+)
+from models import Base, Url, Visit
+
+
+@pytest.fixture(scope="function")
+def test_db(monkeypatch):
+    """Create a test database in memory."""
+    # Clear global engine state to prevent connection leaks
+    monkeypatch.setattr("database._engine", None)
+
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+        echo=False,
+    )
+
+    # Create tables
+    Base.metadata.create_all(bind=engine)
+
+    # Create session
+    session_factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = session_factory()
+
+    try:
+        yield db
+    finally:
+        db.close()
+        # Dispose engine to close connections
+        engine.dispose()
+        Base.metadata.drop_all(bind=engine)
+
+
+def add_visits(db, url_id, start, count, **fields):
+    """Add visits 13 hours apart starting at the given datetime."""
+    for i in range(count):
+        db.add(
+            Visit(url_id=url_id, created_at=start + timedelta(hours=i * 13), **fields)
+        )
+    db.commit()
+
+
+class TestAggregates:
+    """Test cases for analytics aggregation."""
+
+    def test_compute_aggregates(self, test_db):
+        """Test full aggregation of a link's visits."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        start = datetime(2025, 1, 1, 10, 0, 0)
+        add_visits(
+            test_db,
+            url.id,
+            start,
+            3,
+            device_type="mobile",
+            country_code="FR",
+            referrer_host="google.com",
+        )
+        add_visits(test_db, url.id, start, 1)
+
+        aggregates = compute_aggregates(test_db, url)
+
+        assert aggregates["devices"] == {"mobile": 3, "unknown": 1}
+        assert aggregates["countries"] == {"FR": 3, "XX": 1}
+        assert aggregates["referrers"] == {"google.com": 3, "direct": 1}
+        assert list(aggregates["clicks_over_time"]) == [
+            "2025-01-02",
+            "2025-01-01",
+        ]
+        assert "visits" not in aggregates
+
+    def test_referrers_come_from_group_by(self, test_db):
+        """Test the referrer breakdown is one GROUP BY, not a per-row fetch."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        add_visits(test_db, url.id, datetime(2025, 1, 1), 3, referrer_host="t.co")
+        add_visits(test_db, url.id, datetime(2025, 1, 1), 2, referrer_host="")
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        engine = test_db.get_bind()
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            aggregates = compute_aggregates(test_db, url)
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+
+        referrer_queries = [sql for sql in statements if "referrer_host" in sql]
+        assert len(referrer_queries) == 1
+        assert "GROUP BY" in referrer_queries[0]
+        assert aggregates["referrers"] == {"t.co": 3, "direct": 2}
+
+    def test_recent_visits_are_paged(self, test_db):
+        """Test the visits table is read one bounded page at a time."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        add_visits(test_db, url.id, datetime(2025, 1, 1), 5, browser="Firefox")
+
+        first = recent_visits(test_db, url, limit=2)
+        last = recent_visits(test_db, url, limit=2, offset=4)
+
+        assert [(visit["date"], visit["time"]) for visit in first] == [
+            ("2025-01-03", "04:00:00"),
+            ("2025-01-02", "15:00:00"),
+        ]
+        assert first[0]["browser"] == "Firefox"
+        assert first[0]["referrer"] == "direct"
+        assert first[0]["target_url"] == "https://example.com"
+        assert [visit["time"] for visit in last] == ["00:00:00"]
+        with patch("analytics.MAX_RECENT_VISITS_LIMIT", 3):
+            assert len(recent_visits(test_db, url, limit=100)) == 3
+
+    def test_incremental_fold_matches_full_recompute(self, test_db):
+        """Test folding new visits gives the same result as recomputing."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        add_visits(test_db, url.id, datetime(2025, 1, 1), 3, device_type="desktop")
+
+        stored = {}
+        with patch("analytics.cache") as mock_cache:
+            mock_cache.get_analytics_data.side_effect = lambda url_id: stored.get(
+                url_id
+            )
+            mock_cache.set_analytics_data.side_effect = (
+                lambda url_id, data, *args, **kwargs: stored.__setitem__(url_id, data)
+            )
+
+            get_cached_aggregates(test_db, url)
+            add_visits(
+                test_db,
+                url.id,
+                datetime(2025, 1, 3),
+                2,
+                device_type="mobile",
+                referrer_host="t.co",
+            )
+            incremental = get_cached_aggregates(test_db, url)
+
+        assert incremental == compute_aggregates(test_db, url)
+        assert mock_cache.set_analytics_data.call_count == 2
+
+    def test_late_visit_counted_by_recompute(self, test_db):
+        """Test folds keep the expiry so late commits are counted on recompute."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        day = datetime(2025, 1, 1)
+        test_db.add(Visit(id=10, url_id=url.id, created_at=day))
+        test_db.commit()
+
+        with patch("analytics.cache") as mock_cache:
+            mock_cache.get_analytics_data.return_value = None
+            get_cached_aggregates(test_db, url)
+            mock_cache.set_analytics_data.assert_called_with(
+                url.id, ANY, RECOMPUTE_SECONDS
+            )
+
+            # Visit 5 was logged earlier but committed after visit 11
+            test_db.add_all(
+                [
+                    Visit(id=5, url_id=url.id, created_at=day),
+                    Visit(id=11, url_id=url.id, created_at=day),
+                ]
+            )
+            test_db.commit()
+            mock_cache.get_analytics_data.return_value = (
+                mock_cache.set_analytics_data.call_args.args[1]
+            )
+            folded = get_cached_aggregates(test_db, url)
+            mock_cache.set_analytics_data.assert_called_with(url.id, ANY, keep_ttl=True)
+
+            # The entry expired: the recompute counts every visit
+            mock_cache.get_analytics_data.return_value = None
+            recomputed = get_cached_aggregates(test_db, url)
+
+        assert folded["clicks_over_time"] == {"2025-01-01": 2}
+        assert recomputed["clicks_over_time"] == {"2025-01-01": 3}
+
+    def test_cached_aggregates_without_new_visits(self, test_db):
+        """Test cached aggregates are reused when nothing changed."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        add_visits(test_db, url.id, datetime(2025, 1, 1), 2)
+        cached = compute_aggregates(test_db, url)
+
+        with patch("analytics.cache") as mock_cache:
+            mock_cache.get_analytics_data.return_value = cached
+            result = get_cached_aggregates(test_db, url)
+
+        assert result == cached
+        mock_cache.set_analytics_data.assert_not_called()
+
+    def test_etag_changes_with_new_visits(self, test_db):
+        """Test ETag depends on the high-water mark."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        before = compute_aggregates(test_db, url)
+        add_visits(test_db, url.id, datetime(2025, 1, 1), 1)
+        after = compute_aggregates(test_db, url)
+
+        assert analytics_etag(url, before) != analytics_etag(url, after)
+
+    def test_build_analytics_payload(self, test_db):
+        """Test payload keeps the analytics API response shape."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        add_visits(test_db, url.id, datetime(2025, 1, 1), 2)
+
+        payload = build_analytics_payload(
+            url, compute_aggregates(test_db, url), recent_visits(test_db, url)
+        )
+
+        assert set(payload) == {
+            "url_info",
+            "clicks_over_time",
+            "devices",
+            "countries",
+            "referrers",
+            "visits",
+        }
+        assert payload["clicks_over_time"] == {
+            "labels": ["2025-01-01"],
+            "data": [2],
+        }
+        assert len(payload["visits"]) == 2
+
+
+class TestUniqueVisitors:
+    """Test cases for HyperLogLog unique visitor series."""
+
+    def test_visitor_fingerprint(self):
+        """Test fingerprints are stable and do not expose the raw IP."""
+        first = visitor_fingerprint("10.0.0.1", "Mozilla/5.0")
+
+        assert first == visitor_fingerprint("10.0.0.1", "Mozilla/5.0")
+        assert first != visitor_fingerprint("10.0.0.2", "Mozilla/5.0")
+        assert "10.0.0.1" not in first
+
+    def test_series_groups_days_into_periods(self):
+        """Test weekly and monthly periods merge their daily sketches."""
+        with patch("analytics.cache") as mock_cache:
+            mock_cache.count_unique_visitors.side_effect = lambda url_id, groups: [
+                len(group) for group in groups
+            ]
+            series = unique_visitor_series(1, today=date(2025, 3, 5))
+
+        assert mock_cache.count_unique_visitors.call_count == 1
+        assert series["daily"]["labels"][-1] == "2025-03-05"
+        assert series["daily"]["data"] == [1] * 30
+        # 2025-03-05 is a Wednesday of ISO week 10
+        assert series["weekly"]["labels"][-1] == "2025-W10"
+        assert series["weekly"]["data"][-2:] == [7, 3]
+        assert series["monthly"]["labels"] == [
+            "2024-10",
+            "2024-11",
+            "2024-12",
+            "2025-01",
+            "2025-02",
+            "2025-03",
+        ]
+        assert series["monthly"]["data"][-2:] == [28, 5]
+        assert series["last_30_days"] == 30
+
+
+class TestVectorizedAggregation:
+    """Test cases for the NumPy aggregation path."""
+
+    def test_matches_row_aggregation(self, test_db):
+        """Test vectorized aggregates equal the GROUP BY aggregates."""
+        pytest.importorskip("numpy")
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        rng = random.Random(42)
+        start = datetime(2025, 1, 1)
+        for _ in range(500):
+            test_db.add(
+                Visit(
+                    url_id=url.id,
+                    created_at=start + timedelta(minutes=rng.randint(0, 20000)),
+                    device_type=rng.choice(["mobile", "desktop", "tablet", None, ""]),
+                    country_code=rng.choice(["FR", "US", "DE", None]),
+                    referrer_host=rng.choice(["google.com", "t.co", "direct", None]),
+                    ip_address=rng.choice(["10.0.0.1", None]),
+                    browser=rng.choice(["Chrome", "", None]),
+                    final_url=rng.choice(["https://example.com/b", None]),
+                )
+            )
+        test_db.commit()
+
+        with patch("analytics.FETCH_CHUNK_ROWS", 64):
+            vectorized = aggregate_vectorized(test_db, url)
+
+        assert vectorized == aggregate_grouped(test_db, url)
+
+    def test_compute_aggregates_dispatch(self, test_db):
+        """Test large links use the vectorized path."""
+        pytest.importorskip("numpy")
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        url.click_count = 10
+
+        with patch("analytics.VECTORIZE_MIN_CLICKS", 5), patch(
+            "analytics.aggregate_vectorized"
+        ) as mock_vectorized:
+            compute_aggregates(test_db, url)
+
+        mock_vectorized.assert_called_once()
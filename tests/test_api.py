@@ -144,6 +144,24 @@ class TestAPIEndpoints:
         assert response.status_code == 302
         assert response.headers["Location"] == "https://example.com/test"
 
+    def test_redirect_without_rules_skips_rule_queries(self, client):
+        """Test a link without rules is redirected without loading rules."""
+        from routing import rule_cache
+
+        data = {"original_url": "https://example.com/test"}
+        create_response = client.post(
+            "/api/shorten", data=json.dumps(data), content_type="application/json"
+        )
+        create_data = json.loads(create_response.data)
+
+        with patch("routing.fetch_active_rules") as mock_fetch_rules:
+            response = client.get(f"/{create_data['short_code']}")
+
+        assert response.status_code == 302
+        assert response.headers["Location"] == "https://example.com/test"
+        mock_fetch_rules.assert_not_called()
+        assert rule_cache.get(int(create_data["id"])).rules == []
+
     def test_redirect_not_found(self, client):
         """Test redirect for non-existing URL."""
         response = client.get("/nonexistent")
@@ -177,6 +195,98 @@ class TestAPIEndpoints:
         assert create_response.status_code == 201
         assert short_code is not None
 
+    def test_info_adds_click_counter_slots(self, client):
+        """Test the click count includes clicks not yet compacted."""
+        from sqlalchemy.orm import Session
+
+        import database
+        from models import Url, UrlClickCounter
+
+        data = {"original_url": "https://example.com/test"}
+        create_response = client.post(
+            "/api/shorten", data=json.dumps(data), content_type="application/json"
+        )
+        short_code = json.loads(create_response.data)["short_code"]
+        with Session(database.get_engine()) as db:
+            url = Url.get_by_short_code(db, short_code)
+            url.click_count = 2
+            for _ in range(3):
+                UrlClickCounter.increment(db, url.id)
+            db.commit()
+
+        info_response = client.get(f"/api/info/{short_code}")
+
+        assert json.loads(info_response.data)["data"]["click_count"] == 5
+
+    @patch("main.DATABASE_REPLICA_URL", "sqlite:///:memory:")
+    def test_write_sets_primary_cookie(self, client):
+        """Test a write makes the client read from the primary for a while."""
+        data = {"original_url": "https://example.com/test"}
+        response = client.post(
+            "/api/shorten", data=json.dumps(data), content_type="application/json"
+        )
+        assert response.status_code == 201
+        assert "db_primary_until=" in response.headers["Set-Cookie"]
+
+        response = client.get("/api/version")
+        assert "Set-Cookie" not in response.headers
+
+    def test_reads_through_replica(self, client, monkeypatch, tmp_path):
+        """Test info and redirects read from the replica without the cookie."""
+        from sqlalchemy import create_engine
+
+        import database
+        from models import Url
+
+        replica = create_engine(f"sqlite:///{tmp_path}/replica.db")
+        Base.metadata.create_all(bind=replica)
+        # The replica mirrors the primary
+        for engine in (database.get_engine(), replica):
+            with engine.begin() as connection:
+                connection.execute(
+                    Url.__table__.insert(),
+                    {"short_code": "onrepl", "original_url": "https://replica.example"},
+                )
+        monkeypatch.setattr("database._replica_engine", replica)
+        monkeypatch.setattr("database.DATABASE_REPLICA_URL", "sqlite://")
+        monkeypatch.setattr("main.DATABASE_REPLICA_URL", "sqlite://")
+        monkeypatch.setattr("database._replica_skip_until", 0.0)
+        monkeypatch.setattr("database._replica_checked_at", 0.0)
+
+        response = client.get("/api/info/onrepl")
+        assert response.status_code == 200
+        assert json.loads(response.data)["data"]["original_url"] == (
+            "https://replica.example"
+        )
+
+        response = client.get("/onrepl")
+        assert response.status_code == 302
+        assert response.headers["Location"] == "https://replica.example"
+        replica.dispose()
+
+    def test_get_replica_status(self, client):
+        """Test replica status requires a token and reports no replica."""
+        response = client.get("/api/db/replica")
+        assert response.status_code == 401
+
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(
+                {
+                    "username": "replicauser",
+                    "email": "replica@example.com",
+                    "password": "testpass123",
+                }
+            ),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        response = client.get(
+            "/api/db/replica", headers={"Authorization": f"Bearer {token}"}
+        )
+        assert response.status_code == 200
+        assert json.loads(response.data) == {"success": True, "replica": False}
+
     def test_get_version(self, client):
         """Test version endpoint."""
         response = client.get("/api/version")
@@ -285,6 +395,533 @@ class TestAPIEndpoints:
         assert url_info["short_code"] == short_code
         assert url_info["original_url"] == "https://example.com/analytics-test"
 
+    def test_get_analytics_not_modified(self, client):
+        """Test analytics revalidation returns 304 for an unchanged ETag."""
+        register_data = {
+            "username": "etaguser",
+            "email": "etag@example.com",
+            "password": "testpass123",
+        }
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(register_data),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        create_response = client.post(
+            "/api/shorten",
+            data=json.dumps({"original_url": "https://example.com/etag"}),
+            content_type="application/json",
+            headers=headers,
+        )
+        short_code = json.loads(create_response.data)["short_code"]
+
+        response = client.get(f"/api/analytics/{short_code}", headers=headers)
+        assert response.status_code == 200
+        etag = response.headers["ETag"]
+
+        response = client.get(
+            f"/api/analytics/{short_code}",
+            headers={**headers, "If-None-Match": etag},
+        )
+        assert response.status_code == 304
+        assert response.data == b""
+
+    def test_get_trending(self, client):
+        """Test trending links are read from the cache."""
+        register_data = {
+            "username": "trenduser",
+            "email": "trend@example.com",
+            "password": "testpass123",
+        }
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(register_data),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+
+        with patch("main.cache.get_trending") as mock_trending:
+            mock_trending.return_value = [("abc123", 5.0), ("xyz789", 1.25)]
+            response = client.get(
+                "/api/trending?limit=500",
+                headers={"Authorization": f"Bearer {token}"},
+            )
+
+        assert response.status_code == 200
+        trending = json.loads(response.data)["trending"]
+        assert [link["short_code"] for link in trending] == ["abc123", "xyz789"]
+        assert trending[0]["short_url"].endswith("/abc123")
+        mock_trending.assert_called_once_with(100)
+
+    def test_get_analytics_timeseries(self, client):
+        """Test per-minute click series for the last hour."""
+        register_data = {
+            "username": "seriesuser",
+            "email": "series@example.com",
+            "password": "testpass123",
+        }
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(register_data),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        create_response = client.post(
+            "/api/shorten",
+            data=json.dumps({"original_url": "https://example.com/series"}),
+            content_type="application/json",
+            headers=headers,
+        )
+        short_code = json.loads(create_response.data)["short_code"]
+
+        response = client.get(
+            f"/api/analytics/{short_code}/timeseries?window=7d", headers=headers
+        )
+        assert response.status_code == 400
+
+        with patch("main.cache.get_click_series") as mock_series:
+            mock_series.return_value = [1] * 60
+            response = client.get(
+                f"/api/analytics/{short_code}/timeseries", headers=headers
+            )
+
+        assert response.status_code == 200
+        timeseries = json.loads(response.data)["timeseries"]
+        assert len(timeseries["labels"]) == 60
+        assert timeseries["data"] == [1] * 60
+        assert mock_series.call_args.args[:2] == (short_code, 60)
+
+    def test_create_rule_with_conditions(self, client):
+        """Test rules accept AND-combined conditions and validate them."""
+        register_data = {
+            "username": "ruleuser",
+            "email": "rule@example.com",
+            "password": "testpass123",
+        }
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(register_data),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        create_response = client.post(
+            "/api/shorten",
+            data=json.dumps({"original_url": "https://example.com/rules"}),
+            content_type="application/json",
+            headers=headers,
+        )
+        url_id = json.loads(create_response.data)["id"]
+        rule_data = {
+            "url_id": url_id,
+            "rule_type": "country",
+            "condition_value": "FR",
+            "target_url": "https://example.com/fr-mobile",
+            "conditions": [{"type": "device", "value": "mobile"}],
+        }
+
+        response = client.post(
+            "/api/rules",
+            data=json.dumps(rule_data),
+            content_type="application/json",
+            headers=headers,
+        )
+        assert response.status_code == 201
+        rule = json.loads(response.data)["rule"]
+        assert rule["conditions"] == [{"type": "device", "value": "mobile"}]
+
+        rule_data["conditions"] = [{"type": "device", "value": "watch"}]
+        response = client.post(
+            "/api/rules",
+            data=json.dumps(rule_data),
+            content_type="application/json",
+            headers=headers,
+        )
+        assert response.status_code == 400
+
+        rule_data["conditions"] = [{"type": "ip", "value": "10.0.0.0/8, 10.0.0.0/40"}]
+        response = client.post(
+            "/api/rules",
+            data=json.dumps(rule_data),
+            content_type="application/json",
+            headers=headers,
+        )
+        assert response.status_code == 400
+        assert "10.0.0.0/40" in json.loads(response.data)["error"]
+
+    def test_rule_changes_bump_rules_version(self, client):
+        """Test rule changes bump the Redis version other processes check."""
+        register_data = {
+            "username": "versionuser",
+            "email": "version@example.com",
+            "password": "testpass123",
+        }
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(register_data),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        create_response = client.post(
+            "/api/shorten",
+            data=json.dumps({"original_url": "https://example.com/version"}),
+            content_type="application/json",
+            headers=headers,
+        )
+        create_data = json.loads(create_response.data)
+        rule_data = {
+            "url_id": create_data["id"],
+            "rule_type": "country",
+            "condition_value": "FR",
+            "target_url": "https://example.com/fr",
+        }
+
+        with patch("main.cache.bump_rules_version") as mock_bump:
+            response = client.post(
+                "/api/rules",
+                data=json.dumps(rule_data),
+                content_type="application/json",
+                headers=headers,
+            )
+            rule_id = json.loads(response.data)["rule"]["id"]
+            client.delete(f"/api/rules/{rule_id}", headers=headers)
+
+        assert [c.args for c in mock_bump.call_args_list] == [
+            (create_data["short_code"],),
+            (create_data["short_code"],),
+        ]
+
+    def test_get_rules_hits(self, client):
+        """Test rule listing reports hit counts and shares per rule."""
+        register_data = {
+            "username": "hitsuser",
+            "email": "hits@example.com",
+            "password": "testpass123",
+        }
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(register_data),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        create_response = client.post(
+            "/api/shorten",
+            data=json.dumps({"original_url": "https://example.com/hits"}),
+            content_type="application/json",
+            headers=headers,
+        )
+        create_data = json.loads(create_response.data)
+        rule_response = client.post(
+            "/api/rules",
+            data=json.dumps(
+                {
+                    "url_id": create_data["id"],
+                    "rule_type": "referrer",
+                    "condition_value": "t.co",
+                    "target_url": "https://example.com/twitter",
+                }
+            ),
+            content_type="application/json",
+            headers=headers,
+        )
+        rule_id = json.loads(rule_response.data)["rule"]["id"]
+
+        with patch("main.cache") as mock_cache:
+            mock_cache.get_redirect_data.return_value = (None, None)
+            client.get(f"/{create_data['short_code']}", headers={"Referer": "t.co/x"})
+            mock_cache.record_click.assert_called_once_with(
+                create_data["short_code"],
+                url_id=create_data["id"],
+                rule_key=str(rule_id),
+            )
+
+            mock_cache.get_rule_hits.return_value = {str(rule_id): 3, "default": 1}
+            response = client.get(f"/api/rules/{create_data['id']}", headers=headers)
+
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data["rules"][0]["hits"] == 3
+        assert data["rules"][0]["share"] == 0.75
+        assert data["hits"] == {"total": 4, "default": 1, "default_share": 0.25}
+
+    def test_simulate_rules(self, client):
+        """Test rule simulation returns the target distribution of profiles."""
+        register_data = {
+            "username": "simuser",
+            "email": "sim@example.com",
+            "password": "testpass123",
+        }
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(register_data),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        create_response = client.post(
+            "/api/shorten",
+            data=json.dumps({"original_url": "https://example.com/sim"}),
+            content_type="application/json",
+            headers=headers,
+        )
+        url_id = json.loads(create_response.data)["id"]
+        client.post(
+            "/api/rules",
+            data=json.dumps(
+                {
+                    "url_id": url_id,
+                    "rule_type": "ip",
+                    "condition_value": "10.0.0.0/8",
+                    "target_url": "https://example.com/office",
+                }
+            ),
+            content_type="application/json",
+            headers=headers,
+        )
+        profiles = [{"ip": "10.0.0.1", "timestamp": "2025-01-06T12:00:00Z"}] * 3
+        profiles.append({"ip": "192.168.0.1", "referrer": "https://t.co/x"})
+
+        with patch("main.log_visit") as mock_log_visit, patch(
+            "main.cache"
+        ) as mock_cache:
+            response = client.post(
+                f"/api/rules/{url_id}/simulate",
+                data=json.dumps({"profiles": profiles}),
+                content_type="application/json",
+                headers=headers,
+            )
+        mock_log_visit.delay.assert_not_called()
+        mock_cache.record_click.assert_not_called()
+        # The redirect's rule cache is left alone
+        from routing import rule_cache
+
+        assert rule_cache.get(url_id) is None
+
+        assert response.status_code == 200
+        data = json.loads(response.data)
+        assert data["profiles"] == 4
+        assert [(t["target_url"], t["count"]) for t in data["targets"]] == [
+            ("https://example.com/office", 3),
+            ("https://example.com/sim", 1),
+        ]
+        assert data["targets"][0]["share"] == 0.75
+
+        response = client.post(
+            f"/api/rules/{url_id}/simulate",
+            data=json.dumps({"profiles": [{"timestamp": "yesterday"}]}),
+            content_type="application/json",
+            headers=headers,
+        )
+        assert response.status_code == 400
+
+        with patch("main.SIMULATION_MAX_BYTES", 100):
+            response = client.post(
+                f"/api/rules/{url_id}/simulate",
+                data=json.dumps({"profiles": profiles * 10}),
+                content_type="application/json",
+                headers=headers,
+            )
+        assert response.status_code == 413
+
+    def test_delete_url_hides_link_and_queues_purge(self, client):
+        """Test deletion marks the link, evicts caches and defers the purge."""
+        from sqlalchemy.orm import Session
+
+        import database
+        from models import Url
+
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(
+                {
+                    "username": "deleteuser",
+                    "email": "delete@example.com",
+                    "password": "testpass123",
+                }
+            ),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        create_response = client.post(
+            "/api/shorten",
+            data=json.dumps({"original_url": "https://example.com/gone"}),
+            content_type="application/json",
+            headers=headers,
+        )
+        link = json.loads(create_response.data)
+
+        with patch("main.purge_deleted_url") as mock_purge, patch(
+            "main.cache"
+        ) as mock_cache:
+            response = client.delete(f"/api/urls/{link['id']}", headers=headers)
+
+        assert response.status_code == 200
+        mock_purge.delay.assert_called_once_with(link["id"])
+        mock_cache.invalidate_url.assert_called_once_with(link["short_code"])
+        mock_cache.invalidate_analytics_data.assert_called_once_with(link["id"])
+        mock_cache.remove_trending.assert_called_once_with(link["short_code"])
+        mock_cache.delete_rule_hits.assert_called_once_with(link["id"])
+
+        # The row stays until the purge task, but nothing resolves it
+        with Session(database.get_engine()) as db:
+            assert db.query(Url).get(link["id"]).deleted_at is not None
+        assert client.get(f"/{link['short_code']}").status_code == 404
+        assert client.get(f"/api/info/{link['short_code']}").status_code == 404
+        response = client.get("/api/my-links", headers=headers)
+        assert json.loads(response.data)["links"] == []
+        with patch("main.purge_deleted_url"):
+            response = client.delete(f"/api/urls/{link['id']}", headers=headers)
+        assert response.status_code == 404
+
+    @patch("main.LIVE_STREAM_SERVER", True)
+    def test_stream_analytics_unauthorized(self, client):
+        """Test live stream requires a token."""
+        response = client.get("/api/analytics/test123/stream")
+        assert response.status_code == 401
+        response = client.post("/api/analytics/test123/stream-token")
+        assert response.status_code == 401
+
+    @patch("main.LIVE_STREAM_SERVER", True)
+    @patch("main.LIVE_STREAM_SECONDS", 0.5)
+    def test_stream_analytics(self, client):
+        """Test live stream sends per-second click counts."""
+        register_data = {
+            "username": "streamuser",
+            "email": "stream@example.com",
+            "password": "testpass123",
+        }
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(register_data),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        create_response = client.post(
+            "/api/shorten",
+            data=json.dumps({"original_url": "https://example.com/stream"}),
+            content_type="application/json",
+            headers=headers,
+        )
+        short_code = json.loads(create_response.data)["short_code"]
+
+        response = client.post(
+            f"/api/analytics/{short_code}/stream-token", headers=headers
+        )
+        assert response.status_code == 200
+        stream = json.loads(response.data)
+        assert stream["stream_url"] == (
+            f"/api/analytics/{short_code}/stream?token={stream['token']}"
+        )
+
+        with patch("main.click_hub") as mock_hub:
+            mock_hub.subscribe.return_value.drain.return_value = 3
+            response = client.get(stream["stream_url"])
+            body = response.get_data(as_text=True)
+
+        assert response.status_code == 200
+        assert response.mimetype == "text/event-stream"
+        assert "event: clicks" in body
+        assert '"count": 3' in body
+        mock_hub.subscribe.assert_called_once_with(short_code)
+        mock_hub.unsubscribe.assert_called_once()
+
+    @patch("main.LIVE_STREAM_SERVER", True)
+    def test_stream_token_scope(self, client):
+        """Test stream and API tokens cannot stand in for each other."""
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(
+                {
+                    "username": "scopeuser",
+                    "email": "scope@example.com",
+                    "password": "testpass123",
+                }
+            ),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        short_code = json.loads(
+            client.post(
+                "/api/shorten",
+                data=json.dumps({"original_url": "https://example.com/scope"}),
+                content_type="application/json",
+                headers=headers,
+            ).data
+        )["short_code"]
+        stream_token = json.loads(
+            client.post(
+                f"/api/analytics/{short_code}/stream-token", headers=headers
+            ).data
+        )["token"]
+
+        # The API token is not accepted by the stream
+        response = client.get(f"/api/analytics/{short_code}/stream?token={token}")
+        assert response.status_code == 401
+        # The stream token opens only the stream of its own link
+        response = client.get(f"/api/analytics/other1/stream?token={stream_token}")
+        assert response.status_code == 401
+        # The stream token is not an API token
+        response = client.get(
+            "/api/my-links", headers={"Authorization": f"Bearer {stream_token}"}
+        )
+        assert response.status_code == 401
+        # Only the owner gets a stream token
+        response = client.post("/api/analytics/missing1/stream-token", headers=headers)
+        assert response.status_code == 404
+
+    def test_web_process_refuses_streams(self, client):
+        """Test streams are refused unless the stream process serves them."""
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(
+                {
+                    "username": "webstream",
+                    "email": "webstream@example.com",
+                    "password": "testpass123",
+                }
+            ),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+        short_code = json.loads(
+            client.post(
+                "/api/shorten",
+                data=json.dumps({"original_url": "https://example.com/web"}),
+                content_type="application/json",
+                headers=headers,
+            ).data
+        )["short_code"]
+        token_url = f"/api/analytics/{short_code}/stream-token"
+
+        # No stream process configured: nothing to point the dashboard at
+        response = client.post(token_url, headers=headers)
+        assert response.status_code == 503
+
+        # Tokens point at the stream process, and the web process refuses streams
+        with patch("main.LIVE_STREAM_ORIGIN", "https://live.example.com"):
+            response = client.post(token_url, headers=headers)
+        assert response.status_code == 200
+        stream = json.loads(response.data)
+        assert stream["stream_url"].startswith(
+            f"https://live.example.com/api/analytics/{short_code}/stream?token="
+        )
+        with patch("main.click_hub") as mock_hub:
+            response = client.get(
+                f"/api/analytics/{short_code}/stream?token={stream['token']}"
+            )
+        assert response.status_code == 503
+        mock_hub.subscribe.assert_not_called()
+
     def test_get_my_links_unauthorized(self, client):
         """Test my-links access without authentication."""
         response = client.get("/api/my-links")
@@ -392,3 +1029,113 @@ class TestAPIEndpoints:
             assert "short_url" in link
             assert "click_count" in link
             assert "created_at" in link
+
+
+@pytest.fixture
+def sharded_client(tmp_path, monkeypatch):
+    """Create a test client with links spread over three SQLite shards."""
+    from database import create_database_engine, get_shard_engine, start_shard_ids
+
+    app.config["TESTING"] = True
+    monkeypatch.setattr(
+        "database.DATABASE_SHARD_URLS",
+        [f"sqlite:///{tmp_path}/shard1.db", f"sqlite:///{tmp_path}/shard2.db"],
+    )
+    monkeypatch.setattr("database._shard_engines", {})
+    monkeypatch.setattr(
+        "database._engine", create_database_engine(f"sqlite:///{tmp_path}/shard0.db")
+    )
+    monkeypatch.setattr("main._db_initialized", True)
+    engines = [get_shard_engine(shard) for shard in range(3)]
+    for shard, engine in enumerate(engines):
+        Base.metadata.create_all(bind=engine)
+        start_shard_ids(engine, shard)
+
+    with patch("main.log_visit"), patch("main.purge_deleted_url"):
+        with app.test_client() as client:
+            yield client, engines
+
+    for engine in engines:
+        engine.dispose()
+
+
+class TestShardedLinks:
+    """Test cases for links stored on several shards."""
+
+    def test_links_on_all_shards(self, sharded_client):
+        """Test creation, redirects, listing and rules across shards."""
+        from sqlalchemy import text
+
+        from database import shard_for_code, shard_for_id
+
+        client, engines = sharded_client
+        register_response = client.post(
+            "/api/auth/register",
+            data=json.dumps(
+                {
+                    "username": "sharduser",
+                    "email": "shard@example.com",
+                    "password": "testpass123",
+                }
+            ),
+            content_type="application/json",
+        )
+        token = json.loads(register_response.data)["access_token"]
+        headers = {"Authorization": f"Bearer {token}"}
+
+        links = []
+        with patch("main.random.randrange", side_effect=[0, 1, 2]):
+            for i in range(3):
+                response = client.post(
+                    "/api/shorten",
+                    data=json.dumps({"original_url": f"https://example.com/{i}"}),
+                    content_type="application/json",
+                    headers=headers,
+                )
+                assert response.status_code == 201
+                links.append(json.loads(response.data))
+
+        for shard, (link, engine) in enumerate(zip(links, engines)):
+            assert shard_for_code(link["short_code"]) == shard
+            assert shard_for_id(link["id"]) == shard
+            with engine.connect() as connection:
+                assert (
+                    connection.execute(text("SELECT COUNT(*) FROM urls")).scalar() == 1
+                )
+
+            response = client.get(f"/{link['short_code']}")
+            assert response.status_code == 302
+            assert response.headers["Location"] == link["original_url"]
+
+        response = client.get("/api/my-links", headers=headers)
+        listed = json.loads(response.data)["links"]
+        assert sorted(link["short_code"] for link in listed) == sorted(
+            link["short_code"] for link in links
+        )
+
+        # A rule is stored next to its link and gets an id of that shard
+        response = client.post(
+            "/api/rules",
+            data=json.dumps(
+                {
+                    "url_id": links[2]["id"],
+                    "rule_type": "device",
+                    "condition_value": "mobile",
+                    "target_url": "https://m.example.com",
+                }
+            ),
+            content_type="application/json",
+            headers=headers,
+        )
+        assert response.status_code == 201
+        rule_id = json.loads(response.data)["rule"]["id"]
+        assert shard_for_id(rule_id) == 2
+
+        response = client.get(f"/api/rules/{links[2]['id']}", headers=headers)
+        assert [rule["id"] for rule in json.loads(response.data)["rules"]] == [rule_id]
+
+        response = client.delete(f"/api/rules/{rule_id}", headers=headers)
+        assert response.status_code == 200
+        response = client.delete(f"/api/urls/{links[1]['id']}", headers=headers)
+        assert response.status_code == 200
+        assert client.get(f"/{links[1]['short_code']}").status_code == 404
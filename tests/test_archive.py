@@ -0,0 +1,162 @@
+"""Unit tests for the columnar visit archive."""
+
+from datetime import datetime, timedelta
+from unittest.mock import MagicMock, patch
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from archive import SegmentReader, VisitArchive, archive_visits_before
+from models import Base, Url, Visit
+from tasks import cleanup_old_visits
+
+
+@pytest.fixture
+def db():
+    """SQLite session with one link."""
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+    session.add(Url(id=1, short_code="abc", original_url="https://example.com"))
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def make_rows(start, count, url_id=1, **fields):
+    """Build archive rows one hour apart."""
+    return [
+        {
+            "id": i + 1,
+            "url_id": url_id,
+            "created_at": start + timedelta(hours=i),
+            "country_code": fields.get("country_code", "FR"),
+            "device_type": fields.get("device_type", "mobile"),
+            "browser": "Safari",
+            "os_name": "iOS",
+            "referrer_host": fields.get("referrer_host", "direct"),
+            "ip_address": "10.0.0.1",
+            "user_agent": "Mozilla/5.0",
+            "referrer": "",
+            "final_url": "https://example.com",
+        }
+        for i in range(count)
+    ]
+
+
+class TestVisitArchive:
+    """Test cases for writing and reading archive segments."""
+
+    def test_write_splits_segments_by_month(self, tmp_path):
+        """Test one segment is written for every month of the input."""
+        archive = VisitArchive(str(tmp_path), block_rows=10)
+        rows = make_rows(datetime(2025, 1, 31, 20), 8)
+
+        segments = archive.write(rows)
+
+        assert len(segments) == 2
+        assert archive.months() == ["2025-01", "2025-02"]
+        assert archive.count() == 8
+
+    def test_segment_round_trip(self, tmp_path):
+        """Test values survive encoding across several blocks."""
+        archive = VisitArchive(str(tmp_path), block_rows=3)
+        rows = make_rows(datetime(2025, 3, 1), 7)
+        rows[5]["country_code"] = None
+
+        (path,) = archive.write(rows)
+        segment = SegmentReader(path)
+
+        assert segment.rows == 7
+        blocks = list(segment.iter_blocks(["id", "country_code", "user_agent"]))
+        assert [len(block["id"]) for block in blocks] == [3, 3, 1]
+        dictionary = segment.dictionary("country_code")
+        countries = [dictionary[code] for b in blocks for code in b["country_code"]]
+        assert countries == ["FR"] * 5 + [None, "FR"]
+        assert blocks[0]["user_agent"] == ["Mozilla/5.0"] * 3
+
+    def test_aggregate_by_dictionary_column(self, tmp_path):
+        """Test grouping archived visits across segments and URLs."""
+        archive = VisitArchive(str(tmp_path), block_rows=4)
+        archive.write(make_rows(datetime(2025, 1, 1), 5, url_id=1))
+        archive.write(
+            make_rows(datetime(2025, 1, 2), 3, url_id=2, device_type="desktop")
+        )
+
+        assert archive.aggregate("device_type") == {"mobile": 5, "desktop": 3}
+        assert archive.aggregate("device_type", url_id=2) == {"desktop": 3}
+        assert archive.aggregate("country_code", months=["2025-02"]) == {}
+
+    def test_aggregate_by_day(self, tmp_path):
+        """Test daily click histogram over archived months."""
+        archive = VisitArchive(str(tmp_path))
+        archive.write(make_rows(datetime(2025, 1, 1, 22), 4))
+
+        assert archive.aggregate("day") == {"2025-01-01": 2, "2025-01-02": 2}
+
+    def test_aggregate_rejects_unencoded_column(self, tmp_path):
+        """Test only dictionary columns and days can be grouped."""
+        with pytest.raises(ValueError):
+            VisitArchive(str(tmp_path)).aggregate("user_agent")
+
+    @patch("tasks.archive_visits_before")
+    @patch("tasks.VISITS_ARCHIVE_DIR", "/tmp/archive")
+    @patch("tasks.get_db_session")
+    def test_cleanup_archives_before_delete(self, mock_get_db_session, mock_archive):
+        """Test cleanup archives expired visits when an archive is configured."""
+        mock_db = MagicMock()
+        mock_get_db_session.return_value = mock_db
+        mock_db.query.return_value.filter.return_value.delete.return_value = 0
+        mock_archive.return_value = ["/tmp/archive/2025-01/segment.vseg"]
+
+        result = cleanup_old_visits(days=90)
+
+        assert result["archived_segments"] == ["/tmp/archive/2025-01/segment.vseg"]
+        mock_archive.assert_called_once()
+
+
+class TestArchiveWatermark:
+    """Test cases for archiving each visit exactly once."""
+
+    def add_visits(self, db, start, count):
+        """Insert visits one hour apart."""
+        for row in make_rows(start, count):
+            row.pop("id")
+            db.add(Visit(**row))
+        db.commit()
+
+    def test_rerun_after_failed_delete_archives_once(self, db, tmp_path):
+        """Test visits already in segments are not archived again."""
+        archive = VisitArchive(str(tmp_path))
+        self.add_visits(db, datetime(2025, 1, 31, 20), 8)
+        cutoff = datetime(2025, 3, 1)
+
+        first = archive_visits_before(db, cutoff, archive)
+        # The delete failed, so the same visits are still in the table
+        second = archive_visits_before(db, cutoff, archive)
+
+        assert len(first) == 2
+        assert second == []
+        assert archive.count() == 8
+
+    def test_archive_continues_after_watermark(self, db, tmp_path):
+        """Test a later run archives only visits newer than the watermark."""
+        archive = VisitArchive(str(tmp_path))
+        self.add_visits(db, datetime(2025, 1, 1), 3)
+        archive_visits_before(db, datetime(2025, 1, 1, 1, 30), archive)
+        assert archive.watermark() == (datetime(2025, 1, 1, 1), 2)
+
+        archive_visits_before(db, datetime(2025, 2, 1), archive)
+
+        assert archive.count() == 3
+        assert archive.watermark() == (datetime(2025, 1, 1, 2), 3)
+
+    def test_watermark_is_per_shard(self, tmp_path):
+        """Test segments of one shard do not move another shard's watermark."""
+        archive = VisitArchive(str(tmp_path))
+        archive.write(make_rows(datetime(2025, 1, 1), 2), shard=1)
+
+        assert archive.watermark(0) is None
+        assert archive.watermark(1) == (datetime(2025, 1, 1, 1), 2)
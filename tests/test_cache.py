@@ -1,8 +1,17 @@
 """Unit tests for Redis cache functionality."""
 
+from datetime import datetime, timezone
 from unittest.mock import Mock, patch
 
-from cache import Cache
+from redis.exceptions import NoScriptError
+
+from cache import (
+    CLICK_SERIES_TTL,
+    TRENDING_SCRIPT,
+    TRENDING_SCRIPT_SHA,
+    UNIQUE_VISITORS_TTL,
+    Cache,
+)
 
 
 class TestCache:
@@ -28,6 +37,40 @@ class TestCache:
 
         assert cache.redis_client is None
 
+    @patch("redis.from_url")
+    def test_set_analytics_data_keeps_ttl(self, mock_redis_from_url):
+        """Test folded aggregates only update an entry and keep its expiry."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        cache = Cache()
+
+        cache.set_analytics_data(7, {"last_visit_id": 3}, 300)
+        cache.set_analytics_data(7, {"last_visit_id": 4}, keep_ttl=True)
+
+        mock_redis.setex.assert_called_once_with(
+            "analytics:7", 300, '{"last_visit_id": 3}'
+        )
+        mock_redis.set.assert_called_once_with(
+            "analytics:7", '{"last_visit_id": 4}', keepttl=True, xx=True
+        )
+
+    @patch("redis.from_url")
+    def test_redirect_data_with_rules_version(self, mock_redis_from_url):
+        """Test URL data and the rules version are read in one MGET."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        mock_redis.mget.return_value = [b'{"id": 7}', None]
+        cache = Cache()
+
+        assert cache.get_redirect_data("abc") == ({"id": 7}, 0)
+        mock_redis.mget.assert_called_once_with("url:abc", "rules_version:abc")
+
+        cache.bump_rules_version("abc")
+        mock_redis.incr.assert_called_once_with("rules_version:abc")
+
+        mock_redis.mget.side_effect = Exception("Redis down")
+        assert cache.get_redirect_data("abc") == (None, None)
+
     @patch("redis.from_url")
     def test_get_url_data_success(self, mock_redis_from_url):
         """Test successful URL data retrieval from cache."""
@@ -231,3 +274,233 @@ class TestCache:
         result = cache.get_counter("test_counter")
 
         assert result == 0
+
+    @patch("redis.from_url")
+    def test_add_unique_visitor(self, mock_redis_from_url):
+        """Test visitor is added to the daily sketch with an expiry."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        pipe = mock_redis.pipeline.return_value
+
+        cache = Cache()
+        cache.add_unique_visitor(7, "2025-01-02", "abc", ttl=60)
+
+        pipe.pfadd.assert_called_once_with("hll:7:2025-01-02", "abc")
+        pipe.expire.assert_called_once_with("hll:7:2025-01-02", 60)
+        pipe.execute.assert_called_once()
+
+    @patch("redis.from_url")
+    def test_count_unique_visitors(self, mock_redis_from_url):
+        """Test every group of days is counted in one pipeline."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        pipe = mock_redis.pipeline.return_value
+        pipe.execute.return_value = [3, 5]
+
+        cache = Cache()
+        result = cache.count_unique_visitors(7, [["2025-01-01"], ["a", "b"]])
+
+        assert result == [3, 5]
+        pipe.pfcount.assert_any_call("hll:7:a", "hll:7:b")
+        pipe.execute.assert_called_once()
+
+    @patch("redis.from_url")
+    def test_count_unique_visitors_no_redis(self, mock_redis_from_url):
+        """Test unique visitor counts default to zero without Redis."""
+        mock_redis_from_url.side_effect = Exception("Redis connection failed")
+
+        cache = Cache()
+
+        assert cache.count_unique_visitors(7, [["a"], ["b"]]) == [0, 0]
+
+    @patch("redis.from_url")
+    def test_record_click(self, mock_redis_from_url):
+        """Test click counter, trending score and publish share one pipeline."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        pipe = mock_redis.pipeline.return_value
+        pipe.execute.return_value = [4, b"1.5"]
+
+        cache = Cache()
+        result = cache.record_click("abc123", now=1000.0)
+
+        assert result == 4
+        pipe.incr.assert_called_once_with("url_clicks:abc123")
+        args = pipe.evalsha.call_args.args
+        assert args[:3] == (TRENDING_SCRIPT_SHA, 2, "trending:links")
+        assert args[4:6] == ("abc123", 1000.0)
+        pipe.hincrby.assert_called_once_with("clicks_ts:abc123:0", "16", 1)
+        pipe.publish.assert_called_once_with("clicks:abc123", 1000.0)
+        pipe.execute.assert_called_once_with(raise_on_error=False)
+        # No SCRIPT EXISTS/LOAD round trip per click
+        mock_redis.script_exists.assert_not_called()
+        mock_redis.script_load.assert_not_called()
+
+    @patch("redis.from_url")
+    def test_record_click_reloads_missing_script(self, mock_redis_from_url):
+        """Test NOSCRIPT loads the script and retries only the score."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        pipe = mock_redis.pipeline.return_value
+        pipe.execute.return_value = [2, NoScriptError("NOSCRIPT"), 1, True, 0]
+
+        cache = Cache()
+        result = cache.record_click("abc123", now=1000.0)
+
+        assert result == 2
+        mock_redis.script_load.assert_called_once_with(TRENDING_SCRIPT)
+        assert mock_redis.evalsha.call_args.args[0] == TRENDING_SCRIPT_SHA
+        pipe.incr.assert_called_once()
+
+    @patch("redis.from_url")
+    def test_load_scripts(self, mock_redis_from_url):
+        """Test scripts are loaded at startup under the SHA clicks use."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+
+        Cache().load_scripts()
+
+        mock_redis.script_load.assert_called_once_with(TRENDING_SCRIPT)
+
+    @patch("redis.from_url")
+    def test_record_click_counts_rule_hit(self, mock_redis_from_url):
+        """Test the matched rule is counted in the same pipeline."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        pipe = mock_redis.pipeline.return_value
+        pipe.execute.return_value = [1]
+
+        cache = Cache()
+        cache.record_click("abc123", now=1000.0, url_id=7, rule_key="42")
+        cache.record_click("abc123", now=1000.0, url_id=7)
+
+        pipe.hincrby.assert_any_call("rule_hits:7", "42", 1)
+        pipe.hincrby.assert_any_call("rule_hits:7", "default", 1)
+        pipe.sadd.assert_called_with("rule_hits:pending", 7)
+        assert pipe.execute.call_count == 2
+
+    @patch("redis.from_url")
+    def test_drain_rule_hits(self, mock_redis_from_url):
+        """Test pending rule hits are read and deleted in one transaction."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        mock_redis.spop.return_value = [b"7", b"8"]
+        pipe = mock_redis.pipeline.return_value
+        pipe.execute.return_value = [{b"42": b"3", b"default": b"1"}, 1, {}, 0]
+
+        cache = Cache()
+        result = cache.drain_rule_hits(100)
+
+        assert result == {7: {"42": 3, "default": 1}}
+        mock_redis.spop.assert_called_once_with("rule_hits:pending", 100)
+        mock_redis.pipeline.assert_called_with(transaction=True)
+        pipe.delete.assert_any_call("rule_hits:8")
+
+    @patch("redis.from_url")
+    def test_delete_url_keys(self, mock_redis_from_url):
+        """Test every key of a purged link is removed without scanning the keyspace."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        pipe = mock_redis.pipeline.return_value
+        now = datetime(2025, 1, 3, 12, 30, tzinfo=timezone.utc).timestamp()
+
+        cache = Cache()
+        cache.delete_url_keys(7, "abc", datetime(2025, 1, 1, 8), now=now)
+
+        mock_redis.scan_iter.assert_not_called()
+        keys = [key for call in pipe.delete.call_args_list for key in call.args]
+        assert keys[:5] == [
+            "url:abc",
+            "url_clicks:abc",
+            "analytics:7",
+            "rule_hits:7",
+            "rules_version:abc",
+        ]
+        assert [key for key in keys if key.startswith("hll:")] == [
+            "hll:7:2024-12-31",
+            "hll:7:2025-01-01",
+            "hll:7:2025-01-02",
+            "hll:7:2025-01-03",
+            "hll:7:2025-01-04",
+        ]
+        hours = [int(key.rsplit(":", 1)[1]) for key in keys if "clicks_ts" in key]
+        assert int(now // 3600) in hours
+        assert int((now - CLICK_SERIES_TTL) // 3600) in hours
+        assert len(hours) == 28
+        pipe.zrem.assert_called_once_with("trending:links", "abc")
+        pipe.execute.assert_called_once()
+
+    @patch("redis.from_url")
+    def test_delete_url_keys_bounded_by_sketch_ttl(self, mock_redis_from_url):
+        """Test sketches older than UNIQUE_VISITORS_TTL are not listed."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        pipe = mock_redis.pipeline.return_value
+
+        cache = Cache()
+        cache.delete_url_keys(7, "abc", datetime(2015, 1, 1))
+
+        keys = [key for call in pipe.delete.call_args_list for key in call.args]
+        days = UNIQUE_VISITORS_TTL // 86400
+        assert days < len([key for key in keys if key.startswith("hll:")]) <= days + 4
+
+    @patch("redis.from_url")
+    def test_rule_hits_no_redis(self, mock_redis_from_url):
+        """Test rule hit counters are empty when Redis is not available."""
+        mock_redis_from_url.side_effect = Exception("Redis connection failed")
+
+        cache = Cache()
+
+        assert cache.get_rule_hits(7) == {}
+        assert cache.drain_rule_hits() == {}
+
+    @patch("cache.TRENDING_HALF_LIFE", 100.0)
+    @patch("redis.from_url")
+    def test_get_trending_decays_scores(self, mock_redis_from_url):
+        """Test trending scores are decayed relative to the landmark."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        pipe = mock_redis.pipeline.return_value
+        pipe.execute.return_value = [b"1000", [(b"abc123", 8.0), (b"xyz789", 2.0)]]
+
+        cache = Cache()
+        result = cache.get_trending(2, now=1200.0)
+
+        assert result == [("abc123", 2.0), ("xyz789", 0.5)]
+        pipe.zrevrange.assert_called_once_with("trending:links", 0, 1, withscores=True)
+
+    @patch("redis.from_url")
+    def test_get_trending_no_redis(self, mock_redis_from_url):
+        """Test trending is empty when Redis is not available."""
+        mock_redis_from_url.side_effect = Exception("Redis connection failed")
+
+        cache = Cache()
+
+        assert cache.get_trending() == []
+        assert cache.record_click("abc123") == 0
+
+    @patch("redis.from_url")
+    def test_get_click_series_across_hours(self, mock_redis_from_url):
+        """Test minute buckets from several hourly hashes form one series."""
+        mock_redis = Mock()
+        mock_redis_from_url.return_value = mock_redis
+        pipe = mock_redis.pipeline.return_value
+        pipe.execute.return_value = [{b"59": b"2"}, {b"0": b"5", b"1": b"1"}]
+
+        cache = Cache()
+        # Minute 61 (01:01), so the last 3 minutes are 00:59, 01:00 and 01:01
+        result = cache.get_click_series("abc123", 3, now=61 * 60 + 30)
+
+        assert result == [2, 5, 1]
+        pipe.hgetall.assert_any_call("clicks_ts:abc123:0")
+        pipe.hgetall.assert_any_call("clicks_ts:abc123:1")
+        pipe.execute.assert_called_once()
+
+    @patch("redis.from_url")
+    def test_get_click_series_no_redis(self, mock_redis_from_url):
+        """Test click series is all zeros when Redis is not available."""
+        mock_redis_from_url.side_effect = Exception("Redis connection failed")
+
+        cache = Cache()
+
+        assert cache.get_click_series("abc123", 60) == [0] * 60
@@ -1,5 +1,6 @@
 """Unit tests for Celery tasks."""
 
+from datetime import datetime, timedelta
 from unittest.mock import MagicMock, patch
 
 import pytest
@@ -7,8 +8,17 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
-from models import Base, Url
-from tasks import cleanup_old_visits, log_visit, process_analytics
+from models import Base, Rule, RuleHit, Url, UrlClickCounter, Visit
+from tasks import (
+    backfill_referrer_hosts,
+    cleanup_old_visits,
+    compact_click_counters,
+    flush_rule_hits,
+    log_visit,
+    process_analytics,
+    purge_deleted_url,
+    purge_deleted_urls,
+)
 
 
 @pytest.fixture(scope="function")
@@ -158,6 +168,51 @@ class TestLogVisitTask:
             # Verify result
             assert result["status"] == "success"
 
+    @patch("tasks.cache")
+    @patch("tasks.get_db_session")
+    def test_log_visit_counts_click_in_slot(
+        self, mock_get_db_session, mock_cache, test_db
+    ):
+        """Test the click goes to a counter slot, not the urls row."""
+        url_obj = Url.create_short_url(
+            test_db, "https://example.com/test", "http://localhost:8000"
+        )
+        url_id = url_obj.id
+        mock_get_db_session.return_value = test_db
+
+        with patch("os.path.exists", return_value=False):
+            result = log_visit.__wrapped__.__func__(
+                MagicMock(), url_id, {"ip_address": "192.168.1.1"}, "https://e.com"
+            )
+
+        assert result["status"] == "success"
+        assert UrlClickCounter.pending(test_db, [url_id]) == {url_id: 1}
+        assert test_db.query(Url).get(url_id).click_count == 0
+
+    @patch("tasks.cache")
+    @patch("tasks.get_db_session")
+    def test_log_visit_skips_deleted_url(
+        self, mock_get_db_session, mock_cache, test_db
+    ):
+        """Test clicks of deleted or purged links are not recorded."""
+        url_obj = Url.create_short_url(
+            test_db, "https://example.com/test", "http://localhost:8000"
+        )
+        url_id = url_obj.id
+        url_obj.deleted_at = datetime.utcnow()
+        test_db.commit()
+        mock_get_db_session.return_value = test_db
+
+        for target_id in (url_id, url_id + 100):
+            result = log_visit.__wrapped__.__func__(
+                MagicMock(), target_id, {"ip_address": "192.168.1.1"}, "https://e.com"
+            )
+            assert result == {"status": "skipped"}
+
+        assert test_db.query(Visit).count() == 0
+        assert UrlClickCounter.pending(test_db, [url_id]) == {}
+        mock_cache.add_unique_visitor.assert_not_called()
+
     @patch("tasks.get_db_session")
     def test_log_visit_retry_on_failure(self, mock_get_db_session):
         """Test task retry on database failure."""
@@ -229,3 +284,186 @@ class TestCleanupOldVisitsTask:
         # Should return error status
         assert result["status"] == "error"
         assert "Database error" in result["error"]
+
+
+class TestBackfillReferrerHostsTask:
+    """Test cases for backfill_referrer_hosts Celery task."""
+
+    @patch("tasks.get_db_session")
+    def test_backfill_referrer_hosts(self, mock_get_db_session, test_db):
+        """Test referrer hosts are filled in batches for old visits."""
+        url_obj = Url.create_short_url(
+            test_db, "https://example.com/test", "http://localhost:8000"
+        )
+        referrers = ["https://www.google.com/search", "", "https://t.co/x"]
+        for referrer in referrers:
+            test_db.add(Visit(url_id=url_obj.id, referrer=referrer))
+        test_db.commit()
+
+        mock_get_db_session.return_value = test_db
+
+        result = backfill_referrer_hosts(batch_size=2)
+
+        assert result == {"status": "success", "updated": 3}
+        hosts = [v.referrer_host for v in test_db.query(Visit).order_by(Visit.id)]
+        assert hosts == ["google.com", "direct", "t.co"]
+
+
+class TestFlushRuleHitsTask:
+    """Test cases for flush_rule_hits Celery task."""
+
+    @patch("tasks.cache")
+    @patch("tasks.get_db_session")
+    def test_flush_rule_hits(self, mock_get_db_session, mock_cache, test_db):
+        """Test drained counts are added to the rollup rows."""
+        url_obj = Url.create_short_url(
+            test_db, "https://example.com/test", "http://localhost:8000"
+        )
+        test_db.add(RuleHit(url_id=url_obj.id, rule_key="default", hits=10))
+        test_db.commit()
+        url_id = url_obj.id
+        mock_get_db_session.return_value = test_db
+        mock_cache.drain_rule_hits.side_effect = [
+            {url_id: {"1": 3, "default": 2}, 999: {"default": 5}},
+            {url_id: {"1": 1}},
+            {},
+        ]
+
+        result = flush_rule_hits()
+
+        assert result == {"status": "success", "flushed": 6}
+        hits = {
+            row.rule_key: row.hits
+            for row in test_db.query(RuleHit).filter(RuleHit.url_id == url_id)
+        }
+        assert hits == {"1": 4, "default": 12}
+        assert test_db.query(RuleHit).filter(RuleHit.url_id == 999).count() == 0
+
+    @patch("tasks.cache")
+    @patch("tasks.get_db_session")
+    def test_flush_rule_hits_error_restores_counts(
+        self, mock_get_db_session, mock_cache
+    ):
+        """Test counts go back to Redis when the database write fails."""
+        mock_db = MagicMock()
+        mock_db.query.side_effect = Exception("Database error")
+        mock_get_db_session.return_value = mock_db
+        mock_cache.drain_rule_hits.return_value = {1: {"default": 2}}
+
+        result = flush_rule_hits()
+
+        assert result["status"] == "error"
+        mock_cache.restore_rule_hits.assert_called_once_with({1: {"default": 2}})
+
+
+class TestCompactClickCountersTask:
+    """Test cases for compact_click_counters Celery task."""
+
+    @patch("tasks.get_db_session")
+    def test_compact_click_counters(self, mock_get_db_session, test_db):
+        """Test counter slots are folded into urls.click_count."""
+        url_obj = Url.create_short_url(
+            test_db, "https://example.com/test", "http://localhost:8000"
+        )
+        url_id = url_obj.id
+        for _ in range(3):
+            UrlClickCounter.increment(test_db, url_id)
+        test_db.commit()
+        mock_get_db_session.return_value = test_db
+
+        result = compact_click_counters()
+
+        assert result == {"status": "success", "folded": 3}
+        assert test_db.query(Url).get(url_id).click_count == 3
+        assert UrlClickCounter.pending(test_db, [url_id]) == {}
+
+    @patch("tasks.get_db_session")
+    def test_compact_click_counters_error(self, mock_get_db_session):
+        """Test database errors are reported."""
+        mock_db = MagicMock()
+        mock_db.execute.side_effect = Exception("Database error")
+        mock_get_db_session.return_value = mock_db
+
+        result = compact_click_counters()
+
+        assert result == {"status": "error", "error": "Database error"}
+        mock_db.rollback.assert_called_once()
+
+
+def add_deleted_url(db, deleted_at, visits=5):
+    """Create a link marked deleted with visits, a rule and counters."""
+    url = Url.create_short_url(db, "https://example.com/old", "http://x")
+    for _ in range(visits):
+        db.add(Visit(url_id=url.id, referrer_host="direct"))
+    db.add(Rule(url_id=url.id, rule_type="device", target_url="https://m.e.com"))
+    db.add(RuleHit(url_id=url.id, rule_key="default", hits=3))
+    UrlClickCounter.increment(db, url.id)
+    url.deleted_at = deleted_at
+    db.commit()
+    return url.id, url.short_code
+
+
+class TestPurgeDeletedUrlTask:
+    """Test cases for purging deleted links."""
+
+    @patch("tasks.cache")
+    @patch("tasks.get_db_session")
+    def test_purge_deleted_url_in_batches(
+        self, mock_get_db_session, mock_cache, test_db
+    ):
+        """Test every row of the link is removed, then the link."""
+        url_id, short_code = add_deleted_url(test_db, datetime.utcnow())
+        kept = Url.create_short_url(test_db, "https://example.com/kept", "http://x")
+        test_db.add(Visit(url_id=kept.id))
+        test_db.commit()
+        created_at = test_db.get(Url, url_id).created_at
+        mock_get_db_session.return_value = test_db
+
+        result = purge_deleted_url.__wrapped__.__func__(
+            MagicMock(), url_id, batch_size=2
+        )
+
+        assert result == {
+            "status": "success",
+            "deleted": {
+                "visits": 5,
+                "rule_hits": 1,
+                "rules": 1,
+                "url_click_counters": 1,
+            },
+        }
+        assert test_db.query(Url).filter(Url.id == url_id).count() == 0
+        assert test_db.query(Visit).count() == 1
+        mock_cache.delete_url_keys.assert_called_once_with(
+            url_id, short_code, created_at
+        )
+
+    @patch("tasks.get_db_session")
+    def test_purge_skips_live_url(self, mock_get_db_session, test_db):
+        """Test a link that is not marked deleted is left alone."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        url_id = url.id
+        mock_get_db_session.return_value = test_db
+
+        result = purge_deleted_url.__wrapped__.__func__(MagicMock(), url_id)
+
+        assert result == {"status": "skipped"}
+        assert test_db.query(Url).filter(Url.id == url_id).count() == 1
+
+    @patch("tasks.cache")
+    @patch("tasks.get_db_session")
+    def test_sweep_purges_links_past_grace(
+        self, mock_get_db_session, mock_cache, test_db
+    ):
+        """Test the sweep purges old deletions and leaves recent ones."""
+        old_id, _ = add_deleted_url(test_db, datetime.utcnow() - timedelta(hours=1))
+        recent_id, _ = add_deleted_url(test_db, datetime.utcnow())
+        mock_get_db_session.return_value = test_db
+
+        result = purge_deleted_urls()
+
+        assert result == {"status": "success", "purged": 1}
+        remaining = {url_id for (url_id,) in test_db.query(Url.id)}
+        assert remaining == {recent_id}
+        assert test_db.query(Visit).filter(Visit.url_id == old_id).count() == 0
+        assert mock_cache.delete_url_keys.call_count == 1
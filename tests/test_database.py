@@ -0,0 +1,439 @@
+"""Unit tests for database engines and read replica routing."""
+
+import threading
+from unittest.mock import MagicMock, patch
+
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import DatabaseError
+from sqlalchemy.pool import NullPool, QueuePool, StaticPool
+
+import database
+from database import (
+    IdlePing,
+    clean_database_url,
+    create_database_engine,
+    fan_out,
+    get_read_db,
+    get_shard_engine,
+    replica_status,
+    requests_pgbouncer,
+    shard_for_code,
+    shard_for_id,
+)
+from models import Base, Url
+
+
+def make_engine():
+    """Create an in-memory SQLite engine."""
+    return create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+        echo=False,
+    )
+
+
+@pytest.fixture
+def engines(monkeypatch):
+    """Configure a primary and a replica engine."""
+    primary, replica = make_engine(), make_engine()
+    monkeypatch.setattr("database._engine", primary)
+    monkeypatch.setattr("database._replica_engine", replica)
+    monkeypatch.setattr("database.DATABASE_REPLICA_URL", "sqlite:///:memory:")
+    monkeypatch.setattr("database._replica_skip_until", 0.0)
+    monkeypatch.setattr("database._replica_checked_at", 0.0)
+    yield primary, replica
+    primary.dispose()
+    replica.dispose()
+
+
+def session_engine(db):
+    """Get the engine a session is bound to."""
+    bind = db.get_bind()
+    return getattr(bind, "engine", bind)
+
+
+class TestReadReplica:
+    """Test cases for routing reads to the replica."""
+
+    def test_reads_use_primary_without_replica(self, monkeypatch):
+        """Test reads fall back to the primary when no replica is configured."""
+        primary = make_engine()
+        monkeypatch.setattr("database._engine", primary)
+        monkeypatch.setattr("database._replica_engine", None)
+        monkeypatch.setattr("database.DATABASE_REPLICA_URL", None)
+
+        assert session_engine(next(get_read_db())) is primary
+        assert replica_status() == {"replica": False}
+
+    def test_reads_use_replica(self, engines):
+        """Test reads go to the replica, and to the primary after a write."""
+        primary, replica = engines
+
+        assert session_engine(next(get_read_db())) is replica
+        assert session_engine(next(get_read_db(use_primary=True))) is primary
+
+    def test_unreachable_replica_falls_back(self, engines):
+        """Test a failed replica connection sends reads to the primary."""
+        primary, replica = engines
+        broken = MagicMock()
+        broken.connect.side_effect = Exception("connection refused")
+        database._replica_engine = broken
+
+        assert session_engine(next(get_read_db())) is primary
+        # The replica is not retried until the check interval has passed
+        assert session_engine(next(get_read_db())) is primary
+        assert broken.connect.call_count == 1
+        assert replica_status() == {"replica": True, "available": False}
+
+    def test_lagging_replica_falls_back(self, engines):
+        """Test a replica lagging past the limit sends reads to the primary."""
+        primary, replica = engines
+
+        with patch("database.get_replica_lag", return_value=120.0):
+            assert session_engine(next(get_read_db())) is primary
+            status = replica_status()
+
+        assert status["lag_seconds"] == 120.0
+        assert status["available"] is True
+
+    def test_clean_database_url(self):
+        """Test PostgreSQL URLs are normalized and others kept as-is."""
+        url = "postgres://user:pw@db:5432/app?pgbouncer=true&sslmode=require"
+
+        assert clean_database_url(url) == (
+            "postgresql://user:pw@db:5432/app?sslmode=require"
+        )
+        assert clean_database_url("sqlite:///./local.db") == "sqlite:///./local.db"
+
+
+class TestSQLiteWalMode:
+    """Test cases for the pooled WAL SQLite mode."""
+
+    @pytest.fixture
+    def wal_engine(self, tmp_path):
+        """Create a WAL mode engine on a database file."""
+        engine = create_database_engine(f"sqlite:///{tmp_path}/wal.db", sqlite_wal=True)
+        Base.metadata.create_all(bind=engine)
+        yield engine
+        engine.dispose()
+
+    def test_pragmas_applied_on_connect(self, wal_engine):
+        """Test every pooled connection gets WAL and the tuned pragmas."""
+        with wal_engine.connect() as connection:
+            assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            # 1 = NORMAL
+            assert connection.execute(text("PRAGMA synchronous")).scalar() == 1
+            assert connection.execute(text("PRAGMA busy_timeout")).scalar() > 0
+        assert isinstance(wal_engine.pool, QueuePool)
+
+    def test_readers_do_not_wait_for_writer(self, wal_engine):
+        """Test reads proceed while another connection holds a write."""
+        writer = wal_engine.connect()
+        transaction = writer.begin()
+        writer.execute(
+            Url.__table__.insert(),
+            {"short_code": "abc123", "original_url": "https://example.com"},
+        )
+
+        result = []
+
+        def read():
+            with wal_engine.connect() as connection:
+                result.append(
+                    connection.execute(text("SELECT COUNT(*) FROM urls")).scalar()
+                )
+
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(timeout=2)
+
+        # The reader sees the last committed state without blocking
+        assert result == [0]
+        transaction.commit()
+        writer.close()
+
+    def test_writers_take_turns(self, wal_engine):
+        """Test a second writer waits for the first to commit."""
+        first = wal_engine.connect()
+        transaction = first.begin()
+        first.execute(
+            Url.__table__.insert(),
+            {"short_code": "first1", "original_url": "https://example.com/1"},
+        )
+
+        done = threading.Event()
+
+        def second_writer():
+            with wal_engine.begin() as connection:
+                connection.execute(
+                    Url.__table__.insert(),
+                    {"short_code": "second", "original_url": "https://example.com/2"},
+                )
+            done.set()
+
+        thread = threading.Thread(target=second_writer)
+        thread.start()
+        assert not done.wait(0.3)
+
+        transaction.commit()
+        first.close()
+        assert done.wait(2)
+        thread.join()
+        with wal_engine.connect() as connection:
+            count = connection.execute(text("SELECT COUNT(*) FROM urls")).scalar()
+        assert count == 2
+
+
+class TestPgBouncerMode:
+    """Test cases for the PgBouncer transaction pooling mode."""
+
+    URL = "postgresql://user:pw@pgbouncer:6432/app"
+
+    def test_requests_pgbouncer(self):
+        """Test the mode is read from the pgbouncer URL parameter."""
+        assert requests_pgbouncer(self.URL + "?pgbouncer=true&sslmode=require")
+        assert not requests_pgbouncer(self.URL + "?pgbouncer=false")
+        assert not requests_pgbouncer(self.URL)
+        assert not requests_pgbouncer(None)
+
+    def test_null_pool_by_default(self, monkeypatch):
+        """Test the process keeps no connections of its own by default."""
+        monkeypatch.setattr("database.PGBOUNCER_POOL_SIZE", 0)
+        engine = create_database_engine(self.URL, pgbouncer=True)
+
+        assert isinstance(engine.pool, NullPool)
+        assert engine.dialect.use_native_hstore is False
+
+    def test_small_pool_without_pre_ping(self, monkeypatch):
+        """Test a configured pool size gives a QueuePool without pre-ping."""
+        monkeypatch.setattr("database.PGBOUNCER_POOL_SIZE", 2)
+        engine = create_database_engine(self.URL, pgbouncer=True)
+
+        assert isinstance(engine.pool, QueuePool)
+        assert engine.pool.size() == 2
+        assert engine.pool._pre_ping is False
+
+    def test_sqlite_ignores_pgbouncer(self):
+        """Test the flag has no effect on SQLite URLs."""
+        engine = create_database_engine("sqlite:///:memory:", pgbouncer=True)
+
+        assert isinstance(engine.pool, StaticPool)
+
+
+class TestIdlePing:
+    """Test cases for pinging idle pooled connections."""
+
+    @pytest.fixture
+    def engine(self, tmp_path):
+        """Create a pooled SQLite engine with idle pings."""
+        engine = create_engine(f"sqlite:///{tmp_path}/ping.db", poolclass=QueuePool)
+        IdlePing(30).attach(engine)
+        yield engine
+        engine.dispose()
+
+    def test_ping_only_after_idle_interval(self, engine):
+        """Test recently used connections are handed out without a ping."""
+        with engine.connect():
+            pass
+        record = engine.pool._pool.queue[0]
+        dbapi_connection = record.dbapi_connection
+
+        with patch(
+            "database.time.monotonic", return_value=record.info["checked_in_at"]
+        ):
+            with engine.connect() as connection:
+                assert connection.connection.dbapi_connection is dbapi_connection
+
+        with patch(
+            "database.time.monotonic",
+            return_value=record.info["checked_in_at"] + 31,
+        ):
+            with engine.connect() as connection:
+                assert connection.execute(text("SELECT 1")).scalar() == 1
+        assert record.dbapi_connection is dbapi_connection
+
+    def test_failed_ping_reconnects(self, engine):
+        """Test a connection that fails the ping is replaced."""
+        with engine.connect():
+            pass
+        record = engine.pool._pool.queue[0]
+        stale = record.dbapi_connection
+        stale.close()
+
+        with patch(
+            "database.time.monotonic",
+            return_value=record.info["checked_in_at"] + 31,
+        ):
+            with engine.connect() as connection:
+                assert connection.execute(text("SELECT 1")).scalar() == 1
+                assert connection.connection.dbapi_connection is not stale
+
+
+@pytest.fixture
+def shards(tmp_path, monkeypatch):
+    """Configure three link shards on local SQLite files."""
+    monkeypatch.setattr(
+        "database.DATABASE_SHARD_URLS",
+        [f"sqlite:///{tmp_path}/shard1.db", f"sqlite:///{tmp_path}/shard2.db"],
+    )
+    monkeypatch.setattr("database._shard_engines", {})
+    monkeypatch.setattr(
+        "database._engine", create_database_engine(f"sqlite:///{tmp_path}/shard0.db")
+    )
+    engines = [get_shard_engine(shard) for shard in range(3)]
+    for shard, engine in enumerate(engines):
+        Base.metadata.create_all(bind=engine)
+        database.start_shard_ids(engine, shard)
+    yield engines
+    for engine in engines:
+        engine.dispose()
+
+
+class TestSharding:
+    """Test cases for routing links to shards."""
+
+    def test_single_database_is_shard_zero(self):
+        """Test everything maps to shard 0 without configured shards."""
+        assert shard_for_code("abc123") == 0
+        assert shard_for_code("1~abc123") == 0
+        assert shard_for_id(7) == 0
+        assert shard_for_id(database.SHARD_ID_SPAN + 7) == 0
+
+    def test_unprefixed_codes_and_ids_stay_on_shard_zero(self, shards):
+        """Test links from before sharding keep routing to shard 0."""
+        assert shard_for_code("abc123") == 0
+        assert shard_for_code("ab_c-1") == 0
+        assert shard_for_code("2~abc123") == 2
+        # A shard that is not configured is not guessed
+        assert shard_for_code("7~abc123") == 0
+        assert shard_for_id(database.SHARD_ID_SPAN - 1) == 0
+        assert shard_for_id(2 * database.SHARD_ID_SPAN + 5) == 2
+        assert shard_for_id(7 * database.SHARD_ID_SPAN) == 0
+
+    def test_enabling_sharding_moves_nothing(self, tmp_path, monkeypatch):
+        """Test links created without shards are still found once they exist."""
+        monkeypatch.setattr("database.DATABASE_SHARD_URLS", [])
+        monkeypatch.setattr(
+            "database._engine",
+            create_database_engine(f"sqlite:///{tmp_path}/shard0.db"),
+        )
+        Base.metadata.create_all(bind=database._engine)
+        db = database.get_shard_session(0)
+        links = [
+            (url.short_code, url.id)
+            for url in (
+                Url.create_short_url(db, f"https://example.com/{i}", "http://x")
+                for i in range(50)
+            )
+        ]
+        db.close()
+
+        monkeypatch.setattr(
+            "database.DATABASE_SHARD_URLS",
+            [f"sqlite:///{tmp_path}/shard1.db", f"sqlite:///{tmp_path}/shard2.db"],
+        )
+        monkeypatch.setattr("database._shard_engines", {})
+
+        for short_code, url_id in links:
+            assert shard_for_code(short_code) == 0
+            assert shard_for_id(url_id) == 0
+        database._engine.dispose()
+
+    def test_create_on_shard(self, shards):
+        """Test a link gets a code and an id that both route to its shard."""
+        for shard, engine in enumerate(shards):
+            db = database.get_shard_session(shard)
+            first = Url.create_short_url(
+                db, "https://a.example", "http://x", shard=shard
+            )
+            second = Url.create_short_url(
+                db, "https://b.example", "http://x", shard=shard
+            )
+
+            for url in (first, second):
+                assert shard_for_code(url.short_code) == shard
+                assert shard_for_id(url.id) == shard
+            assert first.short_code.startswith(f"{shard}~") == (shard > 0)
+            assert second.id == first.id + 1
+            db.close()
+
+            with engine.connect() as connection:
+                assert (
+                    connection.execute(text("SELECT COUNT(*) FROM urls")).scalar() == 2
+                )
+
+    def test_ids_come_from_the_shard_sequence(self, shards):
+        """Test ids start at the shard range and are never handed out twice."""
+        db = database.get_shard_session(1)
+        first = Url.create_short_url(db, "https://a.example", "http://x", shard=1)
+        assert first.id == database.SHARD_ID_SPAN
+        db.delete(first)
+        db.commit()
+
+        second = Url.create_short_url(db, "https://b.example", "http://x", shard=1)
+        assert second.id == database.SHARD_ID_SPAN + 1
+        db.close()
+
+        # Running the setup again never moves the sequence back
+        database.start_shard_ids(shards[1], 1)
+        db = database.get_shard_session(1)
+        third = Url.create_short_url(db, "https://c.example", "http://x", shard=1)
+        assert third.id == database.SHARD_ID_SPAN + 2
+        db.close()
+
+    def test_ids_never_leave_the_shard_range(self, shards):
+        """Test a shard (shard 0 too) refuses ids that route to the next one."""
+        for shard, engine in enumerate(shards):
+            with engine.begin() as connection:
+                connection.execute(
+                    text("DELETE FROM sqlite_sequence WHERE name = 'urls'")
+                )
+                connection.execute(
+                    text(
+                        "INSERT INTO sqlite_sequence (name, seq) "
+                        "VALUES ('urls', :seq)"
+                    ),
+                    {"seq": (shard + 1) * database.SHARD_ID_SPAN - 2},
+                )
+            db = database.get_shard_session(shard)
+            last = Url.create_short_url(db, "https://a.example", "http://x", shard)
+            assert shard_for_id(last.id) == shard
+
+            with pytest.raises(DatabaseError, match="диапазона шарда"):
+                Url.create_short_url(db, "https://b.example", "http://x", shard)
+            db.rollback()
+            db.close()
+
+    def test_shard_zero_past_its_range_is_refused(self, tmp_path, monkeypatch):
+        """Test enabling sharding fails while shard 0 holds ids of shard 1."""
+        monkeypatch.setattr("database.DATABASE_SHARD_URLS", [])
+        engine = create_database_engine(f"sqlite:///{tmp_path}/shard0.db")
+        Base.metadata.create_all(bind=engine)
+        db = database.SessionLocal(bind=engine)
+        db.add(Url(id=database.SHARD_ID_SPAN, original_url="https://a", short_code="a"))
+        db.commit()
+        db.close()
+        # A single database has no range to keep
+        database.start_shard_ids(engine, 0)
+
+        monkeypatch.setattr(
+            "database.DATABASE_SHARD_URLS", [f"sqlite:///{tmp_path}/shard1.db"]
+        )
+        with pytest.raises(RuntimeError, match="SHARD_ID_SPAN"):
+            database.start_shard_ids(engine, 0)
+        engine.dispose()
+
+    def test_fan_out_keeps_shard_order(self, shards):
+        """Test fan_out runs on every shard and returns results in order."""
+        threads = set()
+
+        def query(shard):
+            threads.add(threading.current_thread().name)
+            with shards[shard].connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return shard
+
+        assert fan_out(query) == [0, 1, 2]
+        assert all(name.startswith("shard") for name in threads)
@@ -0,0 +1,239 @@
+"""Unit tests for the bulk link import."""
+
+import io
+import json
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import text
+
+from database import (
+    create_database_engine,
+    get_shard_engine,
+    shard_for_code,
+    shard_for_id,
+    start_shard_ids,
+)
+from import_links import (
+    generated_code,
+    import_links,
+    insert_rows,
+    iter_json_array,
+    read_records,
+    validate_record,
+)
+from models import Base, Url, User
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    """Use a SQLite file as the only database."""
+    engine = create_database_engine(f"sqlite:///{tmp_path}/import.db")
+    monkeypatch.setattr("database._engine", engine)
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+def write_json(path, records):
+    """Write records in the data/urls.json layout."""
+    path.write_text(json.dumps({"urls": records}))
+    return str(path)
+
+
+def url_rows(engine):
+    """Get (short_code, original_url) of all links."""
+    with engine.connect() as connection:
+        rows = connection.execute(text("SELECT short_code, original_url FROM urls"))
+        return dict(rows.fetchall())
+
+
+class TestReading:
+    """Test cases for streaming input records."""
+
+    def test_json_array_streamed_in_small_chunks(self):
+        """Test items split across chunk boundaries are decoded."""
+        records = [
+            {"original_url": f"https://example.com/{i}", "n": i * 1000}
+            for i in range(50)
+        ]
+        stream = io.StringIO(json.dumps({"urls": records}, indent=2))
+
+        assert list(iter_json_array(stream, chunk_size=7)) == records
+
+    def test_top_level_array(self):
+        """Test a plain JSON array is accepted."""
+        stream = io.StringIO('[{"a": 1}, {"a": 2}]')
+
+        assert list(iter_json_array(stream, chunk_size=3)) == [{"a": 1}, {"a": 2}]
+
+    def test_empty_urls_file(self):
+        """Test the shipped empty data file has no records."""
+        assert list(read_records("data/urls.json")) == []
+
+    def test_jsonl_and_csv(self, tmp_path):
+        """Test JSON Lines and CSV inputs."""
+        jsonl = tmp_path / "links.jsonl"
+        jsonl.write_text('{"original_url": "https://a.example"}\n\n')
+        csv_path = tmp_path / "links.csv"
+        csv_path.write_text("short_code,original_url\nabc,https://b.example\n")
+
+        assert list(read_records(str(jsonl))) == [{"original_url": "https://a.example"}]
+        assert list(read_records(str(csv_path))) == [
+            {"short_code": "abc", "original_url": "https://b.example"}
+        ]
+
+    def test_validate_record(self):
+        """Test records are normalized and invalid ones explained."""
+        row = validate_record(
+            {
+                "original_url": "https://example.com",
+                "short_code": "abc_1",
+                "user_id": "3",
+                "click_count": "5",
+                "created_at": "2024-05-01T12:00:00+02:00",
+            }
+        )
+        assert row["user_id"] == 3
+        assert row["click_count"] == 5
+        assert row["created_at"].isoformat() == "2024-05-01T10:00:00"
+
+        with pytest.raises(ValueError, match="http"):
+            validate_record({"original_url": "ftp://example.com"})
+        with pytest.raises(ValueError, match="код"):
+            validate_record({"original_url": "https://e.com", "short_code": "a b"})
+        with pytest.raises(ValueError, match="времени"):
+            validate_record({"original_url": "https://e.com", "created_at": "soon"})
+
+
+class TestImport:
+    """Test cases for loading links."""
+
+    def test_import_keeps_codes_and_detects_conflicts(self, engine, tmp_path):
+        """Test supplied codes are kept and taken codes are rejected."""
+        with engine.begin() as connection:
+            connection.execute(
+                Url.__table__.insert(),
+                {"short_code": "taken", "original_url": "https://other.example"},
+            )
+        path = write_json(
+            tmp_path / "links.json",
+            [
+                {"short_code": "keep01", "original_url": "https://a.example"},
+                {"short_code": "taken", "original_url": "https://b.example"},
+                {"original_url": "https://c.example"},
+                {"original_url": "not a url"},
+                {"short_code": "keep01", "original_url": "https://a.example"},
+            ],
+        )
+        rejects = tmp_path / "rejects.jsonl"
+
+        result = import_links(path, batch_size=2, rejects_path=str(rejects))
+
+        assert result["imported"] == 2
+        assert result["conflicts"] == 1
+        assert result["invalid"] == 1
+        assert result["existing"] == 1
+        rows = url_rows(engine)
+        assert rows["keep01"] == "https://a.example"
+        assert rows["taken"] == "https://other.example"
+        assert rows[generated_code("links.json", 2, 0)] == "https://c.example"
+        reasons = [
+            json.loads(line)["reason"] for line in rejects.read_text().splitlines()
+        ]
+        assert len(reasons) == 2
+
+    def test_unknown_user_is_rejected(self, engine, tmp_path):
+        """Test links of users that do not exist are not loaded."""
+        with engine.begin() as connection:
+            connection.execute(
+                User.__table__.insert(),
+                {"id": 1, "username": "u", "email": "u@e.com", "password_hash": "x"},
+            )
+        path = write_json(
+            tmp_path / "links.json",
+            [
+                {"original_url": "https://a.example", "user_id": 1},
+                {"original_url": "https://b.example", "user_id": 2},
+            ],
+        )
+
+        result = import_links(path)
+
+        assert result["imported"] == 1
+        assert result["invalid"] == 1
+
+    def test_resume_after_failure(self, engine, tmp_path):
+        """Test a rerun continues after the last saved batch without duplicates."""
+        records = [{"original_url": f"https://example.com/{i}"} for i in range(10)]
+        path = write_json(tmp_path / "links.json", records)
+        calls = []
+
+        def fail_third_batch(shard, rows):
+            calls.append(len(rows))
+            if len(calls) == 3:
+                raise RuntimeError("connection lost")
+            insert_rows(shard, rows)
+
+        with patch("import_links.insert_rows", side_effect=fail_third_batch):
+            with pytest.raises(RuntimeError):
+                import_links(path, batch_size=3)
+        assert len(url_rows(engine)) == 6
+
+        result = import_links(path, batch_size=3)
+
+        assert result["imported"] == 10
+        assert result["position"] == 10
+        assert sorted(url_rows(engine).values()) == sorted(
+            record["original_url"] for record in records
+        )
+
+    def test_rerun_from_scratch_is_idempotent(self, engine, tmp_path):
+        """Test reimporting the same file finds every link already there."""
+        path = write_json(
+            tmp_path / "links.json",
+            [{"original_url": f"https://example.com/{i}"} for i in range(5)],
+        )
+        import_links(path)
+
+        result = import_links(path, restart=True)
+
+        assert result["imported"] == 0
+        assert result["existing"] == 5
+        assert len(url_rows(engine)) == 5
+
+    def test_parallel_validation(self, engine, tmp_path):
+        """Test validation in worker processes keeps every record."""
+        path = write_json(
+            tmp_path / "links.json",
+            [{"original_url": f"https://example.com/{i}"} for i in range(40)],
+        )
+
+        result = import_links(path, batch_size=7, workers=2)
+
+        assert result["imported"] == 40
+        assert len(url_rows(engine)) == 40
+
+    def test_import_into_shards(self, engine, tmp_path, monkeypatch):
+        """Test links land on the shard of their code with ids of that shard."""
+        monkeypatch.setattr(
+            "database.DATABASE_SHARD_URLS", [f"sqlite:///{tmp_path}/shard1.db"]
+        )
+        monkeypatch.setattr("database._shard_engines", {})
+        shard_engine = get_shard_engine(1)
+        Base.metadata.create_all(bind=shard_engine)
+        start_shard_ids(shard_engine, 1)
+        path = write_json(
+            tmp_path / "links.json",
+            [{"original_url": f"https://example.com/{i}"} for i in range(20)],
+        )
+
+        assert import_links(path)["imported"] == 20
+
+        for shard, shard_db in enumerate([engine, shard_engine]):
+            with shard_db.connect() as connection:
+                rows = connection.execute(text("SELECT id, short_code FROM urls"))
+                for row_id, code in rows:
+                    assert shard_for_code(code) == shard
+                    assert shard_for_id(row_id) == shard
+        shard_engine.dispose()
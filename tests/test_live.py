@@ -0,0 +1,96 @@
+"""Unit tests for the live click hub."""
+
+from unittest.mock import Mock, patch
+
+from live import ClickHub
+
+
+class TestClickHub:
+    """Test cases for fanning out published clicks."""
+
+    def make_hub(self):
+        """Create a hub without Redis so no listener thread is started."""
+        return ClickHub(Mock(redis_client=None))
+
+    def test_dispatch_counts_per_subscription(self):
+        """Test a click reaches every dashboard of its link only."""
+        hub = self.make_hub()
+        first = hub.subscribe("abc123")
+        second = hub.subscribe("abc123")
+        other = hub.subscribe("xyz789")
+
+        hub.dispatch(b"clicks:abc123", b"1000.0")
+        hub.dispatch("clicks:abc123")
+
+        assert first.drain(0) == 2
+        assert second.drain(0) == 2
+        assert other.drain(0) == 0
+
+    def test_drain_resets_count(self):
+        """Test each drain returns only clicks since the previous one."""
+        hub = self.make_hub()
+        subscription = hub.subscribe("abc123")
+        hub.dispatch("clicks:abc123")
+
+        assert subscription.drain(0) == 1
+        assert subscription.drain(0) == 0
+
+    def test_unsubscribe(self):
+        """Test closed subscriptions stop receiving clicks."""
+        hub = self.make_hub()
+        subscription = hub.subscribe("abc123")
+
+        hub.unsubscribe(subscription)
+        hub.dispatch("clicks:abc123")
+
+        assert subscription.closed
+        assert subscription.drain(0) == 0
+        assert hub.subscriber_count() == 0
+
+    @patch("live.threading.Thread")
+    def test_listener_started_once(self, mock_thread):
+        """Test one listener thread serves all subscriptions."""
+        mock_thread.return_value.is_alive.return_value = True
+        hub = ClickHub(Mock(redis_client=Mock()))
+
+        hub.subscribe("abc123")
+        hub.subscribe("xyz789")
+
+        mock_thread.assert_called_once()
+        mock_thread.return_value.start.assert_called_once()
+        assert hub.subscriber_count() == 2
+
+    def test_sync_channels_follows_open_streams(self):
+        """Test the listener subscribes only to links with open streams."""
+        hub = self.make_hub()
+        pubsub = Mock()
+        first = hub.subscribe("abc123")
+        hub.subscribe("abc123")
+
+        subscribed = hub.sync_channels(pubsub, set())
+        pubsub.subscribe.assert_called_once_with("clicks:abc123")
+
+        hub.unsubscribe(first)
+        assert hub.sync_channels(pubsub, subscribed) == {"abc123"}
+        pubsub.unsubscribe.assert_not_called()
+
+        other = hub.subscribe("xyz789")
+        hub.unsubscribe(other)
+        for subscription in list(hub._subscriptions["abc123"]):
+            hub.unsubscribe(subscription)
+        assert hub.sync_channels(pubsub, subscribed) == set()
+        pubsub.unsubscribe.assert_called_once_with("clicks:abc123")
+
+    def test_changes_wake_the_listener(self):
+        """Test only first and last subscriptions of a link signal changes."""
+        hub = self.make_hub()
+        first = hub.subscribe("abc123")
+        assert hub._changed.is_set()
+
+        hub.sync_channels(Mock(), set())
+        second = hub.subscribe("abc123")
+        hub.unsubscribe(first)
+        assert not hub._changed.is_set()
+
+        hub.unsubscribe(second)
+        assert hub._changed.is_set()
@@ -0,0 +1,97 @@
+"""Unit tests for the Core lookups of the redirect path."""
+
+from datetime import datetime
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from lookups import fetch_active_rules, fetch_url_target, lookup_url
+from models import Base, Rule, Url
+
+
+@pytest.fixture(scope="function")
+def test_db():
+    """Create a test database in memory."""
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+        echo=False,
+    )
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(autocommit=False, autoflush=False, bind=engine)()
+
+    try:
+        yield db
+    finally:
+        db.close()
+        engine.dispose()
+
+
+def add_rule(db, url_id, priority, is_active=1):
+    """Add a country rule to a URL."""
+    rule = Rule(
+        url_id=url_id,
+        rule_type="country",
+        condition_value="US",
+        target_url=f"https://example.com/{priority}",
+        priority=priority,
+        is_active=is_active,
+    )
+    db.add(rule)
+    db.commit()
+    return rule
+
+
+class TestLookups:
+    """Test cases for Core lookup statements."""
+
+    def test_lookup_url(self, test_db):
+        """Test a short code resolves to a plain row."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+
+        row = lookup_url(test_db, url.short_code)
+
+        assert tuple(row) == (url.id, "https://example.com", None, 0, False)
+        assert row.original_url == "https://example.com"
+        assert lookup_url(test_db, "missing") is None
+
+    def test_has_rules_counts_active_rules_only(self, test_db):
+        """Test has_rules ignores inactive rules."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        add_rule(test_db, url.id, 1, is_active=0)
+        assert not lookup_url(test_db, url.short_code).has_rules
+
+        add_rule(test_db, url.id, 2)
+        assert lookup_url(test_db, url.short_code).has_rules
+
+    def test_fetch_active_rules_in_priority_order(self, test_db):
+        """Test rules come back highest priority first, inactive ones skipped."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        low = add_rule(test_db, url.id, 1)
+        high = add_rule(test_db, url.id, 5)
+        add_rule(test_db, url.id, 9, is_active=0)
+
+        rows = fetch_active_rules(test_db, url.id)
+
+        assert [row.id for row in rows] == [high.id, low.id]
+        assert rows[0].target_url == "https://example.com/5"
+
+    def test_fetch_url_target(self, test_db):
+        """Test the original URL is looked up by link id."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+
+        assert fetch_url_target(test_db, url.id) == "https://example.com"
+        assert fetch_url_target(test_db, 999) is None
+
+    def test_deleted_url_is_not_found(self, test_db):
+        """Test links marked deleted are ignored by the lookups."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        url.deleted_at = datetime.utcnow()
+        test_db.commit()
+
+        assert lookup_url(test_db, url.short_code) is None
+        assert fetch_url_target(test_db, url.id) is None
+        assert Url.get_by_short_code(test_db, url.short_code) is None
@@ -0,0 +1,207 @@
+"""Unit tests for schema version stamps and migrations."""
+
+from unittest.mock import patch
+
+import pytest
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.pool import StaticPool
+
+from migrations import (
+    SCHEMA_VERSION,
+    check_schema,
+    get_schema_version,
+    migrate,
+    set_schema_version,
+)
+from models import Base
+
+
+@pytest.fixture
+def engine():
+    """Create an empty in-memory SQLite engine."""
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+        echo=False,
+    )
+    yield engine
+    engine.dispose()
+
+
+def drop_later_columns(engine):
+    """Turn a create_all database into one built on the original schema."""
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as connection:
+        connection.execute(text("DROP INDEX ix_urls_deleted_at"))
+        for table, column in [
+            ("urls", "deleted_at"),
+            ("visits", "referrer_host"),
+            ("rules", "conditions"),
+        ]:
+            connection.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+
+
+def column_names(engine, table):
+    """Get the column names of a table."""
+    return {column["name"] for column in inspect(engine).get_columns(table)}
+
+
+def count_queries(engine):
+    """Collect the statements executed on an engine."""
+    statements = []
+    event.listen(
+        engine,
+        "before_cursor_execute",
+        lambda conn, cursor, statement, *args: statements.append(statement),
+    )
+    return statements
+
+
+class TestMigrations:
+    """Test cases for the migration runner."""
+
+    def test_fresh_database_is_created_and_stamped(self, engine):
+        """Test an empty database gets all tables and the latest stamp."""
+        assert get_schema_version(engine) is None
+
+        assert migrate(engine) == SCHEMA_VERSION
+        assert get_schema_version(engine) == SCHEMA_VERSION
+        assert inspect(engine).has_table("urls")
+
+    def test_unstamped_database_runs_baseline(self, engine):
+        """Test a database created before the stamp gets the baseline."""
+        Base.metadata.create_all(bind=engine)
+
+        with patch("migrations.database.init_db") as mock_init_db:
+            assert migrate(engine) == SCHEMA_VERSION
+
+        mock_init_db.assert_called_once_with(engine)
+        assert get_schema_version(engine) == SCHEMA_VERSION
+
+    def test_current_database_is_left_alone(self, engine):
+        """Test migrating an up-to-date database applies nothing."""
+        migrate(engine)
+
+        with patch("migrations.database.init_db") as mock_init_db:
+            assert migrate(engine) == SCHEMA_VERSION
+        mock_init_db.assert_not_called()
+
+    def test_set_schema_version_keeps_one_row(self, engine):
+        """Test stamping twice updates the single stamp row."""
+        migrate(engine)
+        set_schema_version(engine, SCHEMA_VERSION + 1)
+
+        with engine.connect() as connection:
+            rows = connection.execute(
+                Base.metadata.tables["schema_version"].select()
+            ).fetchall()
+        assert [row.version for row in rows] == [SCHEMA_VERSION + 1]
+
+    @pytest.mark.parametrize("stamp", [None, 1, 2])
+    def test_original_schema_gains_later_columns(self, engine, stamp):
+        """Test columns added after the original schema are altered in."""
+        drop_later_columns(engine)
+        if stamp is not None:
+            # Stamped by an earlier release that relied on create_all
+            set_schema_version(engine, stamp)
+
+        assert migrate(engine) == SCHEMA_VERSION
+
+        assert "referrer_host" in column_names(engine, "visits")
+        assert "conditions" in column_names(engine, "rules")
+        assert "deleted_at" in column_names(engine, "urls")
+        with engine.begin() as connection:
+            connection.execute(
+                text("INSERT INTO visits (url_id, referrer_host) VALUES (1, 'direct')")
+            )
+
+    def test_deleted_at_added_to_existing_urls(self, engine):
+        """Test migration 3 adds urls.deleted_at and its index."""
+        Base.metadata.create_all(bind=engine)
+        with engine.begin() as connection:
+            connection.execute(text("DROP INDEX ix_urls_deleted_at"))
+            connection.execute(text("ALTER TABLE urls DROP COLUMN deleted_at"))
+        set_schema_version(engine, 2)
+
+        assert migrate(engine) == SCHEMA_VERSION
+
+        inspector = inspect(engine)
+        assert "deleted_at" in {c["name"] for c in inspector.get_columns("urls")}
+        assert "ix_urls_deleted_at" in {
+            i["name"] for i in inspector.get_indexes("urls")
+        }
+
+    def test_migrate_all_shards(self, tmp_path, monkeypatch):
+        """Test migrating without an engine covers every link shard."""
+        from database import create_database_engine, get_shard_engines
+
+        monkeypatch.setattr(
+            "database.DATABASE_SHARD_URLS", [f"sqlite:///{tmp_path}/shard1.db"]
+        )
+        monkeypatch.setattr("database._shard_engines", {})
+        monkeypatch.setattr(
+            "database._engine",
+            create_database_engine(f"sqlite:///{tmp_path}/shard0.db"),
+        )
+
+        assert migrate() == SCHEMA_VERSION
+        for engine in get_shard_engines():
+            assert get_schema_version(engine) == SCHEMA_VERSION
+            engine.dispose()
+
+
+class TestCheckSchema:
+    """Test cases for the worker startup check."""
+
+    def test_current_stamp_costs_one_query(self, engine):
+        """Test a stamped database is checked with a single query."""
+        migrate(engine)
+        statements = count_queries(engine)
+
+        assert check_schema(engine) == SCHEMA_VERSION
+        assert len(statements) == 1
+        assert "schema_version" in statements[0]
+
+    def test_missing_stamp_migrates_in_development(self, engine):
+        """Test a worker migrates a database without a stamp when allowed."""
+        with patch("migrations.AUTO_MIGRATE", True):
+            assert check_schema(engine) == SCHEMA_VERSION
+        assert inspect(engine).has_table("urls")
+
+    def test_missing_stamp_not_migrated_in_production(self, engine):
+        """Test a worker leaves migrations to the release step."""
+        with patch("migrations.AUTO_MIGRATE", False):
+            assert check_schema(engine) is None
+        assert not inspect(engine).has_table("urls")
+
+    def test_every_shard_is_checked(self, tmp_path, monkeypatch):
+        """Test a worker migrates shards behind the primary too."""
+        from database import create_database_engine, get_shard_engines
+
+        monkeypatch.setattr(
+            "database.DATABASE_SHARD_URLS", [f"sqlite:///{tmp_path}/shard1.db"]
+        )
+        monkeypatch.setattr("database._shard_engines", {})
+        monkeypatch.setattr(
+            "database._engine",
+            create_database_engine(f"sqlite:///{tmp_path}/shard0.db"),
+        )
+        primary, shard = get_shard_engines()
+        migrate(primary)
+
+        with patch("migrations.AUTO_MIGRATE", False):
+            assert check_schema() is None
+        with patch("migrations.AUTO_MIGRATE", True):
+            assert check_schema() == SCHEMA_VERSION
+        assert get_schema_version(shard) == SCHEMA_VERSION
+        primary.dispose()
+        shard.dispose()
+
+    def test_check_disabled(self, engine):
+        """Test SCHEMA_CHECK=false skips the database entirely."""
+        statements = count_queries(engine)
+
+        with patch("migrations.SCHEMA_CHECK", False):
+            assert check_schema(engine) is None
+        assert statements == []
@@ -5,7 +5,7 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import StaticPool
 
-from models import Base, Rule, Url, Visit
+from models import Base, Rule, Url, UrlClickCounter, Visit
 
 
 @pytest.fixture(scope="function")
@@ -133,7 +133,8 @@ class TestUrlModel:
 
         # Check click count incremented
         updated_url = Url.get_by_short_code(test_db, created_url.short_code)
-        assert updated_url.click_count == 1
+        UrlClickCounter.attach_totals(test_db, [updated_url])
+        assert updated_url.total_clicks == 1
 
         # Second access
         result2 = Url.get_original_url(test_db, created_url.short_code)
@@ -141,7 +142,8 @@ class TestUrlModel:
 
         # Check click count incremented again
         updated_url = Url.get_by_short_code(test_db, created_url.short_code)
-        assert updated_url.click_count == 2
+        UrlClickCounter.attach_totals(test_db, [updated_url])
+        assert updated_url.total_clicks == 2
 
     def test_get_original_url_not_exists(self, test_db):
         """Test getting original URL for non-existing short code."""
@@ -166,6 +168,65 @@ class TestUrlModel:
         assert data["created_at"] is not None
 
 
+class TestUrlClickCounter:
+    """Test cases for the click counter slots."""
+
+    def test_increment_spreads_over_slots(self, test_db, monkeypatch):
+        """Test clicks go to separate rows and reads sum them."""
+        monkeypatch.setattr("models.CLICK_COUNTER_SLOTS", 4)
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+
+        for _ in range(200):
+            UrlClickCounter.increment(test_db, url.id)
+        test_db.commit()
+
+        slots = test_db.query(UrlClickCounter).filter_by(url_id=url.id).all()
+        assert 1 < len(slots) <= 4
+        assert UrlClickCounter.pending(test_db, [url.id, 999]) == {url.id: 200}
+        assert url.click_count == 0
+
+    def test_compact_folds_slots_into_click_count(self, test_db):
+        """Test compaction moves the counts to urls.click_count."""
+        urls = [
+            Url.create_short_url(test_db, f"https://example.com/{i}", "http://x")
+            for i in range(3)
+        ]
+        for url, clicks in zip(urls, [5, 0, 2]):
+            for _ in range(clicks):
+                UrlClickCounter.increment(test_db, url.id)
+        test_db.commit()
+
+        assert UrlClickCounter.compact(test_db, batch_size=1) == 7
+
+        assert [url.click_count for url in urls] == [5, 0, 2]
+        assert test_db.query(UrlClickCounter).count() == 0
+        UrlClickCounter.attach_totals(test_db, urls)
+        assert [url.total_clicks for url in urls] == [5, 0, 2]
+
+    def test_compact_keeps_clicks_added_meanwhile(self, test_db, monkeypatch):
+        """Test only the folded amount is subtracted from a slot."""
+        monkeypatch.setattr("models.CLICK_COUNTER_SLOTS", 1)
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+        UrlClickCounter.increment(test_db, url.id, 3)
+        test_db.commit()
+
+        original_execute = test_db.execute
+        added = []
+
+        def click_during_fold(statement, *args, **kwargs):
+            # A click arrives between reading the slots and updating them
+            if not added and statement.is_dml and statement.table.name == "urls":
+                added.append(True)
+                UrlClickCounter.increment(test_db, url.id)
+            return original_execute(statement, *args, **kwargs)
+
+        monkeypatch.setattr(test_db, "execute", click_during_fold)
+        assert UrlClickCounter.compact(test_db) == 3
+
+        assert url.click_count == 3
+        assert UrlClickCounter.pending(test_db, [url.id]) == {url.id: 1}
+
+
 class TestRuleModel:
     """Test cases for Rule model."""
 
@@ -368,3 +429,13 @@ class TestVisitModel:
         assert data["device_type"] == "desktop"
         assert data["final_url"] == original_url
         assert data["created_at"] is not None
+
+    def test_normalize_referrer_host(self):
+        """Test referrer host normalization used at ingest time."""
+        assert Visit.normalize_referrer_host("https://WWW.Google.com/search") == (
+            "google.com"
+        )
+        assert Visit.normalize_referrer_host("https://t.co:443/abc") == "t.co"
+        assert Visit.normalize_referrer_host("") == "direct"
+        assert Visit.normalize_referrer_host(None) == "direct"
+        assert Visit.normalize_referrer_host("direct") == "direct"
@@ -0,0 +1,174 @@
+"""Unit tests for visits table partitioning helpers."""
+
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from archive import VisitArchive, archive_visits_before
+from models import Base
+from partitioning import (
+    add_months,
+    ensure_visit_partitions,
+    expired_partitions,
+    is_partitioning_enabled,
+    month_start,
+    partition_name,
+)
+from tasks import cleanup_old_visits, maintain_visit_partitions
+
+
+class TestPartitionHelpers:
+    """Test cases for partition naming and date arithmetic."""
+
+    def test_month_start(self):
+        """Test truncating a datetime to the start of its month."""
+        result = month_start(datetime(2025, 3, 17, 14, 30, 5))
+        assert result == datetime(2025, 3, 1)
+
+    def test_add_months_across_year(self):
+        """Test month arithmetic wraps around the year boundary."""
+        assert add_months(datetime(2025, 11, 1), 2) == datetime(2026, 1, 1)
+        assert add_months(datetime(2025, 1, 1), -1) == datetime(2024, 12, 1)
+
+    def test_partition_name(self):
+        """Test partition naming convention."""
+        assert partition_name(datetime(2025, 4, 1)) == "visits_2025_04"
+
+    def test_expired_partitions(self):
+        """Test only fully expired months are selected."""
+        names = ["visits_2025_01", "visits_2025_02", "visits_2025_03", "other"]
+        cutoff = datetime(2025, 3, 10)
+
+        result = expired_partitions(names, cutoff)
+
+        assert result == ["visits_2025_01", "visits_2025_02"]
+
+    def test_partitioning_disabled_for_sqlite(self):
+        """Test SQLite engines are never partitioned."""
+        engine = MagicMock()
+        engine.dialect.name = "sqlite"
+
+        with patch("partitioning.VISITS_PARTITIONING", True):
+            assert is_partitioning_enabled(engine) is False
+
+
+class TestEnsurePartitions:
+    """Test cases for creating the default and monthly partitions."""
+
+    def executed(self, conn):
+        """Get the SQL of every statement run on a mock connection."""
+        return [str(call.args[0]) for call in conn.execute.call_args_list]
+
+    def test_creates_default_and_monthly_partitions(self):
+        """Test a fresh table gets the default partition and the months ahead."""
+        engine = MagicMock()
+        conn = engine.begin.return_value.__enter__.return_value
+        conn.execute.return_value.scalar.return_value = None
+        conn.execute.return_value.first.return_value = None
+
+        created = ensure_visit_partitions(engine, months_ahead=1)
+
+        assert created[0] == "visits_default"
+        assert len(created) == 3
+        statements = self.executed(conn)
+        assert any("PARTITION OF visits DEFAULT" in sql for sql in statements)
+        assert not any("ATTACH PARTITION" in sql for sql in statements)
+
+    def test_moves_stranded_visits_out_of_default(self):
+        """Test visits already in the default partition move to their month."""
+        engine = MagicMock()
+        conn = engine.begin.return_value.__enter__.return_value
+        # The default partition exists, the current month does not
+        conn.execute.return_value.scalar.side_effect = ["visits_default", None]
+        conn.execute.return_value.first.return_value = (1,)
+
+        created = ensure_visit_partitions(engine, months_ahead=0)
+
+        assert len(created) == 1
+        statements = self.executed(conn)
+        assert any("DELETE FROM visits_default" in sql for sql in statements)
+        assert "ATTACH PARTITION" in statements[-1]
+
+    @patch("tasks.default_partition_in_use", return_value=True)
+    @patch("tasks.ensure_visit_partitions", return_value=[])
+    @patch("tasks.shard_engines")
+    def test_maintenance_warns_about_default_partition(
+        self, mock_engines, mock_ensure, mock_in_use
+    ):
+        """Test maintenance reports visits left in the default partition."""
+        mock_engines.return_value = [MagicMock()]
+
+        with patch("tasks.is_partitioning_enabled", return_value=True):
+            result = maintain_visit_partitions()
+
+        assert result["status"] == "success"
+        assert result["default_partition_in_use"] is True
+
+
+class TestPartitionedCleanup:
+    """Test cases for partition-aware visit cleanup."""
+
+    @patch("tasks.ensure_visit_partitions")
+    @patch("tasks.drop_expired_partitions")
+    @patch("tasks.is_partitioning_enabled", return_value=True)
+    @patch("tasks.get_db_session")
+    def test_cleanup_drops_partitions(
+        self, mock_get_db_session, mock_enabled, mock_drop, mock_ensure
+    ):
+        """Test cleanup drops expired partitions before deleting rows."""
+        mock_db = MagicMock()
+        mock_get_db_session.return_value = mock_db
+        mock_db.query.return_value.filter.return_value.delete.return_value = 3
+        mock_drop.return_value = ["visits_2025_01"]
+
+        result = cleanup_old_visits(days=90)
+
+        assert result["status"] == "success"
+        assert result["deleted"] == 3
+        assert result["dropped_partitions"] == ["visits_2025_01"]
+        mock_ensure.assert_called_once()
+
+    @patch("tasks.get_engine")
+    def test_maintain_partitions_skipped_without_postgres(self, mock_get_engine):
+        """Test partition maintenance is a no-op on SQLite."""
+        mock_get_engine.return_value.dialect.name = "sqlite"
+
+        result = maintain_visit_partitions()
+
+        assert result["status"] == "skipped"
+
+    @patch("tasks.ensure_visit_partitions")
+    @patch("tasks.drop_expired_partitions", return_value=[])
+    @patch("tasks.is_partitioning_enabled", return_value=True)
+    @patch("tasks.get_db_session")
+    def test_archive_transaction_ends_before_partition_ddl(
+        self, mock_get_db_session, mock_enabled, mock_drop, mock_ensure, tmp_path
+    ):
+        """Test the archive read is committed before partitions are detached."""
+        engine = create_engine("sqlite:///:memory:")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        mock_get_db_session.return_value = db
+        in_transaction = []
+
+        def drop_partitions(engine, cutoff):
+            in_transaction.append(db.in_transaction())
+            return []
+
+        mock_drop.side_effect = drop_partitions
+
+        def archive_to_tmp(session, cutoff, shard=0):
+            return archive_visits_before(
+                session, cutoff, VisitArchive(str(tmp_path)), shard
+            )
+
+        with patch("tasks.VISITS_ARCHIVE_DIR", str(tmp_path)), patch(
+            "tasks.archive_visits_before", side_effect=archive_to_tmp
+        ):
+            result = cleanup_old_visits(days=90)
+
+        assert result["status"] == "success"
+        assert in_transaction == [False]
+        engine.dispose()
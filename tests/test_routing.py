@@ -1,5 +1,9 @@
 """Unit tests for smart routing functionality."""
 
+import ipaddress
+import random
+import time
+from datetime import datetime, timezone
 from unittest.mock import MagicMock, patch
 
 import pytest
@@ -11,10 +15,27 @@ from main import (
     apply_routing_rules,
     get_client_info,
     get_country_code,
-    get_current_time_slot,
     get_device_type,
+    simulate_routing_rules,
 )
 from models import Base, Rule, Url
+from routing import (
+    AliasTable,
+    IpTrie,
+    ReferrerAutomaton,
+    RequestContext,
+    RuleCache,
+    compile_condition,
+    compile_rule_set,
+    compile_time_windows,
+    get_rule_set,
+    parse_ip_address,
+    parse_profile_epochs,
+    parse_profile_times,
+    rule_cache,
+    simulate_profiles,
+    sticky_draw,
+)
 
 
 @pytest.fixture(scope="function")
@@ -127,6 +148,17 @@ class TestDeviceDetection:
         result = get_device_type(ua)
         assert result == "desktop"  # fallback
 
+    def test_get_device_type_is_memoized(self):
+        """Test each distinct User-Agent is parsed once."""
+        get_device_type.cache_clear()
+        with patch("main.user_agents") as mock_user_agents:
+            mock_user_agents.parse.return_value.is_mobile = True
+            assert get_device_type("memo-agent") == "mobile"
+            assert get_device_type("memo-agent") == "mobile"
+
+        mock_user_agents.parse.assert_called_once_with("memo-agent")
+        get_device_type.cache_clear()
+
 
 class TestGeoLocation:
     """Test cases for geolocation."""
@@ -166,31 +198,6 @@ class TestGeoLocation:
             assert result == "XX"
 
 
-class TestTimeSlots:
-    """Test cases for time slot detection."""
-
-    @patch("main.datetime")
-    def test_get_current_time_slot_business(self, mock_datetime):
-        """Test business hours time slot."""
-        mock_datetime.now.return_value.hour = 14  # 2 PM
-        result = get_current_time_slot()
-        assert result == "09:00-18:00"
-
-    @patch("main.datetime")
-    def test_get_current_time_slot_evening(self, mock_datetime):
-        """Test evening time slot."""
-        mock_datetime.now.return_value.hour = 20  # 8 PM
-        result = get_current_time_slot()
-        assert result == "18:00-22:00"
-
-    @patch("main.datetime")
-    def test_get_current_time_slot_night(self, mock_datetime):
-        """Test night time slot."""
-        mock_datetime.now.return_value.hour = 2  # 2 AM
-        result = get_current_time_slot()
-        assert result == "22:00-09:00"
-
-
 class TestRoutingRules:
     """Test cases for routing rules application."""
 
@@ -296,8 +303,9 @@ class TestRoutingRules:
             "referrer": "https://google.com",
         }
 
-        # Mock time slot to return business hours
-        with patch("main.get_current_time_slot", return_value="09:00-18:00"):
+        # Mock the clock to business hours in server local time
+        business_hours = datetime(2025, 1, 6, 12, 0).astimezone()
+        with patch("main.get_current_time", return_value=business_hours):
             result = apply_routing_rules(test_db, url_obj.id, client_info)
 
         assert result == "https://example.com/business"
@@ -332,6 +340,40 @@ class TestRoutingRules:
 
         assert result == "https://example.com/seo-landing"
 
+    def test_apply_routing_rules_ip_match(self, test_db):
+        """Test IP range routing rule matching."""
+        url_obj = Url.create_short_url(
+            test_db, "https://example.com/test", "http://localhost:8000"
+        )
+        test_db.add(
+            Rule(
+                url_id=url_obj.id,
+                rule_type="ip",
+                condition_value="10.0.0.0/8, 2001:db8::/32",
+                target_url="https://example.com/office",
+                priority=5,
+                is_active=1,
+            )
+        )
+        test_db.commit()
+
+        client_info = {
+            "ip_address": "10.20.30.40",
+            "user_agent": "Mozilla/5.0 (Windows NT 10.0)",
+            "referrer": "",
+        }
+        assert (
+            apply_routing_rules(test_db, url_obj.id, client_info)
+            == "https://example.com/office"
+        )
+
+        rule_cache.clear()
+        client_info["ip_address"] = "192.168.1.1"
+        assert (
+            apply_routing_rules(test_db, url_obj.id, client_info)
+            == "https://example.com/test"
+        )
+
     def test_apply_routing_rules_weight_ab_testing(self, test_db):
         """Test weight-based A/B testing routing."""
         # Create a test URL
@@ -470,3 +512,610 @@ class TestRoutingRules:
 
         # Should return original URL since rule is inactive
         assert result == original_url
+
+
+def make_context(**values):
+    """Build a request context with fixed dimension values."""
+    resolvers = {name: (lambda value=value: value) for name, value in values.items()}
+    return RequestContext(resolvers, lambda: 0.5)
+
+
+class TestRuleEngine:
+    """Test cases for compiled, indexed routing rules."""
+
+    def test_compile_condition_validation(self):
+        """Test invalid conditions are rejected with a message."""
+        with pytest.raises(ValueError):
+            compile_condition("planet", "mars")
+        with pytest.raises(ValueError):
+            compile_condition("device", "smartwatch")
+        with pytest.raises(ValueError):
+            compile_condition("weight", "1.5")
+        with pytest.raises(ValueError):
+            compile_condition("country", " , ")
+
+    def test_condition_value_lists(self):
+        """Test comma separated values compile into sets."""
+        matcher = compile_condition("country", "fr, de")
+
+        assert matcher(make_context(country="DE"))
+        assert not matcher(make_context(country="US"))
+
+    def test_and_combined_conditions(self):
+        """Test every condition of a rule must match."""
+        rule = Rule(
+            id=1,
+            rule_type="country",
+            condition_value="FR",
+            conditions='[{"type": "device", "value": "mobile"}]',
+            target_url="https://example.com/fr-mobile",
+        )
+        rule_set = compile_rule_set("https://example.com", [rule])
+
+        assert rule_set.match(make_context(country="FR", device="mobile"))
+        assert rule_set.match(make_context(country="FR", device="desktop")) is None
+
+    def test_only_needed_dimensions_are_resolved(self):
+        """Test indexed rules skip resolving dimensions of non-candidates."""
+        rules = [
+            Rule(id=1, rule_type="country", condition_value="JP", target_url="a"),
+            Rule(id=2, rule_type="device", condition_value="tablet", target_url="b"),
+        ]
+        rule_set = compile_rule_set("https://example.com", rules)
+        resolved = []
+
+        def resolver(name, value):
+            return lambda: resolved.append(name) or value
+
+        context = RequestContext(
+            {
+                "country": resolver("country", "US"),
+                "device": resolver("device", "mobile"),
+                "referrer": resolver("referrer", ""),
+            },
+            lambda: 0.0,
+        )
+
+        assert rule_set.match(context) is None
+        assert sorted(resolved) == ["country", "device"]
+
+    def test_candidates_keep_priority_order(self):
+        """Test indexed and scanned rules are merged by priority."""
+        rules = [
+            Rule(id=1, rule_type="referrer", condition_value="t.co", target_url="a"),
+            Rule(id=2, rule_type="country", condition_value="US", target_url="b"),
+            Rule(id=3, rule_type="weight", condition_value="1", target_url="c"),
+        ]
+        rule_set = compile_rule_set("https://example.com", rules)
+
+        context = make_context(country="US", referrer="https://google.com")
+
+        assert rule_set.candidates(context) == [0, 1, 2]
+        assert rule_set.match(context).target_url == "b"
+
+    def test_weight_read_from_condition_value(self):
+        """Test weight rules without a stored weight use condition_value."""
+        rule = Rule(id=1, rule_type="weight", condition_value="0.6", target_url="b")
+        rule_set = compile_rule_set("https://example.com", [rule])
+
+        assert rule_set.rules[0].matchers[0].weight == 0.6
+
+    def test_rule_set_is_cached(self, test_db):
+        """Test compiled rules are reused until invalidated."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+
+        with patch.object(rule_cache, "ttl", 60):
+            first = get_rule_set(test_db, url.id)
+            test_db.add(
+                Rule(
+                    url_id=url.id,
+                    rule_type="country",
+                    condition_value="FR",
+                    target_url="https://example.com/fr",
+                )
+            )
+            test_db.commit()
+
+            assert get_rule_set(test_db, url.id) is first
+            rule_cache.invalidate(url.id)
+            assert len(get_rule_set(test_db, url.id).rules) == 1
+
+    def test_rule_set_recompiled_for_new_version(self, test_db):
+        """Test a rule change made by another process (a new version) applies."""
+        url = Url.create_short_url(test_db, "https://example.com", "http://x")
+
+        with patch.object(rule_cache, "ttl", 60):
+            first = get_rule_set(test_db, url.id, version=0)
+            test_db.add(
+                Rule(
+                    url_id=url.id,
+                    rule_type="country",
+                    condition_value="FR",
+                    target_url="https://example.com/fr",
+                )
+            )
+            test_db.commit()
+
+            assert get_rule_set(test_db, url.id, version=0) is first
+            assert len(get_rule_set(test_db, url.id, version=1).rules) == 1
+            assert rule_cache.get(url.id, version=0) is None
+
+    def test_missing_url(self, test_db):
+        """Test routing a missing URL gives no rule set."""
+        assert get_rule_set(test_db, 999) is None
+
+    def test_few_rules_are_scanned(self):
+        """Test links with few rules skip the index but match the same way."""
+        rules = [
+            Rule(id=1, rule_type="country", condition_value="FR", target_url="a"),
+            Rule(id=2, rule_type="device", condition_value="mobile", target_url="b"),
+        ]
+        scanned = compile_rule_set("https://example.com", rules)
+        with patch("routing.LINEAR_MAX_RULES", 0):
+            indexed = compile_rule_set("https://example.com", rules)
+
+        assert scanned.index == {}
+        assert scanned.scan == [0, 1]
+        assert set(indexed.index) == {"country", "device"}
+        for country, device, rule_id in [
+            ("FR", "mobile", 1),
+            ("US", "mobile", 2),
+            ("US", "desktop", None),
+        ]:
+            for rule_set in (scanned, indexed):
+                rule = rule_set.match(make_context(country=country, device=device))
+                assert (rule.id if rule else None) == rule_id
+
+    def test_rule_cache_is_bounded(self):
+        """Test the least recently used links are evicted first."""
+        cache = RuleCache(ttl=60, size=2)
+        rule_sets = {
+            url_id: compile_rule_set(f"https://example.com/{url_id}", [])
+            for url_id in (1, 2, 3)
+        }
+        cache.set(1, rule_sets[1])
+        cache.set(2, rule_sets[2])
+        assert cache.get(1) is rule_sets[1]
+
+        cache.set(3, rule_sets[3])
+
+        assert len(cache) == 2
+        assert cache.get(2) is None
+        assert cache.get(1) is rule_sets[1]
+        assert cache.get(3) is rule_sets[3]
+
+    def test_rule_cache_drops_expired_entries(self):
+        """Test expired rule sets are removed when they are looked up."""
+        cache = RuleCache(ttl=60)
+        cache.set(1, compile_rule_set("https://example.com", []))
+
+        with patch("routing.time.monotonic", return_value=time.monotonic() + 61):
+            assert cache.get(1) is None
+        assert len(cache) == 0
+
+
+class TestWeightedSplit:
+    """Test cases for alias-table A/B splitting."""
+
+    def pick_shares(self, rule_set, draws=10000):
+        """Route evenly spaced draws and count the share of every target."""
+        shares = {}
+        for i in range(draws):
+            context = RequestContext({}, lambda i=i: (i + 0.5) / draws)
+            rule = rule_set.match(context)
+            target = rule.target_url if rule else None
+            shares[target] = shares.get(target, 0) + 1 / draws
+        return shares
+
+    def test_alias_table_matches_weights(self):
+        """Test each index is picked with its configured probability."""
+        table = AliasTable([0.1, 0.6, 0.3])
+        draws = 10000
+        counts = [0, 0, 0]
+        for i in range(draws):
+            counts[table.pick((i + 0.5) / draws)] += 1
+
+        assert [round(count / draws, 2) for count in counts] == [0.1, 0.6, 0.3]
+
+    def test_split_matches_configured_weights(self):
+        """Test weight rules split traffic exactly, not sequentially."""
+        rules = [
+            Rule(id=1, rule_type="weight", condition_value="0.5", target_url="a"),
+            Rule(id=2, rule_type="weight", condition_value="0.3", target_url="b"),
+        ]
+        rule_set = compile_rule_set("https://example.com", rules)
+
+        shares = self.pick_shares(rule_set)
+
+        assert round(shares["a"], 2) == 0.5
+        assert round(shares["b"], 2) == 0.3
+        assert round(shares[None], 2) == 0.2
+
+    def test_weights_above_one_are_normalized(self):
+        """Test weights adding up to more than 1 are scaled down."""
+        rules = [
+            Rule(id=1, rule_type="weight", condition_value="1", target_url="a"),
+            Rule(id=2, rule_type="weight", condition_value="1", target_url="b"),
+        ]
+        rule_set = compile_rule_set("https://example.com", rules)
+
+        shares = self.pick_shares(rule_set)
+
+        assert round(shares["a"], 2) == 0.5
+        assert round(shares["b"], 2) == 0.5
+
+    def test_one_draw_per_visit(self):
+        """Test all weight rules of a visit share a single draw."""
+        rules = [
+            Rule(id=1, rule_type="weight", condition_value="0.5", target_url="a"),
+            Rule(id=2, rule_type="weight", condition_value="0.5", target_url="b"),
+        ]
+        rule_set = compile_rule_set("https://example.com", rules)
+        draws = []
+
+        def draw():
+            draws.append(1)
+            return 0.75
+
+        rule_set.match(RequestContext({}, draw))
+
+        assert len(draws) == 1
+
+    def test_sticky_draw_is_deterministic(self):
+        """Test a visitor always gets the same draw for a link."""
+        first = sticky_draw(1, "visitor")
+
+        assert first == sticky_draw(1, "visitor")
+        assert 0 <= first < 1
+        assert first != sticky_draw(2, "visitor")
+
+    def test_sticky_assignment(self, test_db):
+        """Test sticky A/B tests route a visitor to the same variant."""
+        url_obj = Url.create_short_url(test_db, "https://example.com", "http://x")
+        for target in ["https://example.com/a", "https://example.com/b"]:
+            test_db.add(
+                Rule(
+                    url_id=url_obj.id,
+                    rule_type="weight",
+                    condition_value="0.5",
+                    target_url=target,
+                )
+            )
+        test_db.commit()
+        client_info = {
+            "ip_address": "10.0.0.1",
+            "user_agent": "Mozilla/5.0",
+            "referrer": "",
+        }
+
+        with patch("main.STICKY_AB_TESTS", True):
+            results = {
+                apply_routing_rules(test_db, url_obj.id, client_info) for _ in range(20)
+            }
+
+        assert len(results) == 1
+
+
+class TestTimeWindows:
+    """Test cases for minute-of-week time rules."""
+
+    def matches(self, value, now):
+        """Check a schedule against an aware datetime."""
+        matcher = compile_time_windows(value)
+        return matcher(RequestContext({"now": lambda: now}, lambda: 0.0))
+
+    def test_daily_window(self):
+        """Test a window without days applies every day."""
+        utc = timezone.utc
+        assert self.matches("09:30-17:00 UTC", datetime(2025, 1, 4, 9, 30, tzinfo=utc))
+        assert not self.matches("09:30-17:00 UTC", datetime(2025, 1, 4, 17, tzinfo=utc))
+
+    def test_weekday_mask(self):
+        """Test day ranges and lists limit the window."""
+        utc = timezone.utc
+        # 2025-01-06 is a Monday, 2025-01-11 a Saturday
+        schedule = "Mon-Fri 09:00-18:00, Sat+Sun 10:00-12:00 UTC"
+        assert self.matches(schedule, datetime(2025, 1, 6, 9, 0, tzinfo=utc))
+        assert not self.matches(schedule, datetime(2025, 1, 11, 9, 0, tzinfo=utc))
+        assert self.matches(schedule, datetime(2025, 1, 11, 11, 0, tzinfo=utc))
+
+    def test_window_wraps_past_midnight_and_week_end(self):
+        """Test night windows spill into the next day, Sunday into Monday."""
+        utc = timezone.utc
+        assert self.matches("Sun 22:00-02:00 UTC", datetime(2025, 1, 6, 1, tzinfo=utc))
+        assert not self.matches(
+            "Sun 22:00-02:00 UTC", datetime(2025, 1, 6, 2, tzinfo=utc)
+        )
+
+    def test_time_zone(self):
+        """Test windows are evaluated in the rule's time zone."""
+        # 07:00 UTC is 10:00 in Moscow
+        now = datetime(2025, 1, 6, 7, 0, tzinfo=timezone.utc)
+        assert self.matches("Mon 09:00-18:00 Europe/Moscow", now)
+        assert not self.matches("Mon 09:00-18:00 UTC", now)
+
+    def test_bitmap_size(self):
+        """Test schedules compile into a minute-of-week bitmap."""
+        matcher = compile_time_windows("Mon 00:00-24:00 UTC")
+
+        assert len(matcher.bitmap) * 8 == 10080
+        assert sum(bin(byte).count("1") for byte in matcher.bitmap) == 1440
+
+    def test_invalid_schedules(self):
+        """Test malformed schedules are rejected."""
+        for value in ["", "Funday", "25:00-26:00", "09:00-18:00 Mars/Base"]:
+            with pytest.raises(ValueError):
+                compile_time_windows(value)
+
+
+class TestReferrerAutomaton:
+    """Test cases for multi-pattern referrer matching."""
+
+    def test_search_matches_substring_checks(self):
+        """Test the automaton finds exactly the contained patterns."""
+        rng = random.Random(7)
+        patterns = ["".join(rng.choice("abc") for _ in range(rng.randint(1, 4)))]
+        patterns += [
+            "".join(rng.choice("abc") for _ in range(rng.randint(1, 4)))
+            for _ in range(40)
+        ]
+        automaton = ReferrerAutomaton([(p, i) for i, p in enumerate(patterns)])
+
+        for _ in range(200):
+            text = "".join(rng.choice("abcd") for _ in range(rng.randint(0, 20)))
+            expected = {i for i, pattern in enumerate(patterns) if pattern in text}
+            assert automaton.search(text) == expected
+
+    def test_highest_priority_referrer_rule_wins(self):
+        """Test many referrer rules resolve to the first one by priority."""
+        rules = [
+            Rule(
+                id=i + 1,
+                rule_type="referrer",
+                condition_value=f"partner{i}",
+                target_url=f"https://example.com/{i}",
+            )
+            for i in range(100)
+        ]
+        rules.insert(
+            50,
+            Rule(id=500, rule_type="referrer", condition_value="t.co", target_url="t"),
+        )
+        rule_set = compile_rule_set("https://example.com", rules)
+        assert rule_set.referrer_automaton is not None
+
+        # "partner1" is also a substring of "partner17" and has higher priority
+        context = make_context(referrer="https://partner17.example/page")
+        assert rule_set.match(context).target_url == "https://example.com/1"
+        assert rule_set.match(make_context(referrer="https://t.co/x")).target_url == "t"
+        assert rule_set.match(make_context(referrer="")) is None
+
+    def test_referrer_condition_with_automaton(self):
+        """Test referrer conditions of indexed rules use the shared automaton."""
+        rules = [
+            Rule(
+                id=1,
+                rule_type="country",
+                condition_value="FR",
+                conditions='[{"type": "referrer", "value": "google"}]',
+                target_url="fr-google",
+            )
+        ] + [
+            Rule(
+                id=i + 2,
+                rule_type="referrer",
+                condition_value=f"site{i}",
+                target_url=f"site{i}",
+            )
+            for i in range(10)
+        ]
+        rule_set = compile_rule_set("https://example.com", rules)
+
+        context = make_context(country="FR", referrer="https://google.fr")
+        assert rule_set.match(context).target_url == "fr-google"
+        context = make_context(country="FR", referrer="https://site3.example")
+        assert rule_set.match(context).target_url == "site3"
+
+
+class TestIpRanges:
+    """Test cases for CIDR routing rules."""
+
+    def test_trie_matches_network_membership(self):
+        """Test trie lookups agree with ipaddress containment checks."""
+        rng = random.Random(3)
+        networks = []
+        for _ in range(200):
+            if rng.random() < 0.7:
+                address = ipaddress.IPv4Address(rng.getrandbits(32))
+                prefix = rng.randint(0, 32)
+            else:
+                address = ipaddress.IPv6Address(rng.getrandbits(128))
+                prefix = rng.randint(0, 128)
+            networks.append(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+        trie = IpTrie([(network, i) for i, network in enumerate(networks)])
+
+        for network in networks[:50]:
+            address = network.network_address
+            expected = {
+                i
+                for i, other in enumerate(networks)
+                if other.version == address.version and address in other
+            }
+            assert trie.lookup(address) == expected
+        for _ in range(200):
+            address = ipaddress.IPv4Address(rng.getrandbits(32))
+            expected = {
+                i
+                for i, other in enumerate(networks)
+                if other.version == 4 and address in other
+            }
+            assert trie.lookup(address) == expected
+
+    def test_ip_condition(self):
+        """Test CIDR lists, single addresses and IPv4-mapped addresses."""
+        matcher = compile_condition("ip", "10.0.0.0/8, 192.168.1.7, 2001:db8::/32")
+
+        assert matcher(make_context(ip="10.1.2.3"))
+        assert matcher(make_context(ip="192.168.1.7"))
+        assert matcher(make_context(ip="::ffff:10.9.9.9"))
+        assert matcher(make_context(ip="2001:db8:1::1"))
+        assert not matcher(make_context(ip="192.168.1.8"))
+        assert not matcher(make_context(ip="not an ip"))
+        assert parse_ip_address("::ffff:10.9.9.9").version == 4
+
+    def test_invalid_networks(self):
+        """Test invalid networks are rejected with a message."""
+        with pytest.raises(ValueError, match="10.0.0.0/33"):
+            compile_condition("ip", "10.0.0.0/33")
+        with pytest.raises(ValueError):
+            compile_condition("ip", "example.com")
+
+    def test_most_specific_rules_by_priority(self):
+        """Test overlapping ranges resolve to the highest priority rule."""
+        rules = [
+            Rule(id=1, rule_type="ip", condition_value="10.1.0.0/16", target_url="a"),
+            Rule(
+                id=2,
+                rule_type="country",
+                condition_value="FR",
+                conditions='[{"type": "ip", "value": "10.0.0.0/8"}]',
+                target_url="b",
+            ),
+            Rule(id=3, rule_type="ip", condition_value="10.0.0.0/8", target_url="c"),
+        ]
+        with patch("routing.LINEAR_MAX_RULES", 0):
+            rule_set = compile_rule_set("https://example.com", rules)
+
+        assert set(rule_set.ip_index) == {0, 2}
+        assert rule_set.match(make_context(ip="10.1.0.1", country="FR")).id == 1
+        assert rule_set.match(make_context(ip="10.2.0.1", country="FR")).id == 2
+        assert rule_set.match(make_context(ip="10.2.0.1", country="US")).id == 3
+        assert rule_set.match(make_context(ip="11.0.0.1", country="FR")) is None
+
+
+class TestSimulation:
+    """Test cases for bulk rule simulation."""
+
+    def make_rules(self):
+        return [
+            Rule(id=1, rule_type="ip", condition_value="10.0.0.0/8", target_url="a"),
+            Rule(
+                id=2,
+                rule_type="referrer",
+                condition_value="google",
+                conditions='[{"type": "time", "value": "09:00-18:00 UTC"}]',
+                target_url="b",
+            ),
+            Rule(id=3, rule_type="device", condition_value="mobile", target_url="c"),
+        ]
+
+    def test_matches_single_evaluation(self):
+        """Test batch results equal evaluating every profile on its own."""
+        rule_set = compile_rule_set("https://example.com", self.make_rules())
+        rng = random.Random(5)
+        profiles = [
+            {
+                "ip": rng.choice(["10.1.1.1", "192.168.0.1", "::ffff:10.0.0.9"]),
+                "user_agent": rng.choice(
+                    ["Mozilla/5.0 (iPhone; CPU iPhone OS 14_7_1)", "curl/8.0"]
+                ),
+                "referrer": rng.choice(["https://google.com/", ""]),
+                "timestamp": f"2025-01-06T{rng.randint(0, 23):02d}:30:00Z",
+            }
+            for _ in range(300)
+        ]
+
+        expected = {}
+        for profile in profiles:
+            now = datetime.fromisoformat(profile["timestamp"].replace("Z", "+00:00"))
+            context = make_context(
+                ip=profile["ip"],
+                device=get_device_type(profile["user_agent"]),
+                now=now,
+                referrer=profile["referrer"],
+            )
+            rule = rule_set.match(context)
+            rule_id = rule.id if rule else None
+            expected[rule_id] = expected.get(rule_id, 0) + 1
+
+        assert simulate_routing_rules(rule_set, 1, profiles) == expected
+
+    def test_weight_rules_draw_per_profile(self):
+        """Test A/B rules are drawn for every profile, not once per batch."""
+        rules = self.make_rules() + [
+            Rule(id=4, rule_type="weight", condition_value="0.5", target_url="d")
+        ]
+        rule_set = compile_rule_set("https://example.com", rules)
+        profiles = [{"ip": "192.168.0.1"}] * 2000
+
+        counts = simulate_routing_rules(rule_set, 1, profiles)
+
+        assert set(counts) == {4, None}
+        assert 800 < counts[4] < 1200
+
+    def test_bulk_matches_per_profile_evaluation(self):
+        """Test NumPy bulk evaluation agrees with the per-profile loop."""
+        rules = self.make_rules() + [
+            Rule(
+                id=4,
+                rule_type="time",
+                condition_value="Sun 02:00-04:00 America/New_York",
+                target_url="d",
+            ),
+            Rule(id=5, rule_type="weight", condition_value="0.3", target_url="e"),
+            Rule(id=6, rule_type="weight", condition_value="0.2", target_url="f"),
+            Rule(id=7, rule_type="country", condition_value="FR", target_url="g"),
+        ]
+        rule_set = compile_rule_set("https://example.com", rules)
+        rng = random.Random(7)
+        # Minutes around the New York DST change of 2025-03-09 07:00 UTC
+        profiles = [
+            {
+                "ip": f"{rng.choice([10, 11, 12])}.0.0.{rng.randint(1, 9)}",
+                "user_agent": rng.choice(["iPhone; CPU iPhone OS 14", "curl/8.0"]),
+                "referrer": rng.choice(["https://Google.com/", "", None]),
+                "timestamp": f"2025-03-09T{rng.randint(5, 9):02d}:"
+                f"{rng.randint(0, 59):02d}:00Z",
+            }
+            for _ in range(500)
+        ]
+
+        def simulate():
+            return simulate_profiles(
+                rule_set,
+                profiles,
+                lambda ip: "FR" if ip.startswith("12.") else "US",
+                lambda user_agent: "mobile" if "iPhone" in user_agent else "desktop",
+                lambda ip, user_agent: lambda: sticky_draw(1, ip + user_agent),
+            )
+
+        bulk = simulate()
+        with patch("routing.np", None):
+            assert bulk == simulate()
+        assert {4, 5, 6, 7} <= set(bulk)
+
+    def test_parse_profile_times(self):
+        """Test bulk parsing agrees with fromisoformat for every form."""
+        values = [
+            "2025-01-06T09:30:00Z",
+            "2025-01-06T09:30:00.250",
+            "2025-01-06T09:30",
+            "2025-01-06",
+            "2025-01-06T11:30:00+02:00",
+        ]
+
+        parsed = parse_profile_times(values)
+
+        assert parsed["2025-01-06T09:30:00Z"] == datetime(
+            2025, 1, 6, 9, 30, tzinfo=timezone.utc
+        )
+        assert parsed["2025-01-06T11:30:00+02:00"] == parsed["2025-01-06T09:30:00Z"]
+        assert parsed["2025-01-06T09:30:00.250"].microsecond == 250000
+        assert parsed["2025-01-06"] == datetime(2025, 1, 6, tzinfo=timezone.utc)
+        assert all(value.tzinfo is not None for value in parsed.values())
+        epochs = parse_profile_epochs(values)
+        assert epochs.tolist() == [parsed[value].timestamp() for value in values]
+        with pytest.raises(ValueError, match="времени"):
+            parse_profile_times(["2025-13-01T00:00:00Z"])
+        with pytest.raises(ValueError, match="времени"):
+            parse_profile_times([20250106])
@@ -0,0 +1 @@
+ALTER TABLE rules ALTER COLUMN condition_value TYPE TEXT;